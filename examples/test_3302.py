@@ -28,7 +28,7 @@ def plot_waveforms(runNumber, num_waveforms=5):
     file_name = "t1_run{}.h5".format(runNumber)
 
     dcdr = dl.SIS3302Decoder(file_name)
-    df_events = pd.read_hdf(file_name, key=dcdr.decoder_name)
+    df_events = dcdr.read_file(file_name)
 
     plt.figure()
     plt.xlabel("Time [ns]")
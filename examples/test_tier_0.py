@@ -49,9 +49,8 @@ def plot_baselines(file_name, draw_non_detectors=False):
     plt.xlabel("Time")
 
 def plot_waveforms(file_name, num_waveforms=5):
-    df_gretina = pd.read_hdf(file_name, key="ORGretina4MWaveformDecoder")
-    
     g4 = dl.Gretina4MDecoder(file_name)
+    df_gretina = g4.read_file(file_name)
 
     plt.figure()
     plt.xlabel("Time [ns]")
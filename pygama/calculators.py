@@ -2,72 +2,147 @@ import numpy as np
 import pandas as pd
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy import signal, interpolate
+from functools import lru_cache
+
+from .utils import batch_aware
+
+#All the calculators marked batch_aware take a single waveform or a 2-D block with one waveform per row.
+#For a block they return one value per row (several outputs come back as a sequence, one array per output),
+#and per-event parameters can be given as arrays with one value per row.
+
+def interp_two_point(x, xp0, xp1, fp0, fp1):
+    '''
+    np.interp(x, (xp0, xp1), (fp0, fp1)), elementwise over arrays of points -- done with the same
+    arithmetic and the same order of edge checks as np.interp, so the results are identical
+    '''
+    x, xp0, xp1 = np.asarray(x, dtype=np.float64), np.asarray(xp0, dtype=np.float64), np.asarray(xp1, dtype=np.float64)
+    fp0, fp1 = np.asarray(fp0, dtype=np.float64), np.asarray(fp1, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (fp1 - fp0) / (xp1 - xp0)
+        val = slope*(x - xp0) + fp0
+        val = np.where(np.isnan(val), slope*(x - xp1) + fp1, val)
+    val = np.where(np.isnan(val) & (fp0 == fp1), fp0, val)
+    val = np.where(x == xp0, fp0, val)
+    val = np.where(x >= xp1, fp1, val)
+    val = np.where(x < xp0, fp0, val)
+    return np.where(x > xp1, fp1, val)
 
 #Finds the maximum current ("A").  Current is calculated by convolution with a first-deriv. of Gaussian
+@batch_aware
 def current_max(waveform, sigma=1):
   if sigma > 0:
-      return np.amax(gaussian_filter1d(waveform, sigma=sigma, order=1))
+      return np.amax(gaussian_filter1d(waveform, sigma=sigma, order=1), axis=-1)
   else:
       print("Current max requires smooth>0")
       exit(0)
 
+@lru_cache(maxsize=32)
+def baseline_fit_matrix(start_index, end_index, order):
+    '''
+    Least-squares matrix for a polynomial fit of samples [start_index, end_index): multiplying a window of
+    samples by it gives the coefficients (highest power first, like np.polyfit).  Columns of the design
+    matrix are scaled before the pseudo-inverse, as np.polyfit does, to keep high orders well conditioned.
+    '''
+    design = np.vander(np.arange(start_index, end_index, dtype=np.float64), order+1)
+    scale = np.sqrt((design*design).sum(axis=0))
+    fit_matrix = np.linalg.pinv(design/scale) / scale[:, np.newaxis]
+    fit_matrix.flags.writeable = False
+    return fit_matrix
+
 #Finds baseline from start index to end index samples (default linear)
+@batch_aware
 def fit_baseline(waveform, start_index=0, end_index=500, order=1):
-    if end_index == -1: end_index = len(waveform)
-    p = np.polyfit(np.arange(start_index, end_index), waveform[start_index:end_index], 1)
-    return p
+    '''
+    Returns the polynomial coefficients, highest power first (for a block, one array of coefficients per power).
+    The fit is a product with a precomputed least-squares matrix, so a block of baselines is fit at once
+    '''
+    waveform = np.asarray(waveform)
+    if end_index == -1: end_index = waveform.shape[-1]
+    fit_matrix = baseline_fit_matrix(start_index, end_index, order)
+
+    #einsum (unlike a BLAS matrix product) sums each row the same way however many rows there are,
+    #so a waveform gets the same fit on its own or in a block
+    window = np.atleast_2d(waveform)[:, start_index:end_index]
+    p = np.einsum("ij,kj->ki", window, fit_matrix)
+    return p[:,0] if waveform.ndim == 1 else p
 
+@batch_aware
 def is_saturated(waveform, bit_precision=14):
-    return True if np.amax(waveform) >= 0.5*2**bit_precision - 1 else False
+    waveform = np.asarray(waveform)
+    saturated = np.amax(waveform, axis=-1) >= 0.5*2**bit_precision - 1
+    return bool(saturated) if waveform.ndim == 1 else saturated
 
 #Estimate t0
+@batch_aware
 def t0_estimate(waveform, baseline=0, median_kernel_size=51):
 
-    wf_med = signal.medfilt(waveform, kernel_size=median_kernel_size)
+    waveform = np.asarray(waveform)
+    wfs = np.atleast_2d(waveform)
+    n_samples = wfs.shape[-1]
+    wf_med = signal.medfilt(wfs, kernel_size=(1, median_kernel_size))
     med_diff = gaussian_filter1d(wf_med, sigma=1, order=1)
 
-    tp05 = calc_timepoint(waveform, percentage=0.005, baseline=0, do_interp=False, doNorm=False)
-    tp05_rel = np.int(tp05+1)
+    tp05 = calc_timepoint(wfs, percentage=0.005, baseline=0, do_interp=False, doNorm=False)
+    tp05_rel = (tp05+1).astype(np.int64)
     thresh = 5E-5
-    last_under = tp05_rel - np.argmax(med_diff[tp05_rel::-1]<=thresh)
 
-    t0 = np.interp(thresh, ( med_diff[last_under],   med_diff[last_under+1] ), (last_under, last_under+1))
+    #last sample at or before tp05_rel (counting back from there) with med_diff <= thresh
+    search_start = np.minimum(tp05_rel, n_samples-1)
+    under = (med_diff <= thresh) & (np.arange(n_samples) <= search_start[:, np.newaxis])
+    last_idx = n_samples-1 - np.argmax(under[:, ::-1], axis=-1)
+    last_under = np.where(under.any(axis=-1), tp05_rel - (search_start - last_idx), tp05_rel)
+
+    rows = np.arange(len(wfs))
+    t0 = interp_two_point(thresh, med_diff[rows, last_under], med_diff[rows, last_under+1], last_under, last_under+1)
 
-    return t0
+    return t0[0] if waveform.ndim == 1 else t0
 
 
 #Estimate arbitrary timepoint before max
+@batch_aware
 def calc_timepoint(waveform, percentage=0.5, baseline=0, do_interp=False, doNorm=True):
     '''
     percentage: if less than zero, will return timepoint on falling edge
     do_interp: linear linerpolation of the timepoint...
+    For a block of waveforms, baseline can have one value per row; several percentages give one
+    array of timepoints per percentage
     '''
-    wf_norm = (np.copy(waveform) - baseline)
-    if doNorm: wf_norm /= np.amax(wf_norm)
+    waveform = np.asarray(waveform)
+    wf_norm = np.atleast_2d(waveform) - np.asarray(baseline)[..., np.newaxis]
+    if doNorm: wf_norm = wf_norm / np.amax(wf_norm, axis=-1, keepdims=True)
+    n_samples = wf_norm.shape[-1]
+    rows = np.arange(len(wf_norm))
 
     def get_tp(perc):
         if perc > 0:
-            first_over = np.argmax( wf_norm >= perc )
-            if do_interp and first_over > 0:
-                val = np.interp(perc, ( wf_norm[first_over-1],   wf_norm[first_over] ), (first_over-1, first_over))
-            else: val = first_over
+            first_over = np.argmax( wf_norm >= perc, axis=-1 )
+            if not do_interp: return first_over
+            prev = np.maximum(first_over-1, 0)
+            val = interp_two_point(perc, wf_norm[rows, prev], wf_norm[rows, first_over], first_over-1, first_over)
+            return np.where(first_over > 0, val, first_over)
         else:
             perc = np.abs(perc)
             above_thresh = wf_norm >= perc
-            last_over = len(wf_norm)-1 - np.argmax(above_thresh[::-1])
-            if do_interp and last_over < len(wf_norm)-1:
-                val = np.interp(perc, (  wf_norm[last_over+1], wf_norm[last_over] ), (last_over+1, last_over))
-            else: val = last_over
-        return val
+            last_over = n_samples-1 - np.argmax(above_thresh[:, ::-1], axis=-1)
+            if not do_interp: return last_over
+            after = np.minimum(last_over+1, n_samples-1)
+            val = interp_two_point(perc, wf_norm[rows, after], wf_norm[rows, last_over], last_over+1, last_over)
+            return np.where(last_over < n_samples-1, val, last_over)
 
     if not getattr(percentage, '__iter__', False):
-        return get_tp(percentage)
+        tp = get_tp(percentage)
+        return tp[0] if waveform.ndim == 1 else tp
     else:
-        vfunc = np.vectorize(get_tp)
-        return vfunc(percentage)
+        tps = np.array([get_tp(perc) for perc in percentage])
+        return tps[:,0] if waveform.ndim == 1 else tps
 
 
 #Calculate maximum of trapezoid -- no pride here
+@batch_aware
 def trap_max(waveform, method = "max", pickoff_sample = 0):
-    if method == "max": return np.amax(waveform)
-    elif method == "fixed_time": return waveform[pickoff_sample]
+    waveform = np.asarray(waveform)
+    if method == "max": return np.amax(waveform, axis=-1)
+    elif method == "fixed_time":
+        if waveform.ndim == 1: return waveform[pickoff_sample]
+        if np.ndim(pickoff_sample) == 0: return waveform[:, pickoff_sample]
+        return np.take_along_axis(waveform, np.asarray(pickoff_sample)[:, np.newaxis], axis=-1)[:,0]
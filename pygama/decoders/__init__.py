@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from .dataloading import get_decoders
+from .dataloading import get_decoder_class
+from .dataloading import register_decoder
 from .dataloading import get_next_event
 # from .dataloading import DataLoader
+from .buffers import ColumnBuffer
+from .buffers import RaggedArray
 
 from .digitizers import get_digitizers
 from .digitizers import Gretina4MDecoder
@@ -13,7 +17,11 @@ from .pollers import ISegHVDecoder
 
 __all__ = [
 "get_decoders",
+"get_decoder_class",
+"register_decoder",
 "get_next_event",
+"ColumnBuffer",
+"RaggedArray",
 "get_digitizers",
 # "DataLoader",
 #digitizers
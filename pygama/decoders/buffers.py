@@ -0,0 +1,266 @@
+import numpy as np
+import pandas as pd
+
+__all__ = ["ColumnBuffer", "RaggedArray"]
+
+class RaggedArray():
+    '''
+    A column of variable-length rows (eg, waveforms of different lengths), stored as one flat
+    sample buffer plus the offset where each row ends -- the same layout the rows get on disk.
+        flat: 1-D array of all the samples, rows back-to-back
+        ends: end offset (into flat) of each row
+    Indexing with an int gives a view of that row, and with a slice gives a RaggedArray that shares
+    the samples.  Rows can be appended: the flat buffer doubles in size whenever it fills up.
+    '''
+    def __init__(self, flat=None, ends=None, dtype=None):
+        if flat is None:
+            flat = np.zeros(0, dtype=dtype if dtype is not None else np.float64)
+        self._flat = np.asarray(flat)
+        self.ends = np.zeros(0, dtype=np.int64) if ends is None else np.asarray(ends, dtype=np.int64)
+        self._n_ends = len(self.ends)
+
+    @classmethod
+    def from_rows(cls, rows, dtype=None):
+        '''
+        Builds a RaggedArray from a 2-D array or a sequence of 1-D arrays
+        '''
+        if dtype is None:
+            dtype = rows.dtype if isinstance(rows, (np.ndarray, RaggedArray)) else (np.asarray(rows[0]).dtype if len(rows) > 0 else None)
+        ragged = cls(dtype=dtype)
+        ragged.extend(rows)
+        return ragged
+
+    @classmethod
+    def concatenate(cls, raggeds):
+        flat = np.concatenate([r.flat for r in raggeds])
+        ends = np.concatenate([np.zeros(0, dtype=np.int64)] + [r.ends[:len(r)] for r in raggeds])
+        shifts = np.repeat(np.cumsum([0] + [len(r.flat) for r in raggeds[:-1]]), [len(r) for r in raggeds])
+        return cls(flat, ends + shifts)
+
+    @property
+    def flat(self):
+        #the filled part of the sample buffer
+        return self._flat[:self.ends[self._n_ends-1] if self._n_ends > 0 else 0]
+
+    @property
+    def starts(self):
+        ends = self.ends[:self._n_ends]
+        return np.concatenate(([0], ends[:-1])) if len(ends) > 0 else ends
+
+    @property
+    def lengths(self):
+        return np.diff(self.ends[:self._n_ends], prepend=0)
+
+    @property
+    def dtype(self):
+        return self._flat.dtype
+
+    @property
+    def nbytes(self):
+        return self.flat.nbytes + self._n_ends*self.ends.itemsize
+
+    def __len__(self):
+        return self._n_ends
+
+    def __iter__(self):
+        flat = self._flat
+        start = 0
+        for end in self.ends[:self._n_ends].tolist():
+            yield flat[start:end]
+            start = end
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            if stop <= start:
+                return RaggedArray(dtype=self.dtype)
+            first = self.ends[start-1] if start > 0 else 0
+            return RaggedArray(self._flat[first:self.ends[stop-1]], self.ends[start:stop] - first)
+
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("RaggedArray index {} out of range for {} rows".format(i, len(self)))
+        return self._flat[(self.ends[i-1] if i > 0 else 0):self.ends[i]]
+
+    def take(self, indices):
+        '''
+        Returns a new RaggedArray of the given rows (a copy), gathered without a python loop
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        ends = np.cumsum(lengths)
+        shift = np.repeat(self.starts[indices] - (ends - lengths), lengths)
+        return RaggedArray(self._flat[np.arange(ends[-1] if len(ends) > 0 else 0) + shift], ends)
+
+    def append(self, row):
+        self.extend([row])
+
+    def extend(self, rows):
+        '''
+        Adds rows: a 2-D array, a RaggedArray or a sequence of 1-D arrays
+        '''
+        if isinstance(rows, RaggedArray):
+            flat, lengths = rows.flat, rows.lengths
+        elif isinstance(rows, np.ndarray) and rows.ndim == 2:
+            flat, lengths = rows.reshape(-1), np.full(len(rows), rows.shape[1], dtype=np.int64)
+        else:
+            rows = [np.ravel(row) for row in rows]
+            if len(rows) == 0: return
+            flat, lengths = np.concatenate(rows), np.array([len(row) for row in rows], dtype=np.int64)
+
+        n_samples = self.ends[self._n_ends-1] if self._n_ends > 0 else 0
+        self._flat = self._grow(self._flat, n_samples, n_samples + len(flat))
+        self.ends = self._grow(self.ends, self._n_ends, self._n_ends + len(lengths))
+
+        self._flat[n_samples:n_samples+len(flat)] = flat
+        self.ends[self._n_ends:self._n_ends+len(lengths)] = n_samples + np.cumsum(lengths)
+        self._n_ends += len(lengths)
+
+    def _grow(self, array, n_used, n_needed):
+        if n_needed <= len(array): return array
+        grown = np.empty(max(2*len(array), n_needed, 16), dtype=array.dtype)
+        grown[:n_used] = array[:n_used]
+        return grown
+
+    def clear(self):
+        self._n_ends = 0
+
+    def truncate(self, n_rows):
+        #drops all but the first n_rows
+        self._n_ends = min(self._n_ends, n_rows)
+
+    def iter_groups(self):
+        '''
+        Yields (indices, block) for each row length, where block is an (n_rows, length) 2-D array
+        of the rows of that length, so they can be processed together.  If every row has the same
+        length, block is a view of the samples.
+        '''
+        lengths = self.lengths
+        if len(lengths) == 0: return
+        if np.all(lengths == lengths[0]):
+            yield np.arange(len(self)), self.flat.reshape(len(self), int(lengths[0]))
+            return
+
+        starts = self.starts
+        for length in np.unique(lengths):
+            indices = np.flatnonzero(lengths == length)
+            yield indices, self._flat[starts[indices][:,np.newaxis] + np.arange(length)]
+
+class ColumnBuffer():
+    '''
+    Growable, typed column storage for decoded values: one preallocated numpy array per field,
+    doubled in size whenever it fills up.  Fields are given as a dict of
+        name: dtype            for one value per event
+        name: (dtype, width)   for a fixed-width row per event (eg, a waveform).  If width is None,
+                               it is set by the first row that gets written
+        name: (dtype, "ragged") for rows whose length changes from event to event (kept in a RaggedArray)
+    Reading a field gives a view of the filled part of its array, so handing the values to
+    pandas or the hdf5 writer doesn't copy them.  clear() keeps the memory around for reuse.
+    '''
+    def __init__(self, fields, capacity=1024):
+        self.fields = {}
+        for name, spec in fields.items():
+            dtype, width = spec if isinstance(spec, tuple) else (spec, 0)
+            self.fields[name] = (np.dtype(dtype), width)
+
+        self.capacity = capacity
+        self.n_rows = 0
+        self.arrays = {name: RaggedArray(dtype=dtype) if width == "ragged" else None for name, (dtype, width) in self.fields.items()}
+
+    def __len__(self):
+        return self.n_rows
+
+    def keys(self):
+        return self.fields.keys()
+
+    def __getitem__(self, name):
+        dtype, width = self.fields[name]
+        if width == "ragged":
+            return self.arrays[name]
+        if self.arrays[name] is None:
+            return np.zeros((0,) if width == 0 else (0, width or 0), dtype=dtype)
+        return self.arrays[name][:self.n_rows]
+
+    @property
+    def nbytes(self):
+        return sum(self[name].nbytes for name in self.fields)
+
+    def reserve(self, n_new):
+        '''
+        Makes sure there is room for n_new more rows
+        '''
+        if self.n_rows + n_new <= self.capacity: return
+
+        self.capacity = max(2*self.capacity, self.n_rows + n_new)
+        for name, array in self.arrays.items():
+            if array is None or isinstance(array, RaggedArray): continue
+            grown = np.empty((self.capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.n_rows] = array[:self.n_rows]
+            self.arrays[name] = grown
+
+    def get_array(self, name, width):
+        '''
+        Returns the full allocated array for a field, allocating it (with rows of the given width) if needed
+        '''
+        dtype, field_width = self.fields[name]
+        if field_width != 0 and width != field_width:
+            if field_width is not None:
+                raise ValueError("ColumnBuffer field {} holds rows of width {}, got one of width {}".format(name, field_width, width))
+            self.fields[name] = (dtype, width)
+
+        if self.arrays[name] is None:
+            self.arrays[name] = np.empty((self.capacity,) if width == 0 else (self.capacity, width), dtype=dtype)
+        return self.arrays[name]
+
+    def append(self, row):
+        '''
+        Adds one row.  row is a dict with a value for each field
+        '''
+        self.reserve(1)
+        for name in self.fields:
+            value = row[name]
+            if self.fields[name][1] == "ragged":
+                self.arrays[name].append(value)
+                continue
+            self.get_array(name, 0 if self.fields[name][1] == 0 else len(value))[self.n_rows] = value
+        self.n_rows += 1
+
+    def extend(self, columns):
+        '''
+        Adds a block of rows.  columns is a dict with an array (2-D for row fields) for each field
+        '''
+        n_new = len(columns[next(iter(self.fields))])
+        self.reserve(n_new)
+        for name in self.fields:
+            if self.fields[name][1] == "ragged":
+                self.arrays[name].extend(columns[name])
+                continue
+            values = np.asarray(columns[name])
+            self.get_array(name, 0 if self.fields[name][1] == 0 else values.shape[1])[self.n_rows:self.n_rows+n_new] = values
+        self.n_rows += n_new
+
+    def clear(self):
+        self.truncate(0)
+
+    def truncate(self, n_rows):
+        '''
+        Drops all but the first n_rows
+        '''
+        self.n_rows = min(self.n_rows, n_rows)
+        for array in self.arrays.values():
+            if isinstance(array, RaggedArray): array.truncate(n_rows)
+
+    def to_dict(self):
+        return {name: self[name] for name in self.fields}
+
+    def to_df(self):
+        '''
+        Returns a dataframe of the rows, with row fields as object columns of per-row arrays.
+        The dataframe shares memory with the buffer, so it is only good until the next clear()
+        '''
+        data = {}
+        for name, values in self.to_dict().items():
+            data[name] = list(values) if isinstance(values, RaggedArray) or values.ndim > 1 else values
+        return pd.DataFrame(data, copy=False)
@@ -1,12 +1,19 @@
 from abc import ABC, abstractmethod
 import numpy as np
 import pandas as pd
+import h5py
 import sys
 
 import matplotlib.pyplot as plt
-from ..processing._header_parser import get_object_info
+from ..processing._header_parser import get_object_info, get_decoder_for_id
+from .buffers import ColumnBuffer, RaggedArray
 
-__all__ = ["get_next_event", "get_decoders"]
+__all__ = ["get_next_event", "get_record_block", "get_decoders", "get_decoder_class", "register_decoder"]
+
+#ORCA decoder name -> DataLoader subclass.  Classes with a decoder_name register themselves when they're
+#defined; decoders from other packages can also be registered through the "pygama.decoders" entry point group
+_decoder_registry = {}
+DECODER_ENTRY_POINT_GROUP = "pygama.decoders"
 
 def get_next_event(f_in):
     """
@@ -27,7 +34,7 @@ def get_next_event(f_in):
     # NCRATES = 10
 
     try:
-        head = np.fromstring(f_in.read(4),dtype=np.uint32)     # event header is 8 bytes (2 longs)
+        head = np.frombuffer(f_in.read(4),dtype=np.uint32)     # event header is 8 bytes (2 longs)
     except Exception as e:
         print(e)
         raise Exception("Failed to read in the event orca header.")
@@ -61,30 +68,88 @@ def get_next_event(f_in):
     # return event_data, slot, crate, data_id
     return event_data, data_id
 
-def get_decoders(object_info):
+def get_record_block(raw_data, offsets, record_length):
     """
-        Looks through all the data takers that exist in this DataLoader class and see which ones exist.
-        TODO: this only works if the subclasses have been imported.  is that what we want?
-              also relies on 2-level abstraction, which is dicy
+    Returns the data (everything after the 4-byte orca record header) of several records of the
+    same length as one 2-D uint8 array, one record per row.
+        raw_data: flat uint8 array of the raw file (eg, a memory map)
+        offsets: byte offsets of the records
+        record_length: length of each record in bytes
+    If the records sit back-to-back in the file, this is a zero-copy view.
     """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_bytes = record_length - 4
 
-    decoders = []
+    if len(offsets) == 1 or np.all(np.diff(offsets) == record_length):
+        first = raw_data[offsets[0]+4 : offsets[0]+4 + len(offsets)*record_length]
+        return np.lib.stride_tricks.as_strided(first, shape=(len(offsets), n_bytes), strides=(record_length, 1), writeable=False)
+
+    block = np.empty((len(offsets), n_bytes), dtype=np.uint8)
+    for i, offset in enumerate(offsets.tolist()):
+        block[i] = raw_data[offset+4 : offset+record_length]
+    return block
+
+def register_decoder(decoder_class):
+    """
+        Adds a DataLoader subclass to the registry under its decoder_name (the ORCA decoder name).
+        Subclasses defining decoder_name are registered automatically, so this is only needed
+        to swap in a different class for a decoder name.
+    """
+    _decoder_registry[decoder_class.decoder_name] = decoder_class
+    return decoder_class
+
+def _load_entry_point_decoders():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    eps = entry_points()
+    return eps.select(group=DECODER_ENTRY_POINT_GROUP) if hasattr(eps, "select") else eps.get(DECODER_ENTRY_POINT_GROUP, [])
 
-    for sub in DataLoader.__subclasses__():
-        for subsub in sub.__subclasses__():
-            try:
-                a = subsub(object_info)
-                # n = a.name
-                # print("name: ",n)
-                decoders.append(a)
-            except Exception as e:
-                print(e)
-                pass
+def get_decoder_class(decoder_name):
+    """
+        Returns the DataLoader subclass for an ORCA decoder name (without building one), or None.
+        Entry points (named after the decoder they provide) are only loaded for names that
+        aren't registered yet.
+    """
+    if decoder_name not in _decoder_registry:
+        for ep in _load_entry_point_decoders():
+            if ep.name == decoder_name:
+                _decoder_registry[decoder_name] = ep.load()
+                break
+    return _decoder_registry.get(decoder_name)
+
+def get_decoders(object_info, decoder_names=None):
+    """
+        Builds a decoder (loaded with object_info) for each ORCA decoder name in decoder_names that has
+        a registered class.  If decoder_names is None, object_info has to be a header dict (or from
+        get_header_info), and a decoder is built for each decoder named in the header.
+    """
+    if decoder_names is None:
+        header_dict = object_info.get("header_dict", object_info)
+        decoder_names = set(get_decoder_for_id(header_dict).values())
+
+    decoders = []
+    for decoder_name in sorted(decoder_names):
+        decoder_class = get_decoder_class(decoder_name)
+        if decoder_class is None: continue
+        try:
+            decoders.append(decoder_class(object_info))
+        except Exception as e:
+            print("Warning: couldn't build a {} for {} (Exception: {})".format(decoder_class.__name__, decoder_name, e))
 
     return decoders
 
 
 class DataLoader(ABC):
+    decoder_name = None #ORCA decoder name
+    class_name = None #ORCA object class name (used to find the object info)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "decoder_name" in cls.__dict__ and cls.decoder_name is not None:
+            register_decoder(cls)
+
     def __init__(self, object_info=None):
         self.decoded_values = []
 
@@ -93,20 +158,41 @@ class DataLoader(ABC):
 
         self.hf5_type="fixed"
 
+        #storage of array columns (waveforms) in appendable files: see append_array_column
+        self.compression = "lzf"
+        self.delta_encode = False
+
     def load_object_info(self, object_info):
-        if isinstance(object_info, dict):
+        if isinstance(object_info, dict) and "object_info" in object_info:
+            #from get_header_info, which has already pulled out the object info for each card class
+            self.object_info = object_info["object_info"].get(self.class_name)
+            if self.object_info is None:
+                print("Warning: no object info parsed for {}".format(self.class_name))
+        elif isinstance(object_info, dict):
             self.object_info = get_object_info(object_info, self.class_name)
         elif isinstance(object_info, pd.core.frame.DataFrame):
             self.object_info = object_info
         elif isinstance(object_info, str):
             self.object_info = pd.read_hdf(object_info, self.class_name)
         else:
-            raise TypeError("DataLoader object_info must be a dict of header values, or a string hdf5 filename.  You passed a {}".format( type(object_info)  ))
+            raise TypeError("DataLoader object_info must be a dict of header values (or from get_header_info), or a string hdf5 filename.  You passed a {}".format( type(object_info)  ))
 
     @abstractmethod
     def decode_event(self,event_data_bytes, event_number, header_dict):
         pass
 
+    def decode_records(self, raw_data, records, event_numbers, header_dict):
+        '''
+        Decodes a group of records for this decoder
+            raw_data: flat uint8 array of the raw file
+            records: the rows of the record index to decode (all with this decoder's data id)
+            event_numbers: event number of each record
+        Default is to go one event at a time; decoders with fixed-format records override this
+        to decode whole blocks at once.
+        '''
+        for offset, length, event_number in zip(records["offset"].tolist(), records["length"].tolist(), event_numbers.tolist()):
+            self.decode_event(raw_data[offset+4 : offset+length], event_number, header_dict)
+
     # @abstractmethod
     # def decode_header(self):
     #     pass
@@ -115,13 +201,240 @@ class DataLoader(ABC):
         '''
         allows us to overload for more complicated use cases
         '''
+        if isinstance(self.decoded_values, ColumnBuffer):
+            return self.decoded_values.to_df()
         return pd.DataFrame.from_dict(self.decoded_values)
 
-    def to_file(self, file_name):
-        df_data = self.create_df()
-        df_data.to_hdf(file_name, key=self.decoder_name, mode='a', format=self.hf5_type, data_columns=['channel', 'energy'])
+    def get_n_buffered(self):
+        '''
+        Returns the number of rows decoded but not written out yet
+        '''
+        if isinstance(self.decoded_values, dict):
+            return len(next(iter(self.decoded_values.values()), []))
+        return len(self.decoded_values)
+
+    def discard_buffered(self, n_rows):
+        '''
+        Throws out the buffered rows past the first n_rows (eg, the rows from a batch that failed partway through)
+        '''
+        if isinstance(self.decoded_values, ColumnBuffer):
+            self.decoded_values.truncate(n_rows)
+        elif isinstance(self.decoded_values, dict):
+            for values in self.decoded_values.values():
+                del values[n_rows:]
+        else:
+            del self.decoded_values[n_rows:]
+
+    def clear_decoded_values(self):
+        '''
+        Empties decoded_values (eg, once they have been written to file)
+        '''
+        if isinstance(self.decoded_values, ColumnBuffer):
+            self.decoded_values.clear()
+        elif isinstance(self.decoded_values, dict):
+            for values in self.decoded_values.values():
+                del values[:]
+        else:
+            del self.decoded_values[:]
+
+    def flush(self, file_name):
+        '''
+        Appends the events decoded so far to file_name, then forgets them
+        '''
+        if isinstance(self.decoded_values, ColumnBuffer):
+            if len(self.decoded_values) > 0:
+                self.to_file(file_name, append=True)
+        else:
+            df_data = self.create_df()
+            if len(df_data) > 0:
+                self.to_file(file_name, df_data, append=True)
+        self.clear_decoded_values()
+
+    def to_file(self, file_name, df_data=None, append=False):
+        '''
+        writes the decoded values (or df_data, if given) to file_name
+            append: write to an appendable table instead, so a file can be written a piece at a time.
+                    Array-valued columns (waveforms etc) can't go in a table: they are appended to
+                    datasets in the group <decoder_name>_arrays.  Use read_file to get it all back.
+                    df_data can also be a dict of columns (eg, from read_columns)
+        '''
+        if append:
+            if df_data is None and isinstance(self.decoded_values, ColumnBuffer):
+                columns = self.decoded_values.to_dict()
+            elif isinstance(df_data, dict):
+                columns = df_data
+            else:
+                if df_data is None: df_data = self.create_df()
+                columns = {name: df_data[name].values for name in df_data.columns}
+
+            if self.append_columns(file_name, columns): return
+        else:
+            if df_data is None: df_data = self.create_df()
+            df_data.to_hdf(file_name, key=self.decoder_name, mode='a', format=self.hf5_type, data_columns=['channel', 'energy'])
 
-        if self.object_info is not None:
+        if getattr(self, "object_info", None) is not None:
             if self.class_name == self.decoder_name:
                 raise ValueError("Class {} has the same ORCA decoder and class names: {}.  Can't write dataframe to file.".format(self.__name__, self.class_name))
             self.object_info.to_hdf(file_name, key=self.class_name, mode='a')
+
+    def append_columns(self, file_name, columns):
+        '''
+        Appends a dict of columns to the appendable layout in file_name (see to_file)
+        Returns whether the object info is already in the file
+        '''
+        array_columns = [name for name, values in columns.items()
+                         if isinstance(values, RaggedArray) or values.ndim > 1
+                         or (values.dtype == object and len(values) > 0 and isinstance(values[0], np.ndarray))]
+
+        df_table = pd.DataFrame({name: values for name, values in columns.items() if name not in array_columns}, copy=False)
+        string_columns = [name for name in df_table.columns if df_table[name].dtype == object]
+        df_table.to_hdf(file_name, key=self.decoder_name, mode='a', format="table", append=True,
+                        data_columns=[name for name in ['channel', 'energy'] if name in df_table.columns],
+                        min_itemsize={name:64 for name in string_columns})
+
+        with h5py.File(file_name, "a") as f:
+            for name in array_columns:
+                self.append_array_column(f, name, columns[name])
+            return self.class_name in f
+
+    def append_array_column(self, f, name, values):
+        '''
+        Appends a column of arrays (a 2-D array, a RaggedArray or a sequence of arrays) to the open h5py file f,
+        in the dataset <decoder_name>_arrays/<name>.
+        A column that starts out as a 2-D array (eg, fixed-length waveforms) is stored as a chunked 2-D
+        dataset, one row per event.  Anything else is stored flat, with the rows back-to-back, and
+        <name>_offsets holds where each row ends.
+        Both are compressed with self.compression (after a byte shuffle).  If self.delta_encode is set,
+        2-D integer columns are stored as sample-to-sample differences, which compress much better for
+        smooth waveforms (read_columns undoes this).
+        '''
+        path = "{}_arrays/{}".format(self.decoder_name, name)
+        is_2d = isinstance(values, np.ndarray) and values.ndim == 2 and values.shape[1] > 0
+
+        if path not in f and is_2d:
+            dset = f.create_dataset(path, shape=(0, values.shape[1]), maxshape=(None, values.shape[1]), dtype=values.dtype,
+                                    chunks=(max(1, (1<<18) // (values.shape[1]*values.dtype.itemsize)), values.shape[1]),
+                                    compression=self.compression, shuffle=self.compression is not None)
+            dset.attrs["delta_encoded"] = bool(self.delta_encode and values.dtype.kind in "iu")
+
+        if path in f and f[path].ndim == 2:
+            dset = f[path]
+            if not is_2d:
+                values = np.array([np.ravel(value) for value in values], dtype=dset.dtype)
+            if values.ndim != 2 or values.shape[1] != dset.shape[1]:
+                raise ValueError("{} column {} is stored with rows of length {}, and can't take rows of other lengths".format(self.decoder_name, name, dset.shape[1]))
+            if dset.attrs["delta_encoded"]:
+                values = np.diff(values, axis=1, prepend=np.zeros((len(values), 1), dtype=values.dtype)).astype(dset.dtype)
+
+            n_rows = dset.shape[0]
+            dset.resize((n_rows + len(values), dset.shape[1]))
+            dset[n_rows:] = values
+            return
+
+        if isinstance(values, RaggedArray):
+            flat, lengths = values.flat, values.lengths
+        elif is_2d:
+            flat = values.reshape(-1)
+            lengths = np.full(len(values), values.shape[1], dtype=np.int64)
+        else:
+            flat = np.concatenate([np.ravel(value) for value in values])
+            lengths = np.array([np.size(value) for value in values], dtype=np.int64)
+
+        if path not in f:
+            f.create_dataset(path, shape=(0,), maxshape=(None,), chunks=(max(1, (1<<18) // flat.dtype.itemsize),), dtype=flat.dtype,
+                             compression=self.compression, shuffle=self.compression is not None)
+            f.create_dataset(path+"_offsets", shape=(0,), maxshape=(None,), chunks=True, dtype=np.int64)
+        dset, offsets = f[path], f[path+"_offsets"]
+
+        n_rows, n_samples = offsets.shape[0], dset.shape[0]
+        offsets.resize((n_rows + len(lengths),))
+        offsets[n_rows:] = n_samples + np.cumsum(lengths)
+        dset.resize((n_samples + len(flat),))
+        dset[n_samples:] = flat
+
+    def get_n_rows(self, file_name):
+        '''
+        Returns the number of rows of this decoder's data in file_name (written by to_file, appendable or not)
+        '''
+        with pd.HDFStore(file_name, "r") as store:
+            if self.decoder_name not in store: return 0
+            storer = store.get_storer(self.decoder_name)
+            return storer.nrows if storer.is_table else storer.shape[0]
+
+    def truncate_file(self, file_name, n_rows):
+        '''
+        Throws out everything past the first n_rows of this decoder's data in an appendable file (see to_file)
+        '''
+        with pd.HDFStore(file_name, "a") as store:
+            if self.decoder_name in store:
+                n_table_rows = store.get_storer(self.decoder_name).nrows
+                if n_rows == 0:
+                    store.remove(self.decoder_name)
+                elif n_table_rows > n_rows:
+                    store.remove(self.decoder_name, start=n_rows, stop=n_table_rows)
+
+        with h5py.File(file_name, "a") as f:
+            group = "{}_arrays".format(self.decoder_name)
+            if group not in f: return
+            if n_rows == 0:
+                del f[group]
+                return
+
+            for name in list(f[group].keys()):
+                if name.endswith("_offsets"): continue
+                dset = f[group][name]
+                if dset.ndim == 2:
+                    dset.resize((min(n_rows, dset.shape[0]), dset.shape[1]))
+                    continue
+                offsets = f[group][name+"_offsets"]
+                if offsets.shape[0] > n_rows:
+                    dset.resize((offsets[n_rows-1],))
+                    offsets.resize((n_rows,))
+
+    def read_file(self, file_name, start=None, stop=None):
+        '''
+        Reads rows [start, stop) of this decoder's data (written by to_file, appendable or not) back into a dataframe
+        '''
+        df_data = pd.read_hdf(file_name, key=self.decoder_name, start=start, stop=stop)
+        df_data.index = np.arange(len(df_data)) + (0 if start is None else start)
+
+        for name, values in self.read_array_columns(file_name, start, stop).items():
+            df_data[name] = list(values)
+        return df_data
+
+    def read_columns(self, file_name, start=None, stop=None):
+        '''
+        Like read_file, but returns a dict of numpy columns: fixed-length array columns come back
+        as 2-D arrays, variable-length ones as RaggedArrays
+        '''
+        df_data = pd.read_hdf(file_name, key=self.decoder_name, start=start, stop=stop)
+        columns = {name: df_data[name].values for name in df_data.columns}
+        columns.update(self.read_array_columns(file_name, start, stop))
+        return columns
+
+    def read_array_columns(self, file_name, start=None, stop=None):
+        '''
+        Reads rows [start, stop) of the array columns written by append_array_column.
+        Only the chunks holding those rows are read.
+        '''
+        columns = {}
+        with h5py.File(file_name, "r") as f:
+            group = "{}_arrays".format(self.decoder_name)
+            if group not in f: return columns
+
+            for name in f[group].keys():
+                if name.endswith("_offsets"): continue
+                dset = f[group][name]
+
+                if dset.ndim == 2:
+                    values = dset[start:stop]
+                    if dset.attrs.get("delta_encoded", False):
+                        values = np.cumsum(values, axis=1, dtype=values.dtype)
+                    columns[name] = values
+                    continue
+
+                ends = f[group][name+"_offsets"][start:stop]
+                first = 0 if (start is None or start == 0 or len(ends) == 0) else f[group][name+"_offsets"][start-1]
+                flat = dset[first:ends[-1]] if len(ends) > 0 else np.zeros(0, dtype=dset.dtype)
+                columns[name] = RaggedArray(flat, ends - first)
+        return columns
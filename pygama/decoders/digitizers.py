@@ -5,26 +5,80 @@ from scipy import signal
 import itertools
 import array
 
-from .dataloading import DataLoader
+from .dataloading import DataLoader, get_record_block, get_decoder_class, _decoder_registry
+from .buffers import ColumnBuffer, RaggedArray
 from ..waveform import Waveform, MultisampledWaveform
 
 __all__ = ['Gretina4MDecoder', 'SIS3302Decoder']
 
-def get_digitizers():
-    return [sub() for sub in Digitizer.__subclasses__()]
+def get_digitizers(decoder_names=None):
+    """
+    Builds a decoder for each registered digitizer, or just for the digitizers among decoder_names (ORCA decoder names)
+    """
+    if decoder_names is None:
+        decoder_names = [name for name, decoder_class in _decoder_registry.items() if issubclass(decoder_class, Digitizer)]
+
+    digitizers = []
+    for decoder_name in decoder_names:
+        decoder_class = get_decoder_class(decoder_name)
+        if decoder_class is not None and issubclass(decoder_class, Digitizer):
+            digitizers.append(decoder_class())
+    return digitizers
 
 class Digitizer(DataLoader):
+    #attributes that decide what parse_event_data/parse_event_block make of the decoded waveforms
+    parse_settings = ["split_waveform", "sample_period"]
+
     def __init__(self, *args, **kwargs):
+        #list of channels to decode (crate_card_chan values).  None decodes everything
+        self.chan_list = kwargs.pop("chan_list", None)
+
         super().__init__(*args, **kwargs)
         self.split_waveform = False
 
-        self.chan_list = None #list of channels to decode
-
         if self.split_waveform:
             self.hf5_type="table"
         else:
             self.hf5_type="fixed"
 
+    @property
+    def chan_list(self):
+        return self._chan_list
+
+    @chan_list.setter
+    def chan_list(self, chan_list):
+        #keep a lookup table indexed by crate_card_chan (4 bits crate, 5 bits card, up to 8 bits channel)
+        #so channel selection is one array lookup instead of a list search
+        self._chan_list = chan_list
+        if chan_list is None:
+            self.channel_mask = None
+        else:
+            self.channel_mask = np.zeros(1<<14, dtype=bool)
+            self.channel_mask[np.asarray(chan_list, dtype=np.int64)] = True
+
+    def get_record_channels(self, raw_data, records):
+        """
+        Returns the crate_card_chan of each record, read from the record headers alone
+            raw_data: flat uint8 array of the raw file
+            records: rows of the record index (all with this decoder's data id)
+        """
+        raise NotImplementedError("{} can't read channels from record headers".format(self.__class__.__name__))
+
+    def select_records(self, raw_data, records):
+        """
+        Returns a bool mask of the records from channels in chan_list (or None if there's no chan_list),
+        so unwanted records can be dropped before their payload is ever read
+        """
+        if self.channel_mask is None: return None
+        return self.channel_mask[self.get_record_channels(raw_data, records)]
+
+    def get_parse_settings(self):
+        """
+        Returns a dict of the settings (see parse_settings) the waveforms get parsed with, eg to tell whether
+        cached Tier 2 results were made from the same waveforms
+        """
+        return {name: getattr(self, name, None) for name in self.parse_settings}
+
     def decode_event(self,event_data_bytes, event_number, header_dict):
         pass
 
@@ -36,6 +90,26 @@ class Digitizer(DataLoader):
 
         return Waveform(wf_data.astype('float_'), self.sample_period)
 
+    def parse_event_block(self, event_df):
+        """
+        Block version of parse_event_data, for batched processing.  Returns the waveforms to process for
+        every event of event_df (a RaggedArray, since they can differ in length) and a dict of the per-event
+        parameters that come with them (fs_start/fs_end for multisampled waveforms).
+        This goes through parse_event_data event by event; decoders whose waveforms need no per-event
+        treatment override it with something faster.
+        """
+        waveforms = RaggedArray(dtype=np.float64)
+        full_sample_ranges = []
+        for index, event_data in event_df.iterrows():
+            waveform = self.parse_event_data(event_data)
+            waveforms.append(waveform.get_waveform())
+            if isinstance(waveform, MultisampledWaveform):
+                full_sample_ranges.append(waveform.full_sample_range)
+
+        if len(full_sample_ranges) == 0 or len(full_sample_ranges) != len(waveforms): return waveforms, {}
+        full_sample_ranges = np.array(full_sample_ranges)
+        return waveforms, {"fs_start": full_sample_ranges[:,0], "fs_end": full_sample_ranges[:,1]}
+
     def reconstruct_waveform(self, event_data_row):
         waveform = []
         for i in itertools.count(0, 1):
@@ -46,15 +120,25 @@ class Digitizer(DataLoader):
                 break
         return np.array(waveform)
 
+    def format_batch(self, data):
+        """
+        Appends the columns returned by a decode_batch to decoded_values
+        """
+        if isinstance(self.decoded_values, ColumnBuffer):
+            self.decoded_values.extend(data)
+        else:
+            for name, values in data.items():
+                self.decoded_values[name].extend(values)
+
     def create_df(self):
         if self.split_waveform:
-            waveform_arr = self.decoded_values.pop("waveform")
-            waveform_arr = np.array(waveform_arr, dtype="int16")
+            data = {name: self.decoded_values[name] for name in self.decoded_values.keys() if name != "waveform"}
+            waveform_arr = np.array(self.decoded_values["waveform"], dtype="int16")
 
             for i in range(waveform_arr.shape[1]):
-                self.decoded_values["waveform_{}".format(i)] = waveform_arr[:,i]
+                data["waveform_{}".format(i)] = waveform_arr[:,i]
 
-            df = pd.DataFrame.from_dict(self.decoded_values)
+            df = pd.DataFrame.from_dict(data)
             # for name in df.columns:
             #     if name.startswith("waveform_"): dtype = "int16"
             #     else: dtype = self.decoded_values[name].typecode
@@ -73,13 +157,11 @@ class Gretina4MDecoder(Digitizer):
     min_signal_thresh: multiplier on noise ampliude required to process a signal: helps avoid processing a ton of noise
     chanList: list of channels to process
     '''
-    def __init__(self, *args, **kwargs):
-        self.decoder_name = 'ORGretina4MWaveformDecoder' #ORGretina4M'
-        self.class_name = 'ORGretina4MModel'
-
-        try: self.chan_list = kwargs.pop("chan_list")
-        except KeyError: self.chan_list = None
+    decoder_name = 'ORGretina4MWaveformDecoder' #ORGretina4M'
+    class_name = 'ORGretina4MModel'
+    parse_settings = Digitizer.parse_settings + ["correct_presum", "wf_length"]
 
+    def __init__(self, *args, **kwargs):
         try: self.load_object_info(kwargs.pop("object_info"))
         except KeyError: pass
 
@@ -98,22 +180,34 @@ class Gretina4MDecoder(Digitizer):
         self.sample_period = 10#ns
 
         self.gretina_event_no=0
-        self.decoded_values = {
-            "event_number":[],#array.array('I'),
-            "energy": [],#array.array('I'),
-            "timestamp": [],#array.array('L'),
-            "channel": [],#array.array('I'),
-            "board_id":[],#array.array('I'),
-            "waveform":[]#np.empty((100000,2032), dtype=np.int16)
-        }
+        self.decoded_values = ColumnBuffer({
+            "event_number": np.int64,
+            "energy": np.int64,
+            "timestamp": np.int64,
+            "channel": np.int64,
+            "board_id": np.int64,
+            "waveform": (np.int16, None) #width set by the first record
+        })
 
     def load_object_info(self, object_info):
         super().load_object_info(object_info)
         self.active_channels = self.find_active_channels()
 
+        #lookup table indexed by crate_card_chan (4 bits crate, 5 bits card, 4 bits channel)
+        self.active_channel_mask = np.zeros(1<<13, dtype=bool)
+        self.active_channel_mask[self.active_channels] = True
+
     def crate_card_chan(self, crate, card, channel):
         return (crate << 9) + (card << 4) + (channel)
 
+    def get_record_channels(self, raw_data, records):
+        #crate/card are in uint16 word 1 of the record data and the channel in word 4
+        offsets = records["offset"].astype(np.int64)
+        head = raw_data[offsets[:,np.newaxis] + np.arange(4, 14)].view(np.uint16)
+        card = head[:,1] & 0x1F
+        crate = (head[:,1] >> 5) & 0xF
+        return self.crate_card_chan(crate.astype(np.int64), card, head[:,4] & 0xf)
+
     def find_active_channels(self):
         active_channels = []
         for index, row in self.object_info.iterrows():
@@ -128,7 +222,7 @@ class Gretina4MDecoder(Digitizer):
             Parse the header for an individual event
         """
 
-        event_data = np.fromstring(event_data_bytes,dtype=np.uint16)
+        event_data = np.frombuffer(event_data_bytes,dtype=np.uint16)
 
         # this is for a uint32
         # channel = event_data[1]&0xF
@@ -150,11 +244,11 @@ class Gretina4MDecoder(Digitizer):
 
         ccc = self.crate_card_chan(crate, card, channel)
 
-        if ccc not in self.active_channels:
+        if not self.active_channel_mask[ccc]:
             #TODO: should store this to garbage data frame or something
             return None
             # raise ValueError("{} found data from channel {}, which is not in active channel list.".format(self.__class__.__name__, ccc))
-        elif self.chan_list is not None and ccc not in self.chan_list:
+        elif self.channel_mask is not None and not self.channel_mask[ccc]:
             return None
 
         # if crate_card_chan not in board_id_map:
@@ -168,19 +262,61 @@ class Gretina4MDecoder(Digitizer):
 
         # return data_dict
 
-    def format_data(self,energy,timestamp,crate_card_chan,wf_arr, board_id, event_number):
+    def decode_records(self, raw_data, records, event_numbers, header_dict):
         """
-        Format the values that we get from this card into a pandas-friendly format.
+            Decodes the records in blocks: Gretina records have a fixed length, so each run of
+            same-length records is handed to decode_batch as one 2-D array
+        """
+        lengths = records["length"]
+        breaks = np.flatnonzero(np.diff(lengths)) + 1
+        for start, stop in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(records)]))):
+            block = get_record_block(raw_data, records["offset"][start:stop], int(lengths[start]))
+            data = self.decode_batch(block.view(np.uint16), event_numbers[start:stop])
+            self.format_batch(data)
+            self.gretina_event_no += len(data["event_number"])
+
+    def decode_batch(self, event_data, event_numbers):
         """
-        self.decoded_values["energy"].append(energy)
-        self.decoded_values["timestamp"].append(timestamp)
-        self.decoded_values["channel"].append(crate_card_chan)
-        self.decoded_values["board_id"].append(board_id)
-        self.decoded_values["event_number"].append(event_number)
+            Vectorized decode_event for a block of same-length records
+                event_data: (N, record length) uint16 array, one record (without the orca header word) per row
+                event_numbers: event number of each record
+            Returns a dict of columnar arrays (plus an (N, wf_len) int16 "waveform" matrix) for the
+            records from active (and selected) channels
+        """
+        card = event_data[:,1] & 0x1F
+        crate = (event_data[:,1] >> 5) & 0xF
+        channel = event_data[:,4] & 0xf
+        ccc = self.crate_card_chan(crate.astype(np.int64), card, channel)
+
+        keep = self.active_channel_mask[ccc]
+        if self.channel_mask is not None:
+            keep &= self.channel_mask[ccc]
 
-        self.decoded_values["waveform"].append(  wf_arr.astype("int16")  )
+        event_data = event_data[keep]
+        header = event_data[:, :self.event_header_length].astype(np.int64)
 
-        # self.decoded_values["waveform"][self.gretina_event_no,:] = wf_arr
+        data = {
+            "event_number": np.asarray(event_numbers, dtype=np.int64)[keep],
+            "energy": header[:,9] + ((header[:,10]&0x7FFF)<<16),
+            "timestamp": header[:,6] + (header[:,7]<<16) + (header[:,8]<<32),
+            "channel": ccc[keep],
+            "board_id": (header[:,4]&0xFFF0)>>4,
+            "waveform": event_data[:, self.event_header_length:].view(np.int16)
+        }
+        return data
+
+    def format_data(self,energy,timestamp,crate_card_chan,wf_arr, board_id, event_number):
+        """
+        Format the values that we get from this card into a pandas-friendly format.
+        """
+        self.decoded_values.append({
+            "energy": energy,
+            "timestamp": timestamp,
+            "channel": crate_card_chan,
+            "board_id": board_id,
+            "event_number": event_number,
+            "waveform": wf_arr.view(np.int16)
+        })
 
         self.gretina_event_no +=1
 
@@ -199,6 +335,26 @@ class Gretina4MDecoder(Digitizer):
 
         return
 
+    def get_presum_settings(self, event_chan):
+        '''
+        Multisampling settings of a channel (a crate_card_chan, as saved in the channel column):
+        returns (multirate_sum, ratio, prere_cnt, postre_cnt, ft_cnt)
+        '''
+        crate = event_chan >> 9
+        card =  (event_chan & 0x1f0) >> 4
+        chan =  event_chan & 0xf
+
+        #Get the right digitizer information:
+        card_info = self.object_info.loc[(crate, card)]
+
+        multirate_sum = 10 if card_info["Mrpsrt"][chan] == 3 else 2 **(card_info["Mrpsrt"][chan]+1)
+        multirate_div = 2**card_info["Mrpsdv"][chan]
+        ratio = multirate_sum/multirate_div
+        # "channel_div": 2**card["Chpsdv"][channum],
+        # "channel_sum": 10 if card["Chpsrt"][channum] == 3 else 2 **(card["Chpsrt"][channum]+1),
+
+        return multirate_sum, ratio, card_info["Prerecnt"][chan], card_info["Postrecnt"][chan], card_info["FtCnt"][chan]
+
     def parse_event_data(self,event_data):
         '''
         event_data is a pandas df row from a decoded event
@@ -217,24 +373,7 @@ class Gretina4MDecoder(Digitizer):
             #TODO: I fix the presumming by looking for a spike in the current with a windowed convolution
             #This slows down the decoding by almost x2.  We should try to do something faster
 
-            #we save crate_card_chan (for historical reasons), so decode that
-            event_chan = int(event_data['channel'])
-            crate = event_chan >> 9
-            card =  (event_chan & 0x1f0) >> 4
-            chan =  event_chan & 0xf
-
-            #Get the right digitizer information:
-            card_info = self.object_info.loc[(crate, card)]
-
-            multirate_sum = 10 if card_info["Mrpsrt"][chan] == 3 else 2 **(card_info["Mrpsrt"][chan]+1)
-            multirate_div = 2**card_info["Mrpsdv"][chan]
-            ratio = multirate_sum/multirate_div
-            # "channel_div": 2**card["Chpsdv"][channum],
-            # "channel_sum": 10 if card["Chpsrt"][channum] == 3 else 2 **(card["Chpsrt"][channum]+1),
-
-            prere_cnt = card_info["Prerecnt"][chan]
-            postre_cnt = card_info["Postrecnt"][chan]
-            ft_cnt = card_info["FtCnt"][chan]
+            multirate_sum, ratio, prere_cnt, postre_cnt, ft_cnt = self.get_presum_settings(int(event_data['channel']))
             ms_start_offset = 0
 
             idx_ft_start_expected = len(wf_data) - ft_cnt -1
@@ -286,22 +425,103 @@ class Gretina4MDecoder(Digitizer):
 
             return MultisampledWaveform(time[-self.wf_length:], wf_data[-self.wf_length:], self.sample_period, [idx_bl_end, idx_ft_start])
 
+    def parse_event_block(self, event_df):
+        '''
+        Block version of parse_event_data.  Without presum correction the waveforms just need trimming.
+        With it, the presum jumps of the whole block are found at once (same filter and same search windows
+        as parse_event_data), and the full-sampled stretch of each waveform is returned, with fs_start/fs_end.
+        '''
+        if self.split_waveform:
+            return super().parse_event_block(event_df)
+        if len(event_df) == 0: return RaggedArray(dtype=np.float64), {}
+        if len(set(len(wf) for wf in event_df["waveform"].values)) > 1:
+            return super().parse_event_block(event_df)
+        wf_block = np.stack(event_df["waveform"].values).astype('float_')
+        if not self.correct_presum:
+            return wf_block[:, -self.wf_length:], {}
+
+        n_events, n_samples = wf_block.shape
+        channels = event_df["channel"].values.astype(np.int64)
+        unique_channels, channel_idx = np.unique(channels, return_inverse=True)
+        settings = np.array([self.get_presum_settings(int(chan)) for chan in unique_channels], dtype=np.float64)[channel_idx]
+        ratio = settings[:,1]
+        prere_cnt, postre_cnt, ft_cnt = settings[:,2].astype(np.int64), settings[:,3].astype(np.int64), settings[:,4].astype(np.int64)
+
+        idx_ft_start_expected = n_samples - ft_cnt -1
+        idx_bl_end_expected = n_samples - prere_cnt - postre_cnt - ft_cnt
+        if np.any(idx_bl_end_expected + 4 <= 0) or np.any(idx_ft_start_expected - 5 < 0):
+            #search windows that parse_event_data would wrap around
+            return super().parse_event_block(event_df)
+
+        #the convolution with the 10 sample step filter of parse_event_data (5 samples after minus the 5 before, on
+        #the edge-padded waveform), as differences of running sums.  The samples are integers, so these are exact
+        filter_len = 10
+        padded = np.concatenate((np.repeat(wf_block[:,:1], filter_len, axis=1), wf_block, np.repeat(wf_block[:,-1:], filter_len, axis=1)), axis=1)
+        running_sum = np.zeros((n_events, padded.shape[1]+1))
+        np.cumsum(padded, axis=1, out=running_sum[:,1:])
+        wf_diff = np.abs(2*running_sum[:,10:n_samples+10] - running_sum[:,15:n_samples+15] - running_sum[:,5:n_samples+5])
+
+        sample_idx = np.arange(n_samples)
+        idx_bl_end = np.argmax(np.where(sample_idx < (idx_bl_end_expected+4)[:,np.newaxis], wf_diff, -1), axis=-1)
+        idx_ft_start = np.argmax(np.where(sample_idx >= (idx_ft_start_expected-5)[:,np.newaxis], wf_diff, -1), axis=-1)
+
+        #baseline is probably very near zero, s.t. its hard to see the jump.  just assume it where its meant to be.
+        idx_bl_end = np.where((idx_bl_end < idx_bl_end_expected - 8) | (idx_bl_end > idx_bl_end_expected+2), idx_bl_end_expected, idx_bl_end)
+        idx_ft_start = np.where((idx_ft_start < idx_ft_start_expected - 2) | (idx_ft_start > idx_ft_start_expected), idx_ft_start_expected, idx_ft_start)
+
+        #parse_event_data keeps the last wf_length samples, then the full-sampled range [idx_bl_end, idx_ft_start) of those
+        trim = max(n_samples - self.wf_length, 0)
+        first = trim + np.minimum(idx_bl_end, n_samples - trim)
+        last = np.maximum(trim + np.minimum(idx_ft_start, n_samples - trim), first)
+
+        presummed = (sample_idx < idx_bl_end[:,np.newaxis]) | (sample_idx >= idx_ft_start[:,np.newaxis])
+        wf_block[presummed] /= np.broadcast_to(ratio[:,np.newaxis], wf_block.shape)[presummed]
+        in_range = (sample_idx >= first[:,np.newaxis]) & (sample_idx < last[:,np.newaxis])
+        waveforms = RaggedArray(wf_block[in_range], np.cumsum(last - first))
+
+        return waveforms, {"fs_start": idx_bl_end, "fs_end": idx_ft_start}
+
 class SIS3302Decoder(Digitizer):
-    def __init__(self, *args, **kwargs):
-        self.decoder_name = 'ORSIS3302DecoderForEnergy'
-        self.class_name = 'ORSIS3302Model' #what should this be?
+    decoder_name = 'ORSIS3302DecoderForEnergy'
+    class_name = 'ORSIS3302Model' #what should this be?
 
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.values = dict()
         self.event_header_length = 1
 
         self.sample_period = 10#ns
 
+        #waveform lengths can change from event to event, so those are kept ragged
+        self.decoded_values = ColumnBuffer({
+            "energy": np.uint32,
+            "energy_first": np.uint32,
+            "timestamp": np.int64,
+            "channel": np.int64,
+            "board_id": np.int64,
+            "waveform": (np.int16, "ragged"),
+            "energy_wf": (np.int16, "ragged"),
+            "event_number": np.int64
+        })
+
         return
 
     def get_name(self):
         return self.decoder_name
 
+    def parse_event_block(self, event_df):
+        #waveforms are used as they were decoded
+        return RaggedArray.from_rows(list(event_df["waveform"].values), dtype=np.float64), {}
+
+    def get_record_channels(self, raw_data, records):
+        #crate/card/channel are all in the first word of the record data
+        offsets = records["offset"].astype(np.int64)
+        head = raw_data[offsets[:,np.newaxis] + np.arange(4, 8)].view(np.uint32)[:,0]
+        channel = (head>>8) &0xFF
+        card = (head>>16)&0x1F
+        crate = (head>>21)&0xF
+        return (crate.astype(np.int64) << 9) + (card << 4) + (channel)
+
     def decode_event(self,event_data_bytes, event_number, header_dict, verbose=False):
         """
         The SIS3302 can produce a waveform from two sources:
@@ -363,117 +583,118 @@ class SIS3302Decoder(Digitizer):
 
         """
 
-        event_data_uint = np.fromstring(event_data_bytes,dtype=np.uint32)
-        event_data_uint16 = np.fromstring(event_data_bytes,dtype=np.uint16)
-
-        event_data = event_data_uint
-
-        # print(event_data[0])
-        buffer_wrap_mode    = (event_data[0]&0x1)
-        n_lost_records_msb  = ((event_data[0]>>25)&0x7F)
-        n_lost_records_lsb  = ((event_data[0]>>2 )&0x7F)
-        n_lost_records = (n_lost_records_msb<<7) + (n_lost_records_lsb)
-        channel             = ((event_data[0]>>8) &0xFF)
-        card                = ((event_data[0]>>16)&0x1F)
-        crate               = ((event_data[0]>>21)&0xF)
-
-        crate_card_chan = (crate << 9) + (card << 4) + (channel)
-
-        adc_raw_data_length     = event_data[1]     # number of long words long, not the number of points
-        energy_data_length      = event_data[2]
+        event_data = np.frombuffer(event_data_bytes,dtype=np.uint32)
 
-        event_header_id = (event_data[3]&0xFF)
-        timestamp = event_data[4] + ((event_data[3]>>16)&0xFFFF)
-
-        if(buffer_wrap_mode):
-            sisHeaderLength = 4
-
-            adc_raw_data_length = event_data[5]
-            adc_raw_data_start_index = event_data[6]
-
-            adc_raw_data_start_1    = 2*adc_raw_data_start_index
-            adc_raw_data_stop_1     = 2*adc_raw_data_buffer_stop
-
-            adc_raw_data_start_2    = 2*adc_raw_data_buffer_start
-            adc_raw_data_stop_2     = 2*adc_raw_data_start_1 - 2
-
-            wf_data_1 = np.zeros(adc_raw_data_stop_1 - adc_raw_data_start_1)
-            wf_data_2 = np.zeros(adc_raw_data_stop_2 - adc_raw_data_start_2)
-
-        else:
-            sisHeaderLength = 2
-
-        # all lengths here are in long words (32-bytes)
-        totalRecordLength = len(event_data_uint)    # entire thing we get handed here
-        orcaHeaderLength = 3                        # this is the crate/card/channel/bufferwrap
-        footerLength = 4                            # this is the 0xDEADBEEF
-        # expectedWFLength = totalRecordLength - orcaHeaderLength - sisHeaderLength - energy_data_length - footerLength
-
-        wf_data = np.zeros(adc_raw_data_length*2)
-        energy_data = np.zeros(energy_data_length*2)
-
-        # These values are in number of 16-bit short words
-        adc_raw_data_buffer_start = 2*(orcaHeaderLength+sisHeaderLength)                  # wfStart: waveform starting position in the uint16
-        adc_raw_data_buffer_stop = 2*(totalRecordLength - energy_data_length - footerLength)    # wfStop: waveform stopping position in uint16
-        energy_data_buffer_start = adc_raw_data_buffer_stop
-        energy_data_buffer_stop = orcaHeaderLength+sisHeaderLength+adc_raw_data_length+energy_data_length
-        footerStart = energy_data_buffer_stop                               # position of start of footer (after adc and energy buffers)
-
-
-        # Pull the values out of the footer as best we can
-        energy_max_value = event_data_uint[footerStart]
-        energy_first_value = event_data_uint[footerStart+1]
-        pileup_retrigger_counter_word = event_data_uint[footerStart+2]
-        lastword = event_data_uint[-1]
-
-        # basic check for data integrity:
-        if(lastword != 0xDEADBEEF):
-            print("ERROR: Last word of SIS3302 record was ", lastword, " instead of 0xDEADBEEF!!! This may indicate a serious issue!")
-            # for now, we'll just continue blindly, hoping that we can recover...
+        data = self.decode_batch(event_data[np.newaxis,:], [event_number])
+        self.format_batch(data)
+        data_dict = {name: values[0] for name, values in data.items()}
 
         if(verbose):
-            print(hex(lastword))
-
-            print("buffer wrap mode: ",buffer_wrap_mode)
-            print("number of lost records: ", n_lost_records)
-            print("channel: ", channel)
-            print("card: ",card)
-            print("crate", crate)
-            print("waveform length", adc_raw_data_length)
-            print("energy length", energy_data_length)
-            print("length of event data (longs)", len(event_data_uint))
-            print("timestamp: ", timestamp)
-            print("event header word: ",hex(event_header_id))
-            print("energy max val: ", energy_max_value)
-            print("energy first val: ", energy_first_value)
-            print("pileup/retrigger word: ", hex(pileup_retrigger_counter_word))
-
-        # If there is a waveform, store it
-        if(adc_raw_data_length>0):
-            if(buffer_wrap_mode):
-                wf_data_1 = event_data_uint16[adc_raw_data_start_1:adc_raw_data_stop_1]
-                wf_data_2 = event_data_uint16[adc_raw_data_start_2:adc_raw_data_stop_2]
-
-                wf_data = np.concatenate([wf_data_1,wf_data_2])
-
-            else:   # not buffer wrap mode
-                wf_data = event_data_uint16[adc_raw_data_buffer_start:adc_raw_data_buffer_stop]
-
-        # If there is an energy waveform, store it
-        if(energy_data_length > 0):
-            energy_data = event_data_uint16[energy_data_buffer_start:energy_data_buffer_stop]
-
-        data_dict = self.format_data(energy_max_value, energy_first_value, timestamp, crate_card_chan, event_header_id, wf_data,energy_data)
-
-        data_dict["event_number"] = event_number
-        self.decoded_values.append(data_dict)
+            print(hex(event_data[-1]))
+
+            print("buffer wrap mode: ",event_data[0]&0x1)
+            print("number of lost records: ", (((event_data[0]>>25)&0x7F)<<7) + ((event_data[0]>>2)&0x7F))
+            print("channel: ", (event_data[0]>>8)&0xFF)
+            print("card: ",(event_data[0]>>16)&0x1F)
+            print("crate", (event_data[0]>>21)&0xF)
+            print("waveform length", event_data[1])
+            print("energy length", event_data[2])
+            print("length of event data (longs)", len(event_data))
+            print("timestamp: ", data_dict["timestamp"])
+            print("event header word: ",hex(data_dict["board_id"]))
+            print("energy max val: ", data_dict["energy"])
+            print("energy first val: ", data_dict["energy_first"])
 
         return data_dict
 
-    def format_data(self,energy_max_value,energy_first_value,timestamp,crate_card_chan,event_header_id,wf_data,energy_data):
+    def decode_records(self, raw_data, records, event_numbers, header_dict):
         """
-        Format the values that we get from this card into a pandas-friendly format.
+            Decodes the records in groups that share a layout: all records with the same
+            (waveform length, energy length, buffer wrap mode, wrapped adc raw data length) go through decode_batch together,
+            then the results are put back in event order
         """
+        offsets = records["offset"].astype(np.int64)
+
+        #first six words after the orca header: crate/card/chan/wrap word, waveform length, energy length,
+        #timestamp words, and (in buffer wrap mode) the adc raw data length
+        heads = raw_data[offsets[:,np.newaxis] + np.arange(4, 28)].view(np.uint32)
+        buffer_wrap_mode = heads[:,0]&0x1
+        signatures = np.column_stack((records["length"], heads[:,1], heads[:,2], buffer_wrap_mode, heads[:,5]*buffer_wrap_mode))
+        _, group_ids = np.unique(signatures, axis=0, return_inverse=True)
+        group_ids = group_ids.ravel()
+
+        batches = []
+        for group in range(group_ids.max()+1):
+            in_group = np.flatnonzero(group_ids == group)
+            block = get_record_block(raw_data, offsets[in_group], int(records["length"][in_group[0]]))
+            batches.append(self.decode_batch(block.view(np.uint32), event_numbers[in_group]))
+
+        if len(batches) == 1:
+            self.format_batch(batches[0])
+            return
+
+        event_order = np.argsort(np.concatenate([b["event_number"] for b in batches]), kind="mergesort")
+        data = {}
+        for name in batches[0].keys():
+            if batches[0][name].ndim == 2:
+                #waveforms are different lengths across groups
+                data[name] = RaggedArray.concatenate([RaggedArray.from_rows(b[name]) for b in batches]).take(event_order)
+            else:
+                data[name] = np.concatenate([b[name] for b in batches])[event_order]
+        self.format_batch(data)
+
+    def decode_batch(self, event_data, event_numbers):
+        """
+            Vectorized decode_event for records that share a layout (see decode_records)
+                event_data: (N, record length) uint32 array, one record (without the orca header word) per row
+                event_numbers: event number of each record
+            Returns a dict of columnar arrays, with (N, n_samples) int16 matrices for "waveform" and "energy_wf"
+        """
+        buffer_wrap_mode = bool(event_data[0,0]&0x1)
+        channel = (event_data[:,0]>>8) &0xFF
+        card = (event_data[:,0]>>16)&0x1F
+        crate = (event_data[:,0]>>21)&0xF
+        crate_card_chan = (crate.astype(np.int64) << 9) + (card << 4) + (channel)
+
+        adc_raw_data_length = int(event_data[0,1]) # number of long words long, not the number of points
+        energy_data_length = int(event_data[0,2])
+
+        event_header_id = (event_data[:,3]&0xFF).astype(np.int64)
+        timestamp = event_data[:,4].astype(np.int64) + (((event_data[:,3]>>16)&0xFFFF).astype(np.int64)<<32)
+
+        # all positions here are in long words, counting from the crate/card/channel/bufferwrap word
+        orcaHeaderLength = 3
+        sisHeaderLength = 4 if buffer_wrap_mode else 2
+        adc_raw_data_buffer_start = orcaHeaderLength + sisHeaderLength
+        energy_data_buffer_start = adc_raw_data_buffer_start + adc_raw_data_length
+        footerStart = energy_data_buffer_start + energy_data_length
+
+        # the data buffers are packed 16-bit samples
+        event_data_uint16 = event_data.view(np.uint16)
+        wf_data = event_data_uint16[:, 2*adc_raw_data_buffer_start : 2*energy_data_buffer_start]
+        energy_data = event_data_uint16[:, 2*energy_data_buffer_start : 2*footerStart]
+
+        if buffer_wrap_mode:
+            # word 1 sets where the energy buffer starts, but only the first (word 5) longs of the
+            # waveform buffer were filled, circularly: rotate each row so it starts at its adc raw data start index
+            n_samples = 2*min(int(event_data[0,5]), adc_raw_data_length)
+            wf_data = wf_data[:, :n_samples]
+            if n_samples > 0:
+                start_index = 2*event_data[:,6].astype(np.int64)
+                wf_index = (np.arange(n_samples) + start_index[:,np.newaxis]) % n_samples
+                wf_data = np.take_along_axis(wf_data, wf_index, axis=1)
+
+        # Pull the values out of the footer
+        energy_max_value = event_data[:,footerStart]
+        energy_first_value = event_data[:,footerStart+1]
+        lastword = event_data[:,-1]
+
+        # basic check for data integrity:
+        bad_footer = lastword != 0xDEADBEEF
+        if np.any(bad_footer):
+            print("ERROR: {} of {} SIS3302 records did not end with 0xDEADBEEF (first bad word: {})!!! This may indicate a serious issue!".format(
+                np.count_nonzero(bad_footer), len(lastword), hex(lastword[bad_footer][0])))
+            # for now, we'll just continue blindly, hoping that we can recover...
 
         data = {
             "energy": energy_max_value,
@@ -481,7 +702,8 @@ class SIS3302Decoder(Digitizer):
             "timestamp": timestamp,
             "channel": crate_card_chan,
             "board_id":event_header_id,
-            "waveform": [np.array(wf_data, dtype=np.int16)],
-            "energy_wf": [np.array(energy_data, dtype=np.int16)]
+            "waveform": wf_data.astype(np.int16),
+            "energy_wf": energy_data.astype(np.int16),
+            "event_number": np.asarray(event_numbers, dtype=np.int64)
         }
         return data
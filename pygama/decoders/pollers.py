@@ -2,7 +2,8 @@ import numpy as np
 import pandas as pd
 import sys
 
-from .dataloading import DataLoader
+from .dataloading import DataLoader, get_record_block
+from .buffers import ColumnBuffer
 
 __all__ = ['MJDPreampDecoder', 'ISegHVDecoder']
 
@@ -13,17 +14,62 @@ class Poller(DataLoader):
     def decode_event(self,event_data_bytes, event_number, header_dict):
         pass
 
+    def decode_records(self, raw_data, records, event_numbers, header_dict):
+        """
+            Decodes the records in blocks: every record of a given length goes through decode_batch together,
+            then the rows are put back in event order
+        """
+        lengths, group_ids = np.unique(records["length"], return_inverse=True)
+        group_ids = group_ids.ravel()
+        batches = []
+        for group, length in enumerate(lengths):
+            in_group = np.flatnonzero(group_ids == group)
+            block = get_record_block(raw_data, records["offset"][in_group], int(length))
+            batches.append(self.decode_batch(block.view(np.uint32), event_numbers[in_group], header_dict))
+
+        if len(batches) == 1:
+            self.decoded_values.extend(batches[0])
+            return
+
+        #a record can make several rows (eg one per preamp channel): a stable sort keeps them in order
+        event_order = np.argsort(np.concatenate([b["event_number"] for b in batches]), kind="mergesort")
+        self.decoded_values.extend({name: np.concatenate([b[name] for b in batches])[event_order] for name in batches[0].keys()})
+
+    def decode_batch(self, event_data, event_numbers, header_dict):
+        """
+            Vectorized decode_event for a block of same-length records
+                event_data: (N, record length) uint32 array, one record (without the orca header word) per row
+            Returns a dict of columns to append to decoded_values
+        """
+        raise NotImplementedError("{} has no batch decoder".format(self.__class__.__name__))
+
 
 # Polled devices
 
 class MJDPreampDecoder(Poller):
-    def __init__(self, *args, **kwargs):
-        self.decoder_name = 'ORMJDPreAmpDecoderForAdc' #
-        self.class_name = 'MJDPreAmp'
+    decoder_name = 'ORMJDPreAmpDecoderForAdc' #
+    class_name = 'MJDPreAmp'
 
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.event_header_length = -1
 
+        #one row per preamp channel per record
+        self.decoded_values = ColumnBuffer({
+            "adc": np.float64,
+            "enabled": np.float64,
+            "timestamp": np.uint32,
+            "name": object,
+            "channel": np.int64,
+            "device_id": np.int64,
+            "event_number": np.int64
+        })
+
+        #preamp id -> detector names table, built once per header
+        self.preamp_header = None
+        self.preamp_ids = None
+        self.preamp_names = None
+
         return
 
     def decode_event(self, event_data_bytes, event_number, header_dict, verbose=False):
@@ -47,39 +93,66 @@ class MJDPreampDecoder(Poller):
 
         """
 
-        event_data_uint = np.fromstring(event_data_bytes,dtype=np.uint32)
-        event_data_float = np.fromstring(event_data_bytes,dtype=np.float32)
-
-        device_id = (event_data_uint[0]&0xFFF)
-        timestamp = event_data_uint[1]
-        enabled = np.zeros(16)
-        adc_val = np.zeros(16)
+        event_data_uint = np.frombuffer(event_data_bytes,dtype=np.uint32)
 
-        try:
-            detector_names = self.get_detectors_for_preamp(header_dict,device_id)
-        except KeyError:
+        data = self.decode_batch(event_data_uint[np.newaxis,:], [event_number], header_dict)
+        if len(data["event_number"]) == 0:
             return None
+        self.decoded_values.extend(data)
 
-        for i,val in enumerate(enabled):
-            enabled[i] = (event_data_uint[2]>>(i) & 0x1)
-
-            if(verbose):
-                if(enabled[i] != 0):
+        if(verbose):
+            for i, enabled_val in enumerate((event_data_uint[2] >> np.arange(16)) & 0x1):
+                if(enabled_val != 0):
                     print("Channel %d is enabled" % (i))
                 else:
                     print("Channel %d is disabled" % (i))
+            print(event_data_uint[3:19].view(np.float32))
 
-        for i,val in enumerate(adc_val):
-            adc_val[i] = event_data_float[3+i]
+        return [{name: values[i] for name, values in data.items()} for i in range(len(data["event_number"]))]
 
-        if(verbose):
-            print(adc_val)
+    def decode_batch(self, event_data, event_numbers, header_dict):
+        """
+            Vectorized decode_event: decodes a (N, record length) uint32 block of records into
+            N*16 rows (one per channel, laid out like format_data).  Records from preamps that
+            aren't in the header are dropped.
+        """
+        if header_dict is not self.preamp_header:
+            self.build_preamp_table(header_dict)
 
-        data_dict = self.format_data(adc_val, timestamp, enabled, device_id, detector_names, event_number)
-        for d in data_dict:
-            self.decoded_values.append(d)
+        device_id = (event_data[:,0]&0xFFF).astype(np.int64)
+        row = np.searchsorted(self.preamp_ids, device_id).clip(max=max(len(self.preamp_ids)-1, 0))
+        known = self.preamp_ids[row] == device_id if len(self.preamp_ids) > 0 else np.zeros(len(device_id), dtype=bool)
 
-        return data_dict
+        event_data, device_id, row = event_data[known], device_id[known], row[known]
+        n_events = len(event_data)
+
+        enabled = ((event_data[:,2:3] >> np.arange(16, dtype=np.uint32)) & 0x1).astype(np.float64)
+        adc_val = event_data[:,3:19].view(np.float32).astype(np.float64)
+
+        #format_data pairs enabled bit i with the adc value and name of channel i-1
+        data = {
+            "adc": np.roll(adc_val, 1, axis=1).ravel(),
+            "enabled": enabled.ravel(),
+            "timestamp": np.repeat(event_data[:,1], 16),
+            "name": np.roll(self.preamp_names[row], 1, axis=1).ravel(),
+            "channel": np.tile(np.arange(-1, 15, dtype=np.int64), n_events),
+            "device_id": np.repeat(device_id, 16),
+            "event_number": np.repeat(np.asarray(event_numbers, dtype=np.int64)[known], 16)
+        }
+        return data
+
+    def build_preamp_table(self, header_dict):
+        """
+            Builds the sorted preamp id array and matching (n_preamps, 16) array of channel names
+            used by decode_batch
+        """
+        preamp_ids = sorted(set(aux["MJDPreAmp"]["preampID"] for aux in header_dict["ObjectInfo"]["AuxHw"] if "MJDPreAmp" in aux))
+
+        self.preamp_ids = np.array(preamp_ids, dtype=np.int64)
+        self.preamp_names = np.empty((len(preamp_ids), 16), dtype=object)
+        for i, preamp_id in enumerate(preamp_ids):
+            self.preamp_names[i] = self.get_detectors_for_preamp(header_dict, preamp_id)
+        self.preamp_header = header_dict
 
     def format_data(self, adc_val, timestamp, enabled, device_id, detector_names, event_number):
         """
@@ -111,6 +184,7 @@ class MJDPreampDecoder(Poller):
         """
 
         for preampNum in header_dict["ObjectInfo"]["AuxHw"]:
+            if "MJDPreAmp" not in preampNum: continue
 
             preamp_ID = preampNum["MJDPreAmp"]["preampID"]
             if(preamp_ID == an_ID):
@@ -151,16 +225,26 @@ class MJDPreampDecoder(Poller):
                     "-24V",#preampNum["MJDPreAmp"]["detectorName14"],
                     "Temp Chip 2"#preampNum["MJDPreAmp"]["detectorName15"]
                 ]
-        return channel_names
+                return channel_names
+        raise KeyError("No MJDPreAmp with id {} in the header".format(an_ID))
 
 class ISegHVDecoder(Poller):
-    def __init__(self, *args, **kwargs):
-        self.decoder_name = 'ORiSegHVCardDecoderForHV'
-        self.class_name = 'ORiSegHVCard_placeholder' #what should this be?
+    decoder_name = 'ORiSegHVCardDecoderForHV'
+    class_name = 'ORiSegHVCard_placeholder' #what should this be?
 
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.event_header_length = -1
 
+        self.decoded_values = ColumnBuffer({
+            "timestamp": np.uint32,
+            "voltage": (np.float64, 8),
+            "current": (np.float64, 8),
+            "enabled": (np.float64, 8),
+            "crate": np.int64,
+            "card": np.int64,
+            "event_number": np.int64
+        })
 
         return
 
@@ -196,44 +280,40 @@ class ISegHVDecoder(Poller):
         19   xxxx xxxx xxxx xxxx xxxx xxxx xxxx xxxx  actual Current encoded as a float (chan 7)
         """
 
-        event_data_int = np.fromstring(event_data_bytes,dtype=np.uint32)
-        event_data_float = np.fromstring(event_data_bytes,dtype=np.float32)
-
-        # print(event_data_int)
-        # print(event_data_float)
-
-        crate   = (event_data_int[0]>>20)&0xF
-        card    = (event_data_int[0]>>16)&0xF
+        event_data_int = np.frombuffer(event_data_bytes,dtype=np.uint32)
 
+        data = self.decode_batch(event_data_int[np.newaxis,:], [event_number], header_dict)
+        data_dict = {name: values[0] for name, values in data.items()}
+        self.decoded_values.append(data_dict)
 
-        enabled = np.zeros(8)     #enabled channels
-        voltage = np.zeros(8)
-        current = np.zeros(8)
-        timestamp = event_data_int[3]
-
-        for i,j in enumerate(enabled):
-            enabled[i] = (event_data_int[1]>>(4*i) & 0xF)
-
-            if(verbose):
-                if(enabled[i] != 0):
+        if(verbose):
+            for i, enabled_val in enumerate(data_dict["enabled"]):
+                if(enabled_val != 0):
                     print("Channel %d is enabled" % (i))
                 else:
                     print("Channel %d is disabled" % (i))
+            print("HV voltages: ",data_dict["voltage"])
+            print("HV currents: ",data_dict["current"])
 
-        for i,j in enumerate(voltage):
-            voltage[i] = event_data_float[4+(2*i)]
-            current[i] = event_data_float[5+(2*i)]
-
-        if(verbose):
-            print("HV voltages: ",voltage)
-            print("HV currents: ",current)
-
-        # self.values["channel"] = channel
+        return data_dict
 
-        data_dict = self.format_data(timestamp, voltage, current, enabled, crate, card, event_number)
-        self.decoded_values.append(data_dict)
+    def decode_batch(self, event_data, event_numbers, header_dict):
+        """
+            Vectorized decode_event for a (N, record length) uint32 block of records.
+            voltage, current and enabled come back as (N, 8) arrays
+        """
+        event_data_float = event_data.view(np.float32)
 
-        return data_dict
+        data = {
+            "timestamp": event_data[:,3],
+            "voltage": event_data_float[:,4:20:2].astype(np.float64),
+            "current": event_data_float[:,5:20:2].astype(np.float64),
+            "enabled": ((event_data[:,1:2] >> (4*np.arange(8, dtype=np.uint32))) & 0xF).astype(np.float64),
+            "crate": ((event_data[:,0]>>20)&0xF).astype(np.int64),
+            "card": ((event_data[:,0]>>16)&0xF).astype(np.int64),
+            "event_number": np.asarray(event_numbers, dtype=np.int64)
+        }
+        return data
 
     def format_data(self, timestamp, voltage, current, enabled, crate, card, event_number):
         """
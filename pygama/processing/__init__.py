@@ -9,6 +9,17 @@ from ._pygama import TierOneProcessorList
 from ._processing import process_tier_0
 from ._processing import process_tier_1
 
+from ._record_index import build_record_index
+from ._record_index import get_record_index
+
+from ._header_parser import get_header_info
+
+from ._timing import TimingReport
+
+from ._scheduler import RunScheduler
+from ._scheduler import estimate_tier_0_memory
+from ._scheduler import estimate_tier_1_memory
+
 from .processors import Calculator
 from .processors import Transformer
 from .processors import DatabaseLookup
@@ -17,6 +28,13 @@ from .processors import Tier0Passer
 __all__ = [
     "process_tier_0",
     "process_tier_1",
+    "build_record_index",
+    "get_record_index",
+    "get_header_info",
+    "TimingReport",
+    "RunScheduler",
+    "estimate_tier_0_memory",
+    "estimate_tier_1_memory",
     "Calculator",
     "Transformer",
     "DatabaseLookup",
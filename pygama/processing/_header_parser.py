@@ -1,7 +1,22 @@
 import plistlib
-import sys
+import os, sys
+import pickle
+from collections import OrderedDict
 import pandas as pd
 
+HEADER_CACHE_EXT = ".hdr.pkl"
+
+#the last few parsed headers, keyed by (file name, size, mtime), so each process only loads a header once
+#while it works through a file.  Older ones get dropped: the .hdr.pkl cache is there for the rest
+_header_info_memo = OrderedDict()
+HEADER_MEMO_SIZE = 8
+
+def _memoize_header_info(key, header_info):
+    _header_info_memo[key] = header_info
+    _header_info_memo.move_to_end(key)
+    while len(_header_info_memo) > HEADER_MEMO_SIZE:
+        _header_info_memo.popitem(last=False)
+
 def parse_header(xmlfile):
     """
         Opens the given file for binary read ('rb'), then grabs the first 8 bytes as variable ba
@@ -34,10 +49,76 @@ def parse_header(xmlfile):
         if sys.version_info[0] < 3: #the readPlistFromBytes method doesn't exist in 2.7
             header_string = ba.decode("utf-8")
             header_dict = plistlib.readPlistFromString(header_string)
+        elif hasattr(plistlib, "loads"): #readPlistFromBytes is gone as of 3.9
+            header_dict = plistlib.loads(bytes(ba))
         else:
             header_dict = plistlib.readPlistFromBytes(ba)
         return i,j,header_dict
 
+def get_header_info(xmlfile, use_cache=True):
+    """
+        Parses the header of an orca file along with everything we pull out of it.  Results are
+        kept in memory and pickled to <xmlfile>.hdr.pkl, keyed by (file name, size, mtime), so later
+        runs (and worker processes) over the same file skip the plist parsing.
+
+        Returns a dict with:
+            header_length: header length in longs
+            header_bytes: header length in bytes
+            header_dict: the parsed header
+            decoder_for_id: see get_decoder_for_id
+            run_number: run number (None if the header doesn't have one)
+            object_info: dict of class name -> get_object_info dataframe, for each card class in the crates
+    """
+    stat = os.stat(xmlfile)
+    key = (os.path.basename(xmlfile), stat.st_size, stat.st_mtime_ns)
+    cache_name = xmlfile + HEADER_CACHE_EXT
+
+    if use_cache:
+        if key in _header_info_memo:
+            _header_info_memo.move_to_end(key)
+            return _header_info_memo[key]
+        if os.path.isfile(cache_name):
+            try:
+                with open(cache_name, "rb") as cache:
+                    cache_key, header_info = pickle.load(cache)
+                if cache_key == key:
+                    _memoize_header_info(key, header_info)
+                    return header_info
+            except Exception as e:
+                print("Failed to load header cache {} (Exception: {})".format(cache_name, e))
+
+    header_length, header_bytes, header_dict = parse_header(xmlfile)
+
+    try: run_number = get_run_number(header_dict)
+    except ValueError: run_number = None
+
+    class_names = set()
+    for crate in header_dict["ObjectInfo"]["Crates"]:
+        for card in crate["Cards"]:
+            class_names.add(card["Class Name"])
+
+    header_info = {
+        "header_length": header_length,
+        "header_bytes": header_bytes,
+        "header_dict": header_dict,
+        "decoder_for_id": get_decoder_for_id(header_dict),
+        "run_number": run_number,
+        "object_info": {class_name: get_object_info(header_dict, class_name) for class_name in class_names}
+    }
+
+    if use_cache:
+        _memoize_header_info(key, header_info)
+        try:
+            #write then rename, so nobody ever reads a half-written cache
+            with open(cache_name + ".tmp", "wb") as cache:
+                pickle.dump((key, header_info), cache, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_name + ".tmp", cache_name)
+        except OSError:
+            #raw data directories are often read-only.  not a big deal.
+            pass
+
+    return header_info
+
 def from_bytes (data, big_endian = False):
     #python2 doesn't have this function, so rewrite it for bw compatibility
     if isinstance(data, str):
@@ -1,5 +1,6 @@
 import sys, os, glob
 from ._pygama import ProcessTier0,ProcessTier1, TierOneProcessorList
+from ._scheduler import RunScheduler, estimate_tier_0_memory, estimate_tier_1_memory
 
 from multiprocessing import Pool, cpu_count
 from functools import partial
@@ -7,7 +8,17 @@ import numpy as np
 
 #TODO: this file should just be merged with the cython file, np?
 
-def process_tier_0(datadir, runList, verbose=True, output_dir=None, chan_list=None, n_max = np.inf):
+def process_tier_0(datadir, runList, verbose=True, output_dir=None, chan_list=None, n_max = np.inf, num_threads=1, n_workers=None, memory_budget_mb=None, flush_mb=200):
+    '''
+    num_threads: number of processes each run's file is split across
+    n_workers, memory_budget_mb: runs are processed side by side, each in its own process, as many at once as
+                                 there are workers (default: cpu_count()/num_threads) and as fit in the memory
+                                 budget (default: 80% of physical memory) by their estimated use.  See RunScheduler
+    flush_mb: see ProcessTier0
+    Returns a dict of run: None if it was processed, or the error if it failed
+    '''
+    if n_workers is None: n_workers = max(1, cpu_count() // num_threads)
+    scheduler = RunScheduler(n_workers, memory_budget_mb)
 
     for run in runList:
         #Find a file in the directory with the ""
@@ -18,30 +29,45 @@ def process_tier_0(datadir, runList, verbose=True, output_dir=None, chan_list=No
         elif len(filenameList) > 1:
             print("More than one file with name Run{} in directory {}! Skipping run...".format(run, datadir))
             continue
-        filename = filenameList[0]
-        filepath = os.path.join(datadir, filename)
+        filepath = filenameList[0]
 
-        ProcessTier0(filepath, verbose=verbose, output_dir=output_dir, n_max=n_max, chan_list=chan_list)
+        scheduler.add_job(run, ProcessTier0, (filepath,),
+                          {"verbose":verbose, "output_dir":output_dir, "n_max":n_max, "chan_list":chan_list, "num_threads":num_threads, "flush_mb":flush_mb},
+                          memory_mb=estimate_tier_0_memory(filepath, flush_mb, num_threads), size_mb=os.path.getsize(filepath)/1e6)
 
-def process_tier_1(datadir, runList, processor_list, verbose=True, output_dir=None, output_file_string="t2", num_threads=1):
+    return scheduler.run()
+
+def process_tier_1(datadir, runList, processor_list, verbose=True, output_dir=None, output_file_string="t2", num_threads=1, vectorize=True, chunk_size=10000,
+                   n_workers=None, memory_budget_mb=None, incremental=False):
+    '''
+    num_threads: number of processes each run's events are split across (so one big run still uses them all)
+    vectorize: run each transform/calculator on blocks of waveforms (see ProcessTier1)
+    chunk_size: events processed at a time (see ProcessTier1)
+    n_workers, memory_budget_mb: runs are processed side by side, as in process_tier_0
+    incremental: only run the processors whose outputs aren't already up to date in the t2 files (see ProcessTier1)
+    Returns a dict of run: None if it was processed, or the error if it failed
+    '''
     # if processor_list is None:
     #     processor_list = get_default_processor_list()
 
-    t1_args = []
+    max_proc = cpu_count()
+    num_threads = num_threads if num_threads < max_proc else max_proc
+    if n_workers is None: n_workers = max(1, max_proc // num_threads)
+    scheduler = RunScheduler(n_workers, memory_budget_mb)
+
     for run in runList:#[440]:
         filepath = os.path.join(datadir, "t1_run{}.h5".format(run))
-        if num_threads == 1:
-            ProcessTier1(filepath, processor_list, verbose=verbose, output_dir=output_dir, output_file_string=output_file_string  )
-        else:
-            t1_args.append( [filepath, processor_list] )
-            keywords = {"verbose": verbose, "output_dir":output_dir}
+        if not os.path.isfile(filepath):
+            print("No file {}! Skipping run...".format(filepath))
+            continue
+
+        scheduler.add_job(run, ProcessTier1, (filepath, processor_list),
+                          {"verbose":verbose, "output_dir":output_dir, "output_file_string":output_file_string,
+                           "vectorize":vectorize, "chunk_size":chunk_size, "num_threads":num_threads, "incremental":incremental,
+                           "return_path":True},
+                          memory_mb=estimate_tier_1_memory(filepath, chunk_size, num_threads), size_mb=os.path.getsize(filepath)/1e6)
 
-    if num_threads > 1:
-        max_proc = cpu_count() #careful, its a lot to load in RAM...
-        num_threads = num_threads if num_threads < max_proc else max_proc
-        p = Pool(num_threads)
-        # p.starmap( partial(ProcessTier0, **keywords), t0_args)
-        p.starmap(partial(ProcessTier1, **keywords), t1_args)
+    return scheduler.run()
 
 # def get_default_processor_list():
 #
@@ -1,18 +1,24 @@
 cimport numpy as np
 
 import numpy as np
-import os, re, sys
+import os, re, sys, time
 import pandas as pd
 import h5py
+from multiprocessing import Pool
 from future.utils import iteritems
 
 from ..utils import update_progress
 from ..decoders import *
 from ..decoders.digitizers import Digitizer
 from ._header_parser import *
+from ._record_index import build_record_index, get_record_index, split_record_index, map_raw_file, get_record_data
+from ._record_index import QUARANTINE_DTYPE, quarantine_records
+from ._timing import TimingReport
 from .processors import Calculator, Transformer, DatabaseLookup, Tier0Passer
+from .processors import function_identity, cache_token, hash_token
 
-def ProcessTier0( filename, output_file_string = "t1", chan_list=None, n_max=np.inf, verbose=False, output_dir=None, decoders=None):
+def ProcessTier0( filename, output_file_string = "t1", chan_list=None, n_max=np.inf, verbose=False, output_dir=None, decoders=None, use_index_cache=True, use_header_cache=True, num_threads=1, flush_events=50000, flush_mb=200,
+                  follow=False, poll_interval=2., follow_timeout=60., resume=False, checkpoint_mb=None):
   '''
   Reads in "raw," or "tier 0," Orca data and saves to a hdf5 format using pandas
     filename: path to an orca data file
@@ -20,16 +26,42 @@ def ProcessTier0( filename, output_file_string = "t1", chan_list=None, n_max=np.
     n_max: maximum number of events to process (useful for debugging)
     verbose: spits out a progressbar to let you know how the processing is going
     output_dir: where to stash the t1 file
+    use_index_cache: read/write the record index cache (<filename>.idx.npz) next to the raw file
+    use_header_cache: read/write the parsed header cache (<filename>.hdr.pkl) next to the raw file
+    num_threads: number of worker processes to split the file across
+    flush_events, flush_mb: each decoder appends what it has decoded to the t1 file once it has been
+                            handed this many events or megabytes of raw data, which bounds the memory use
+    follow: keep decoding records as they get written to a file that is still being taken.  The file is checked
+            for new records every poll_interval seconds, and following stops once it hasn't grown in follow_timeout
+            seconds (or on ctrl-c).
+    resume: if the t1 file already exists and has a checkpoint from this same raw file, carry on from the
+            checkpoint instead of starting over.  A checkpoint (every decoder flushed, the number of records
+            done, and the records quarantined so far) is committed to the t1 file after about every checkpoint_mb
+            megabytes of raw data.  checkpoint_mb defaults to 1000 with resume; without resume, checkpoints are
+            only written if checkpoint_mb is given (they cost a flush of every decoder).
+            Only works with num_threads=1.
+  Returns a TimingReport of where the time went (per stage and per decoder), which also gets written
+  to the t1 file under the key "tier0_timing".
+  Records that get skipped (corrupt stretches of the file, records without a decoder, records a decoder
+  choked on) are listed, with the reason, under the key "tier0_quarantine"
   '''
 
-  SEEK_END = 2
+  if follow and num_threads > 1:
+    raise ValueError("Can't follow a file that is still being written with more than one thread")
+  if resume and num_threads > 1:
+    raise ValueError("Can only resume Tier 0 processing with num_threads=1")
+  if checkpoint_mb is None and resume: checkpoint_mb = 1000
 
   directory = os.path.dirname(filename)
   output_dir = os.getcwd() if output_dir is None else output_dir
 
-  #parse the header (in python)
+  report = TimingReport()
+  start_time = time.perf_counter()
 
-  reclen, reclen2, headerDict = parse_header(filename)
+  #parse the header (in python).  it's cached next to the raw file, so this is only slow the first time
+  with report.timer("header"):
+    header_info = get_header_info(filename, use_cache=use_header_cache and not follow)
+  reclen, reclen2, headerDict = header_info["header_length"], header_info["header_bytes"], header_info["header_dict"]
 
   #TODO: do something useful with parsing out the MJ model
   # detector_info = StringIO( headerDict["ObjectInfo"]["MajoranaModel"]["DetectorGeometry"] )
@@ -42,40 +74,40 @@ def ProcessTier0( filename, output_file_string = "t1", chan_list=None, n_max=np.
   print("   %d longs (in plist header)" % reclen)
   print("   %d bytes in the header" % reclen2)
 
-  f_in = open(filename.encode('utf-8'), "rb")
-  if f_in == None:
-      print("Couldn't file the file %s" % filename)   # file the file?
-      sys.exit(0)
-
   #figure out the total size
-  f_in.seek(0, SEEK_END)
-  file_size = float(f_in.tell())
-  f_in.seek(0,0)    # rewind
+  file_size = float(os.path.getsize(filename))
   file_size_MB = file_size/1e6
   print("Total file size: %3.3f MB" % file_size_MB)
 
-  # skip the header
-  f_in.seek(reclen*4)   # reclen is in number of longs, and we want to skip a number of bytes
+  #find every record in one pass (reclen is the header length in longs)
+  with report.timer("index", bytes=file_size):
+    record_index, scan_quarantine = get_record_index(filename, reclen, use_cache=use_index_cache and not follow, verbose=verbose,
+                                                     valid_ids=header_info["decoder_for_id"].keys(), return_quarantine=True)
+  report.add("index", records=len(record_index), skipped=len(scan_quarantine))
+  print("Found {} records".format(len(record_index)))
 
   # pull out the run number
-  runNumber = get_run_number(headerDict)
+  runNumber = header_info["run_number"]
+  if runNumber is None:
+    raise ValueError("No run number found in header!")
   print("Run number: {}".format(runNumber))
 
   #TODO: This is all pretty hard to read & comprehend easily.  Can we clean it up?  Move to header_parser?
 
   #id_dict = flip_data_ids(headerDict)
-  id_dict = get_decoder_for_id(headerDict)
+  id_dict = header_info["decoder_for_id"]
 
   print("The Data IDs present in this file (header) are:")
   for id in id_dict:
     print("    {}: {}".format(id, id_dict[id]))
 
-  #find unique decoders actually used in the data
-  used_decoder_names =  set([id_dict[id] for id in id_dict])
+  #find unique decoders actually used in the data (when following, records for any of them might still show up)
+  data_ids = id_dict.keys() if follow else [int(id) for id in np.unique(record_index["data_id"]) if id in id_dict]
+  used_decoder_names = set([id_dict[id] for id in data_ids])
 
   if decoders is None:
-    # The decoders variable is a list of all the decoders that exist in pygama
-    decoders = get_decoders(headerDict)
+    # only build the decoders we need
+    decoders = get_decoders(header_info, used_decoder_names)
     decoder_names = [d.decoder_name for d in decoders]
 
     print("Warning: No decoder implemented for the following data takers: ")
@@ -84,8 +116,8 @@ def ProcessTier0( filename, output_file_string = "t1", chan_list=None, n_max=np.
         print("  {}".format(d))
 
   #kill unnecessary decoders
+  decoders = [d for d in decoders if d.decoder_name in used_decoder_names]
   for d in decoders:
-    if d.decoder_name not in used_decoder_names: decoders.remove(d)
     if chan_list is not None and isinstance(d, Digitizer): d.chan_list = chan_list
 
   decoder_names = [d.decoder_name for d in decoders]
@@ -105,36 +137,69 @@ def ProcessTier0( filename, output_file_string = "t1", chan_list=None, n_max=np.
     print("    {}: {}".format(key, id_to_decoder[key].decoder_name))
 
   #keep track of warnings we've raised for missing decoders
-  unrecognized_data_ids = []
-  board_id_map = {}
-  appended_data_map = {}
-
-  print("Beginning Tier 0 processing of file {}...".format(filename))
-  event_number = 0 #number of events decoded
-  while (event_number < n_max and f_in.tell() < file_size):# and f_in.tell() < file_size):
-    event_number +=1
-    if verbose and event_number%1000==0:
-        update_progress( float(f_in.tell()) / file_size )
+  n_records = len(record_index) if n_max >= len(record_index) else int(n_max)
+  if n_records < len(record_index):
+    scan_quarantine = scan_quarantine[scan_quarantine["offset"] < record_index["offset"][n_records]]
+  record_index = record_index[:n_records]
+  quarantine = [scan_quarantine]
+  unrecognized_data_ids = [id for id in np.unique(record_index["data_id"]) if id not in id_dict]
 
-    try:
-        event_data, data_id = get_next_event(f_in)
-    except EOFError:
-        break
-    except Exception as e:
-        print("Failed to get the next event... (Exception: {})".format(e))
-        break
+  t1_file_name = os.path.join(output_dir, output_file_string+'_run{}.h5'.format(runNumber))
 
-    try:
-        decoder = id_to_decoder[data_id]
-    except KeyError:
-        if data_id not in id_dict and data_id not in unrecognized_data_ids:
-          unrecognized_data_ids.append(data_id)
-        continue
+  first_record = 0
+  if os.path.isfile(t1_file_name):
+    checkpoint = read_tier_0_checkpoint(t1_file_name) if resume else None
+    if checkpoint is not None and is_checkpoint_valid(checkpoint, filename, chan_list, len(record_index)):
+      first_record = checkpoint["n_records"]
+      print("Resuming from checkpoint at record {} (byte {})".format(first_record, checkpoint["offset"]))
+      for d in decoders:
+        d.truncate_file(t1_file_name, checkpoint["rows"].get(d.decoder_name, 0))
+      #records quarantined before the checkpoint were saved with it; the scan is redone for the rest of the file
+      done_quarantine = read_quarantine(t1_file_name)
+      quarantine = [scan_quarantine[scan_quarantine["offset"] >= checkpoint["offset"]],
+                    done_quarantine[done_quarantine["offset"] < checkpoint["offset"]]]
+    else:
+      if resume: print("No usable checkpoint in {}, starting over".format(t1_file_name))
+      if verbose: print("Over-writing tier1 file {}...".format(t1_file_name))
+      os.remove(t1_file_name)
 
-    decoder.decode_event(event_data, event_number, headerDict )
+  print("Beginning Tier 0 processing of file {}...".format(filename))
 
-  f_in.close()
-  if verbose: update_progress(1)
+  if num_threads > 1:
+    #split the file on record boundaries into chunks of about equal size, decode each in its own process
+    chunk_bounds = split_record_index(record_index, num_threads)
+    part_file_names = ["{}.part{}".format(t1_file_name, i) for i in range(len(chunk_bounds))]
+    #workers load the header from the cache rather than having it pickled over to them
+    chunk_args = [(filename, record_index[start:stop], start+1, id_to_decoder, decoders, use_header_cache, part_file_name, flush_events, flush_mb)
+                  for (start, stop), part_file_name in zip(chunk_bounds, part_file_names)]
+
+    p = Pool(num_threads)
+    for i, (chunk_report, chunk_quarantine) in enumerate(p.imap(_process_tier_0_chunk, chunk_args)):
+      report.merge(chunk_report)
+      quarantine.append(chunk_quarantine)
+      if verbose: update_progress( float(i+1) / len(chunk_args) )
+    p.close()
+    p.join()
+
+  else:
+    def commit_checkpoint(n_done):
+      write_tier_0_checkpoint(t1_file_name, filename, decoders, record_index, first_record + n_done, chan_list, np.concatenate(quarantine))
+
+    raw_data = map_raw_file(filename)
+    decode_records(raw_data, record_index[first_record:], id_to_decoder, headerDict, first_event_number=first_record+1, verbose=verbose,
+                   t1_file_name=t1_file_name, flush_events=flush_events, flush_mb=flush_mb, report=report,
+                   checkpoint=commit_checkpoint if checkpoint_mb is not None else None, checkpoint_mb=checkpoint_mb, quarantine=quarantine)
+    del raw_data
+    if verbose: update_progress(1)
+
+    if follow:
+      flush_decoders(decoders, t1_file_name, report)
+      cursor = int(record_index["offset"][-1] + record_index["length"][-1]) if len(record_index) > 0 else reclen*4
+      #a corrupt stretch at the end of the file gets rescanned (and quarantined) once more of the file is written
+      quarantine[0] = quarantine[0][quarantine[0]["offset"] < cursor]
+      follow_file(filename, cursor, len(record_index), id_to_decoder, decoders, headerDict, t1_file_name,
+                  n_max=n_max, poll_interval=poll_interval, follow_timeout=follow_timeout, flush_events=flush_events, flush_mb=flush_mb,
+                  verbose=verbose, report=report, quarantine=quarantine, valid_ids=header_info["decoder_for_id"].keys())
 
   if len(unrecognized_data_ids) > 0:
     print("\nGarbage Report!:")
@@ -143,24 +208,326 @@ def ProcessTier0( filename, output_file_string = "t1", chan_list=None, n_max=np.
       print ("  {}".format(id))
     print("hopefully they weren't important!\n")
 
+  if verbose: print("Writing {} to tier1 file {}...".format(filename, t1_file_name))
+  if num_threads > 1:
+    with report.timer("merge"):
+      merge_tier_0_parts(part_file_names, t1_file_name, decoders, flush_events)
+  else:
+    flush_decoders(decoders, t1_file_name, report)
+
+  quarantine = np.concatenate(quarantine)
+  if len(quarantine) > 0:
+    print("Quarantined {} records (listed under tier0_quarantine in {})".format(len(quarantine), t1_file_name))
+    write_quarantine(t1_file_name, quarantine)
+
+  #summed over workers, the other stages can add up to more than this when running in parallel
+  report.add("total", time.perf_counter() - start_time, len(record_index), file_size)
+  report.to_file(t1_file_name, "tier0_timing")
+  if verbose: report.print_report()
+
+  return report
+
+def decode_records(raw_data, record_index, id_to_decoder, header_dict, first_event_number=1, verbose=False, batch_size=10000,
+                   t1_file_name=None, flush_events=50000, flush_mb=200, report=None, checkpoint=None, checkpoint_mb=1000, quarantine=None):
+  '''
+  Runs the decoders over the records in record_index
+    raw_data: the memory-mapped raw file (from map_raw_file)
+    record_index: (a slice of) the record index of the file
+    id_to_decoder: dict mapping data ids to decoders.  Records with other data ids are skipped.
+    first_event_number: event number of the first record in record_index
+    batch_size: number of records handed out to the decoders at a time
+    t1_file_name: if given, decoders are flushed to this file whenever they've been handed
+                  flush_events records or flush_mb megabytes since their last flush
+    report: TimingReport to add decoding/writing times to (a new one is made if None)
+    checkpoint: if given, every decoder gets flushed after about every checkpoint_mb megabytes of records
+                (and at the end), then checkpoint is called with the number of records of record_index done
+    quarantine: list to add QUARANTINE_DTYPE arrays of skipped records to (records with no decoder, and
+                records whose decoder raised an exception)
+  Returns the TimingReport
+  '''
+  if report is None: report = TimingReport()
+  file_size = float(len(raw_data))
+  pending_events = {}
+  pending_bytes = {}
+  checkpoint_bytes = 0
 
-  t1_file_name = os.path.join(output_dir, output_file_string+'_run{}.h5'.format(runNumber))
+  for block_start in range(0, len(record_index), batch_size):
+    block = record_index[block_start:block_start+batch_size]
+    event_numbers = np.arange(len(block), dtype=np.int64) + first_event_number + block_start
+    if verbose: update_progress( float(block["offset"][0]) / file_size )
 
+    for data_id in np.unique(block["data_id"]):
+      is_id = block["data_id"] == data_id
+      records, record_event_numbers = block[is_id], event_numbers[is_id]
 
-  if os.path.isfile(t1_file_name):
-    if verbose: print("Over-writing tier1 file {}...".format(t1_file_name))
-    os.remove(t1_file_name)
+      try:
+          decoder = id_to_decoder[int(data_id)]
+      except KeyError:
+          report.add("unrecognized", skipped=len(records), bytes=int(np.sum(records["length"])))
+          if quarantine is not None: quarantine.append(quarantine_records(records, "unrecognized"))
+          continue
+
+      stage_start = time.perf_counter()
+      n_ids = len(records)
+
+      #drop records from unwanted channels using just their headers, before any payload gets read
+      if isinstance(decoder, Digitizer):
+        selected = decoder.select_records(raw_data, records)
+        if selected is not None:
+          records, record_event_numbers = records[selected], record_event_numbers[selected]
+
+      n_bytes = int(np.sum(records["length"]))
+      if len(records) > 0:
+        bad_records = decode_or_quarantine(decoder, raw_data, records, record_event_numbers, header_dict)
+        if len(bad_records) > 0:
+          if quarantine is not None: quarantine.append(bad_records)
+          n_ids += len(bad_records)
+      report.add("decode/"+decoder.decoder_name, time.perf_counter() - stage_start, len(records), n_bytes, n_ids - len(records))
+
+      if t1_file_name is None or len(records) == 0: continue
+      pending_events[decoder] = pending_events.get(decoder, 0) + len(records)
+      pending_bytes[decoder] = pending_bytes.get(decoder, 0) + n_bytes
+      if pending_events[decoder] >= flush_events or pending_bytes[decoder] >= flush_mb*1e6:
+        flush_decoders([decoder], t1_file_name, report)
+        pending_events[decoder] = pending_bytes[decoder] = 0
+
+    if checkpoint is None: continue
+    checkpoint_bytes += int(np.sum(block["length"]))
+    if checkpoint_bytes >= checkpoint_mb*1e6 or block_start + len(block) == len(record_index):
+      flush_decoders(list(dict.fromkeys(id_to_decoder.values())), t1_file_name, report)
+      pending_events, pending_bytes = {}, {}
+      with report.timer("checkpoint"):
+        checkpoint(block_start + len(block))
+      checkpoint_bytes = 0
+
+  return report
+
+def decode_or_quarantine(decoder, raw_data, records, event_numbers, header_dict):
+  '''
+  Decodes a group of records.  If the decoder raises an exception, whatever it decoded from the group is thrown
+  out and the records are decoded one at a time instead, so only the ones it can't handle are lost.
+  Returns a QUARANTINE_DTYPE array of the records that couldn't be decoded.
+  '''
+  n_buffered = decoder.get_n_buffered()
+  try:
+    decoder.decode_records(raw_data, records, event_numbers, header_dict)
+    return np.zeros(0, dtype=QUARANTINE_DTYPE)
+  except Exception:
+    decoder.discard_buffered(n_buffered)
+
+  bad_records = []
+  for i in range(len(records)):
+    n_buffered = decoder.get_n_buffered()
+    try:
+      decoder.decode_records(raw_data, records[i:i+1], event_numbers[i:i+1], header_dict)
+    except Exception as e:
+      decoder.discard_buffered(n_buffered)
+      bad_records.append(quarantine_records(records[i:i+1], "decode error: " + type(e).__name__))
+  if len(bad_records) == 0:
+    return np.zeros(0, dtype=QUARANTINE_DTYPE)
+  print("{} couldn't decode {} records; they've been quarantined".format(decoder.decoder_name, len(bad_records)))
+  return np.concatenate(bad_records)
+
+def flush_decoders(decoders, t1_file_name, report=None):
+  '''
+  Flushes each decoder to t1_file_name, adding the time it takes to the "write/<decoder name>" stage of report
+  '''
+  for decoder in decoders:
+    if report is None:
+      decoder.flush(t1_file_name)
+      continue
+    with report.timer("write/"+decoder.decoder_name, records=decoder.get_n_buffered()):
+      decoder.flush(t1_file_name)
+
+def follow_file(filename, cursor, n_decoded, id_to_decoder, decoders, header_dict, t1_file_name, n_max=np.inf,
+                poll_interval=2., follow_timeout=60., flush_events=50000, flush_mb=200, verbose=False, report=None, quarantine=None,
+                valid_ids=None):
+  '''
+  Decodes the records that get added to a file while it is being written, and appends them to the t1 file
+    cursor: byte offset just past the last complete record that has already been decoded
+    n_decoded: number of records already decoded (event numbers carry on from there)
+    quarantine: list to add QUARANTINE_DTYPE arrays of skipped records to (see decode_records)
+    valid_ids: the data ids from the header, used to resync past corrupt stretches (see build_record_index)
+  Returns once n_max records have been decoded, the file hasn't grown for follow_timeout seconds, or on ctrl-c
+  '''
+  if report is None: report = TimingReport()
+  print("Following {} for new records...".format(filename))
+  last_growth = time.time()
+
+  try:
+    while n_decoded < n_max:
+      time.sleep(poll_interval)
+
+      with report.timer("index"):
+        new_records, scan_quarantine = build_record_index(filename, start=cursor, valid_ids=valid_ids, return_quarantine=True)
+      if len(new_records) == 0:
+        if time.time() - last_growth > follow_timeout:
+          #the file has stopped growing, so whatever is left at its end isn't a record still being written
+          if quarantine is not None: quarantine.append(scan_quarantine)
+          break
+        continue
+      last_growth = time.time()
 
-  if verbose: print("Writing {} to tier1 file {}...".format(filename, t1_file_name))
-  [d.to_file(t1_file_name) for d in decoders]
+      if n_decoded + len(new_records) > n_max: new_records = new_records[:int(n_max - n_decoded)]
+      #only stretches before the last new record: one at the end of the file gets rescanned next time
+      new_cursor = int(new_records["offset"][-1] + new_records["length"][-1])
+      if quarantine is not None: quarantine.append(scan_quarantine[scan_quarantine["offset"] < new_cursor])
+
+      raw_data = map_raw_file(filename)
+      decode_records(raw_data, new_records, id_to_decoder, header_dict, first_event_number=n_decoded+1,
+                     t1_file_name=t1_file_name, flush_events=flush_events, flush_mb=flush_mb, report=report, quarantine=quarantine)
+      del raw_data
+      flush_decoders(decoders, t1_file_name, report)
+
+      n_decoded += len(new_records)
+      cursor = new_cursor
+      if verbose: print("  decoded {} new records ({} total)".format(len(new_records), n_decoded))
+
+  except KeyboardInterrupt:
+    pass
+
+  print("Stopped following {} after {} records".format(filename, n_decoded))
+
+def _process_tier_0_chunk(args):
+  '''
+  Worker for parallel Tier 0 processing: decodes one chunk of records and writes it to its own part file
+  Returns the TimingReport and the quarantined records for the chunk
+  '''
+  filename, record_index, first_event_number, id_to_decoder, decoders, use_header_cache, part_file_name, flush_events, flush_mb = args
+
+  header_dict = get_header_info(filename, use_cache=use_header_cache)["header_dict"]
+  if os.path.isfile(part_file_name): os.remove(part_file_name)
+
+  raw_data = map_raw_file(filename)
+  quarantine = [np.zeros(0, dtype=QUARANTINE_DTYPE)]
+  report = decode_records(raw_data, record_index, id_to_decoder, header_dict, first_event_number=first_event_number,
+                          t1_file_name=part_file_name, flush_events=flush_events, flush_mb=flush_mb, quarantine=quarantine)
+  del raw_data
 
-def ProcessTier1(filename,  processorList, digitizer_list=None, output_file_string="t2", verbose=False, output_dir=None):
+  flush_decoders(decoders, part_file_name, report)
+  return report, np.concatenate(quarantine)
+
+def write_quarantine(t1_file_name, quarantine):
+  '''
+  Writes the quarantined records (a QUARANTINE_DTYPE array) to the t1 file under tier0_quarantine, sorted by offset.
+  Pass the rows to get_record_data to get at the data of a quarantined record.
+  '''
+  quarantine = np.sort(quarantine, order="offset")
+  df = pd.DataFrame({name: quarantine[name] for name in ["offset", "data_id", "length"]})
+  df["reason"] = [reason.decode() for reason in quarantine["reason"]]
+  df.to_hdf(t1_file_name, key="tier0_quarantine", mode="a")
+
+def read_quarantine(t1_file_name):
+  '''
+  Reads the tier0_quarantine table of a t1 file back into a QUARANTINE_DTYPE array (empty if there isn't one)
+  '''
+  with pd.HDFStore(t1_file_name, "r") as store:
+    if "tier0_quarantine" not in store: return np.zeros(0, dtype=QUARANTINE_DTYPE)
+    df = store["tier0_quarantine"]
+  quarantine = np.zeros(len(df), dtype=QUARANTINE_DTYPE)
+  for name in ["offset", "data_id", "length"]: quarantine[name] = df[name].values
+  quarantine["reason"] = [reason.encode() for reason in df["reason"]]
+  return quarantine
+
+def write_tier_0_checkpoint(t1_file_name, raw_file_name, decoders, record_index, n_records, chan_list=None, quarantine=None):
+  '''
+  Commits a checkpoint to the t1 file: the first n_records records of record_index are done, and every decoder
+  has been flushed.  The rows each decoder has in the file are stored too, so anything flushed after this
+  checkpoint can be thrown out when resuming.  The records quarantined so far (a QUARANTINE_DTYPE array)
+  get written under tier0_quarantine, so they can be carried over.
+  '''
+  if quarantine is not None and len(quarantine) > 0:
+    write_quarantine(t1_file_name, quarantine)
+
+  rows = {}
+  with pd.HDFStore(t1_file_name, "a") as store:
+    for d in decoders:
+      rows[d.decoder_name] = store.get_storer(d.decoder_name).nrows if d.decoder_name in store else 0
+
+  stat = os.stat(raw_file_name)
+  with h5py.File(t1_file_name, "a") as f:
+    group = f.require_group("tier0_checkpoint")
+    group.attrs["raw_file"] = os.path.basename(raw_file_name)
+    group.attrs["raw_size"] = stat.st_size
+    group.attrs["raw_mtime_ns"] = stat.st_mtime_ns
+    group.attrs["chan_list"] = repr(None if chan_list is None else sorted(chan_list))
+    group.attrs["offset"] = int(record_index["offset"][n_records-1] + record_index["length"][n_records-1]) if n_records > 0 else 0
+    group.attrs["event_number"] = n_records
+    for decoder_name, n_rows in rows.items():
+      group.attrs["rows/"+decoder_name] = n_rows
+    #written last, so it's only there once the rest of the checkpoint is
+    group.attrs["n_records"] = n_records
+
+def read_tier_0_checkpoint(t1_file_name):
+  '''
+  Returns the checkpoint in a t1 file as a dict (with the rows per decoder in "rows"), or None if there isn't one
+  '''
+  try:
+    with h5py.File(t1_file_name, "r") as f:
+      if "tier0_checkpoint" not in f or "n_records" not in f["tier0_checkpoint"].attrs: return None
+      attrs = dict(f["tier0_checkpoint"].attrs)
+  except OSError as e:
+    print("Couldn't read checkpoint from {} (Exception: {})".format(t1_file_name, e))
+    return None
+
+  checkpoint = {name: (value.item() if hasattr(value, "item") else value) for name, value in attrs.items() if not name.startswith("rows/")}
+  checkpoint["rows"] = {name[len("rows/"):]: int(value) for name, value in attrs.items() if name.startswith("rows/")}
+  return checkpoint
+
+def is_checkpoint_valid(checkpoint, raw_file_name, chan_list, n_records):
+  '''
+  Checks that a checkpoint was made from this raw file (unchanged since), with the same channel selection
+  '''
+  stat = os.stat(raw_file_name)
+  return (checkpoint["raw_file"] == os.path.basename(raw_file_name) and checkpoint["raw_size"] == stat.st_size
+          and checkpoint["raw_mtime_ns"] == stat.st_mtime_ns and checkpoint["n_records"] <= n_records
+          and checkpoint["chan_list"] == repr(None if chan_list is None else sorted(chan_list)))
+
+def merge_tier_0_parts(part_file_names, t1_file_name, decoders, chunk_size=50000):
+  '''
+  Appends the part files written by the Tier 0 workers (in order, chunk_size rows at a time) to the tier 1 file, then removes them
+  '''
+  part_file_names = [part_file_name for part_file_name in part_file_names if os.path.isfile(part_file_name)]
+
+  for d in decoders:
+    for part_file_name in part_file_names:
+      with pd.HDFStore(part_file_name, "r") as store:
+        if d.decoder_name not in store: continue
+        n_rows = store.get_storer(d.decoder_name).nrows
+
+      for start in range(0, n_rows, chunk_size):
+        d.to_file(t1_file_name, d.read_columns(part_file_name, start, start+chunk_size), append=True)
+
+  for part_file_name in part_file_names:
+    os.remove(part_file_name)
+
+def ProcessTier1(filename,  processorList, digitizer_list=None, output_file_string="t2", verbose=False, output_dir=None, vectorize=True, chunk_size=10000, num_threads=1,
+                 incremental=False, return_path=False):
   '''
   Reads in "raw," or "tier 0," Orca data and saves to a hdf5 format using pandas
     filename: path to a tier1 data file
     processorList: TierOneProcessorList object with list of calculations/transforms you want done
     output_file_string: file is saved as <output_file_string>_run<runNumber>.h5
     verbose: spits out a progressbar to let you know how the processing is going
+    vectorize: hand each transform/calculator a 2-D block of waveforms at once (see TierOneProcessorList.ProcessBatch).
+               Functions that aren't marked batch_aware are still called once per event.  If False,
+               the whole processor list is run one event at a time
+    chunk_size: number of events read, processed and appended to the t2 file at a time.  This (not the
+                size of the run) sets how much memory processing takes
+    num_threads: number of processes to split the run's events across.  Each worker reads its chunks
+                 straight from the t1 file (only the rows it needs) and sends back the results, which
+                 get written in order.  Chunks are made smaller if needed so every worker gets several
+    incremental: if the t2 file already exists, keep its columns that are still up to date and only run the
+                 processors whose outputs are new or changed (plus the transforms they need).  Every t2 file
+                 stores a cache key for each output (see TierOneProcessorList.GetOutputKeys) under "tier2_cache",
+                 and a column is up to date if the key it was stored with matches.  The t1 file is identified
+                 by its name, size and modification time, and the waveforms by the digitizers' parse settings
+                 (eg Gretina correct_presum, see Digitizer.get_parse_settings).
+  The results for the events of every digitizer go in one table (key "data").  Columns only some digitizers
+  make (eg fs_start/fs_end, which only multisampled waveforms have) are stored as floats, NaN for the others.
+    return_path: return the path of the t2 file instead of the t2 dataframe.  The events are processed a chunk at
+                 a time, but the dataframe is read back from the t2 file whole, so set this for runs that don't fit in memory
+  Returns the t2 dataframe (or its path, with return_path)
   '''
 
   directory = os.path.dirname(filename)
@@ -170,74 +537,193 @@ def ProcessTier1(filename,  processorList, digitizer_list=None, output_file_stri
   run_str = re.findall('run\d+', filename)[-1]
   runNumber = int(''.join(filter(str.isdigit, run_str)))
 
+  #find the available keys
+  with h5py.File(filename, 'r') as f:
+    file_keys = list(f.keys())
+
   if digitizer_list is None:
     #digitize everything available
-    digitizer_list = get_digitizers()
-  digitizer_decoder_names = [d.class_name for d in digitizer_list]
+    digitizer_list = get_digitizers(file_keys)
+  digitizer_list = [d for d in digitizer_list if d.decoder_name in file_keys]
+  digitizer_settings = [(d.class_name, cache_token(d.get_parse_settings())) for d in digitizer_list]
 
-  #find the available keys
-  f = h5py.File(filename, 'r')
-  for d in digitizer_list:
-    if d.decoder_name not in f.keys():
-      digitizer_list.remove(d)
+  t2_file_name = output_file_string+'_run{}.h5'.format(runNumber)
+  t2_path = os.path.join(output_dir,t2_file_name)
 
   print("Beginning Tier 1 processing of file {}...".format(filename))
 
+  n_events = {}
+  row_offsets = [] #where each digitizer's events start in the t2 table
   for digitizer in digitizer_list:
-    print("   Processing from digitizer {}".format(digitizer.class_name))
-
     object_info = pd.read_hdf(filename,key=digitizer.class_name)
     digitizer.load_object_info(object_info)
+    row_offsets.append(sum(n_events.values()))
+    n_events[digitizer] = digitizer.get_n_rows(filename)
+  n_total, n_done = sum(n_events.values()), 0
+
+  stat = os.stat(filename)
+  source_key = hash_token((os.path.basename(filename), stat.st_size, stat.st_mtime_ns, digitizer_settings, processorList.t0_list))
+  output_keys = processorList.GetOutputKeys(source_key)
+
+  #outputs we can take from the existing t2 file (output name: its column there)
+  cached_columns = {}
+  if incremental and os.path.isfile(t2_path):
+    cached_keys = read_tier_1_cache(t2_path)
+    cached_columns = {name: cached_keys[key] for name, key in output_keys.items() if key in cached_keys}
+    if len(cached_columns) > 0 and get_n_t2_rows(t2_path) != n_total:
+      print("   {} doesn't have a row for every event: recomputing everything".format(t2_path))
+      cached_columns = {}
+    print("   Reusing {} of {} outputs from {}".format(len(cached_columns), len(output_keys), t2_path))
+
+  #write next to the old file (which the cached columns get read from), and replace it once done
+  cache_path = t2_path if len(cached_columns) > 0 else None
+  write_path = t2_path + ".tmp" if cache_path is not None else t2_path
+  if os.path.isfile(write_path): os.remove(write_path)
+  processorList.cached_outputs = set(cached_columns)
+
+  digitizer_dtypes = []
+  for i, digitizer in enumerate(digitizer_list):
+    #run the first event through to find out which columns this digitizer's events get
+    if n_events[digitizer] > 0:
+      cached = read_cached_outputs(cache_path, cached_columns, row_offsets[i], row_offsets[i]+1)
+      digitizer_dtypes.append(process_tier_1_chunk(digitizer, digitizer.read_file(filename, 0, 1), processorList, vectorize, cached).dtypes)
+
+  #every chunk has to match the table's columns and types, so take the types that hold all the digitizers' values
+  t2_columns = list(dict.fromkeys(name for dtypes in digitizer_dtypes for name in dtypes.index))
+  #in the order a full run gives, whichever outputs came from the cache: outputs in processor list order after the rest
+  outputs = [name for name in dict.fromkeys(output_keys) if name not in processorList.t0_list]
+  t2_columns = [name for name in t2_columns if name not in outputs] + [name for name in outputs if name in t2_columns]
+  t2_dtypes = {}
+  for name in t2_columns:
+    dtypes = [dtypes[name] for dtypes in digitizer_dtypes if name in dtypes.index]
+    if len(dtypes) < len(digitizer_dtypes): dtypes.append(np.float64)
+    t2_dtypes[name] = np.result_type(*dtypes)
+
+  if num_threads > 1:
+    chunk_size = max(1, min(chunk_size, int(np.ceil(n_total / (4.*num_threads)))))
+  chunks = [(i, start, min(start+chunk_size, n_events[digitizer])) for i, digitizer in enumerate(digitizer_list) for start in range(0, n_events[digitizer], chunk_size)]
+
+  if num_threads > 1:
+    #the processor list and digitizers get sent to each worker once, not with every chunk
+    p = Pool(num_threads, initializer=_init_tier_1_worker, initargs=(filename, digitizer_list, processorList, vectorize, cache_path, cached_columns, row_offsets))
+    chunk_results = p.imap(_process_tier_1_chunk, chunks)
+  else:
+    chunk_results = (process_tier_1_chunk(digitizer_list[i], digitizer_list[i].read_file(filename, start, stop), processorList, vectorize,
+                                          read_cached_outputs(cache_path, cached_columns, row_offsets[i]+start, row_offsets[i]+stop))
+                     for i, start, stop in chunks)
+
+  if verbose: print("Writing to t2 file {}...".format(t2_path))
+  with pd.HDFStore(write_path, "w") as store:
+    last_digitizer = None
+    for (i, start, stop), df_chunk in zip(chunks, chunk_results):
+      if i != last_digitizer:
+        print("   Processing from digitizer {}".format(digitizer_list[i].class_name))
+        last_digitizer = i
+
+      df_chunk = df_chunk.reindex(columns=t2_columns).astype(t2_dtypes, copy=False)
+      df_chunk.index = np.arange(n_done, n_done + len(df_chunk))
+
+      store.append("data", df_chunk, format='table', data_columns=True)
+      n_done += len(df_chunk)
+      if verbose: update_progress( float(n_done)/ n_total)
+
+  if num_threads > 1:
+    p.close()
+    p.join()
+  processorList.cached_outputs = set()
+
+  write_tier_1_cache(write_path, {name: key for name, key in output_keys.items() if name in t2_columns})
+  if write_path != t2_path: os.replace(write_path, t2_path)
 
-    event_df = pd.read_hdf(filename,key=digitizer.decoder_name)
-
-    appended_data = []
-
-    for i, (index, event_data) in enumerate(event_df.iterrows()):
-      if verbose and i%100==0: update_progress( float(i)/ len(event_df.index))
+  if verbose: update_progress(1)
+  if n_total == 0: print("No events to process in {}".format(filename))
 
-      waveform = digitizer.parse_event_data(event_data)
-      #Currently, I'll just mandate that we only process full waveform data i guess
-      wf_data = waveform.get_waveform()
+  if return_path: return t2_path
+  return pd.read_hdf(t2_path, key="data")
 
-      # import matplotlib.pyplot as plt
-      # print(waveform.full_sample_range)
-      # plt.plot(waveform.data)
-      # plt.show()
-      # exit()
+def write_tier_1_cache(t2_file_name, output_keys):
+  #stores the cache key of each output column (see TierOneProcessorList.GetOutputKeys)
+  with h5py.File(t2_file_name, "a") as f:
+    if "tier2_cache" in f: del f["tier2_cache"]
+    group = f.create_group("tier2_cache")
+    for name, key in output_keys.items():
+      group.attrs["columns/"+name] = key
 
-      # try:
-        #convert the stored waveform (which is int16) to a float, throw it to the processorList
-      processorList.Reset( wf_data )
-      try:
-        processorList.param_dict["fs_start"] = waveform.full_sample_range[0]
-        processorList.param_dict["fs_end"] = waveform.full_sample_range[1]
-      except AttributeError:
-        #in case it isn't a multisampled waveform object
-        pass
-
-      paramDict = processorList.Process(event_data)
-      appended_data.append(paramDict)
-      # except Exception as e:
-      #   print(e)
-      #   import matplotlib.pyplot as plt
-      #   plt.plot(wf_data)
-      #   plt.show()
-      #   exit()
+def read_tier_1_cache(t2_file_name):
+  '''
+  Returns the cache keys stored in a t2 file, as a dict of key: column name (empty if there aren't any)
+  '''
+  try:
+    with h5py.File(t2_file_name, "r") as f:
+      if "tier2_cache" not in f: return {}
+      attrs = dict(f["tier2_cache"].attrs)
+  except OSError as e:
+    print("Couldn't read cache keys from {} (Exception: {})".format(t2_file_name, e))
+    return {}
+  return {str(key): name[len("columns/"):] for name, key in attrs.items() if name.startswith("columns/")}
+
+def get_n_t2_rows(t2_file_name):
+  with pd.HDFStore(t2_file_name, "r") as store:
+    return store.get_storer("data").nrows if "data" in store else 0
+
+def read_cached_outputs(t2_file_name, cached_columns, start, stop):
+  '''
+  Reads rows [start, stop) of the cached columns from a t2 file, as a dict of output name: values
+  '''
+  if t2_file_name is None or len(cached_columns) == 0: return {}
+  df = pd.read_hdf(t2_file_name, "data", start=start, stop=stop, columns=list(set(cached_columns.values())))
+  return {name: df[column].values for name, column in cached_columns.items()}
 
-  if verbose: update_progress(1)
+_tier_1_worker_state = {}
 
-  verbose=True
-  if verbose: print("Creating dataframe for file {}...".format(filename))
-  df_data = pd.DataFrame(appended_data)
+def _init_tier_1_worker(filename, digitizer_list, processorList, vectorize, cache_path=None, cached_columns={}, row_offsets=None):
+  _tier_1_worker_state.update(filename=filename, digitizer_list=digitizer_list, processorList=processorList, vectorize=vectorize,
+                              cache_path=cache_path, cached_columns=cached_columns, row_offsets=row_offsets)
 
-  t2_file_name = output_file_string+'_run{}.h5'.format(runNumber)
-  t2_path = os.path.join(output_dir,t2_file_name)
+def _process_tier_1_chunk(chunk):
+  '''
+  Worker for parallel Tier 1 processing: reads rows [start, stop) of a digitizer's events and processes them
+  '''
+  i, start, stop = chunk
+  state = _tier_1_worker_state
+  digitizer = state["digitizer_list"][i]
+  cached = {}
+  if state["cache_path"] is not None:
+    row = state["row_offsets"][i]
+    cached = read_cached_outputs(state["cache_path"], state["cached_columns"], row+start, row+stop)
+  return process_tier_1_chunk(digitizer, digitizer.read_file(state["filename"], start, stop), state["processorList"], state["vectorize"], cached)
+
+def process_tier_1_chunk(digitizer, event_df, processorList, vectorize=True, cached={}):
+  '''
+  Runs the processor list over a dataframe of events read from a t1 file, returning a dataframe of the results.
+  cached: dict of the events' values for the processorList's cached_outputs
+  '''
+  if vectorize:
+    waveforms, param_columns = digitizer.parse_event_block(event_df)
+    param_columns.update(cached)
+    columns = processorList.ProcessBatch(waveforms, event_df, param_columns)
+    return pd.DataFrame({name: list(values) if np.ndim(values) > 1 else values for name, values in columns.items()})
+
+  appended_data = []
+  for i, (index, event_data) in enumerate(event_df.iterrows()):
+    waveform = digitizer.parse_event_data(event_data)
+    #Currently, I'll just mandate that we only process full waveform data i guess
+    wf_data = waveform.get_waveform()
+
+    #convert the stored waveform (which is int16) to a float, throw it to the processorList
+    processorList.Reset( wf_data )
+    try:
+      processorList.param_dict["fs_start"] = waveform.full_sample_range[0]
+      processorList.param_dict["fs_end"] = waveform.full_sample_range[1]
+    except AttributeError:
+      #in case it isn't a multisampled waveform object
+      pass
+    for name, values in cached.items(): processorList.param_dict[name] = values[i]
 
-  if verbose: print("Writing {} to tier1 file {}...".format(filename, t2_path))
+    paramDict = processorList.Process(event_data)
+    appended_data.append(paramDict)
 
-  df_data.to_hdf(t2_path, key="data", format='table', mode='w', data_columns=True)
-  return df_data
+  return pd.DataFrame(appended_data)
 
 
 class TierOneProcessorList():
@@ -252,6 +738,16 @@ class TierOneProcessorList():
     #t1 fields to make available for t2 processors
     self.t0_list = ["channel", "energy", "timestamp"]
 
+    #keep every intermediate waveform in waveform_dict after processing (for looking at them),
+    #instead of freeing each one once the last processor using it has run
+    self.keep_waveforms = False
+
+    #outputs whose values are handed in as parameters (from a cache), so the processors making them don't run
+    self.cached_outputs = set()
+
+    self.plan = None
+    self.plan_key = None
+
   def Reset(self, waveform):
     self.param_dict = {}
     # print("TierOneProcessorList.reset() not implemented")
@@ -259,31 +755,163 @@ class TierOneProcessorList():
     self.waveform_dict = {"waveform":waveform}
 
   def Process(self, t0_row):
-    for processor in self.list:
-      #Parse out the t0 fields
-      for name in self.t0_list: self.param_dict[name] = t0_row[name]
+    #Parse out the t0 fields
+    for name in self.t0_list: self.param_dict[name] = t0_row[name]
 
-      processor.replace_args(self.param_dict)
+    self.RunPlan(self.Compile(self.param_dict.keys()))
+    return self.param_dict
 
-      #TODO: what if output is None??
+  def Compile(self, param_names):
+    '''
+    Turns the processor list into an execution plan, given the names of the parameters available
+    before any processor runs (the t0 fields, plus eg fs_start/fs_end).  This is done once, not per event:
+      - each processor's args are bound to parameter names up front (see Calculator.bind)
+      - names are checked: every input waveform has to be "waveform" or made by an earlier transform
+      - transforms whose output (directly or through other transforms) never reaches a calculator,
+        database lookup or t0 passer are dropped
+      - each intermediate waveform is freed as soon as the last processor reading it has run
+      - calculators, lookups and t0 passers whose outputs are all in cached_outputs are dropped (their
+        values have to be in the parameters), as are transforms only they needed
+    The plan is a list of (processor, names of waveforms to free after it), and is cached until
+    the parameter names or the processor list change.
+    '''
+    key = (tuple(param_names), tuple(id(processor) for processor in self.list), self.keep_waveforms, tuple(sorted(self.cached_outputs)))
+    if key == self.plan_key: return self.plan
+
+    #bind args and check names, in list order
+    param_names = set(param_names)
+    waveform_names = {"waveform"}
+    for processor in self.list:
+      processor.bind(param_names)
+      if isinstance(processor, (Transformer, Calculator)) and processor.input_waveform_name not in waveform_names:
+        raise ValueError("{} reads waveform {}, which no earlier transform makes (there's {})".format(
+          processor.function.__name__, processor.input_waveform_name, ", ".join(sorted(waveform_names))))
+      if isinstance(processor, Transformer): waveform_names.add(processor.output_name)
+      else: param_names.update(processor.get_output_names())
+
+    #walk back through the list to find the transforms whose output gets used
+    live = []
+    needed_waveforms = set()
+    for processor in reversed(self.list):
+      if isinstance(processor, Transformer):
+        if processor.output_name not in needed_waveforms:
+          print("Skipping the {} transform: its output waveform {} is never used".format(processor.function.__name__, processor.output_name))
+          continue
+        needed_waveforms.discard(processor.output_name)
+      elif all(name in self.cached_outputs for name in processor.get_output_names()):
+        continue
+      if isinstance(processor, (Transformer, Calculator)): needed_waveforms.add(processor.input_waveform_name)
+      live.append(processor)
+    live.reverse()
+
+    #free each waveform after its last reader
+    plan = []
+    freed = set()
+    for processor in reversed(live):
+      to_free = []
+      if not self.keep_waveforms and isinstance(processor, (Transformer, Calculator)) and processor.input_waveform_name not in freed:
+        to_free.append(processor.input_waveform_name)
+        freed.add(processor.input_waveform_name)
+      if isinstance(processor, Transformer): freed.discard(processor.output_name)
+      plan.append((processor, to_free))
+    plan.reverse()
+
+    self.plan, self.plan_key = plan, key
+    return plan
+
+  def GetOutputKeys(self, source_key):
+    '''
+    Content-addressed cache keys for the outputs of the processor list.  A processor's key hashes its
+    function (see function_identity), its args, and the keys of whatever it reads: parameters made by
+    earlier processors and its input waveform.  The raw waveform and t0 fields are keyed by source_key,
+    which should identify the t1 file.  So a key changes exactly when something that went into the output
+    did.  Transforms get keys (for their dependents), but only calculator/lookup/t0 passer outputs are
+    returned, as a dict of output name: key.  Keys don't depend on output names, so renaming an output
+    keeps its key.  Database lookups are keyed by function and args only, as if the database never changed.
+    '''
+    waveform_keys = {"waveform": source_key}
+    param_keys = {name: hash_token((source_key, name)) for name in self.t0_list}
+    output_keys = {}
+
+    def arg_tokens(args):
+      return tuple(sorted((arg, ("param", param_keys[val]) if isinstance(val, str) and val in param_keys else cache_token(val))
+                          for (arg, val) in iteritems(args)))
 
-      try: #if you can set a waveform, do it
-        processor.set_waveform(self.waveform_dict)
-      except AttributeError:
-        pass
+    for processor in self.list:
+      if isinstance(processor, Tier0Passer):
+        token = ("Tier0Passer", param_keys.get(processor.t0_name, hash_token((source_key, processor.t0_name))))
+      elif isinstance(processor, DatabaseLookup):
+        token = ("DatabaseLookup", source_key, function_identity(processor.function), arg_tokens(processor.perm_args))
+      else:
+        token = (type(processor).__name__, source_key, function_identity(processor.function), arg_tokens(processor.perm_args),
+                 waveform_keys.get(processor.input_waveform_name))
+      key = hash_token(token)
 
       if isinstance(processor, Transformer):
-        self.waveform_dict[processor.output_name] = processor.process()
+        waveform_keys[processor.output_name] = key
+        continue
+      for i, name in enumerate(processor.get_output_names()):
+        param_keys[name] = output_keys[name] = "{}:{}".format(key, i)
+    return output_keys
+
+  def RunPlan(self, plan, n_events=None):
+    '''
+    Runs a plan from Compile on waveform_dict/param_dict: one event at a time, or a block of n_events
+    '''
+    for processor, to_free in plan:
+      processor.set_args(self.param_dict)
+
+      if isinstance(processor, (Transformer, Calculator)):
+        processor.set_waveform(self.waveform_dict)
 
+      calc = processor.process() if n_events is None else processor.process_batch(n_events)
+      if isinstance(processor, Transformer):
+        self.waveform_dict[processor.output_name] = calc
       else:
-        output = processor.output_name
-        calc = processor.process()
-        if not isinstance(output, str) and len(output) > 1:
-          for i, out in enumerate(output):
+        outputs = processor.get_output_names()
+        if len(outputs) > 1:
+          for i, out in enumerate(outputs):
             self.param_dict[out] = calc[i]
-        else: self.param_dict[output] = calc
-
-    return self.param_dict
+        else: self.param_dict[outputs[0]] = calc
+
+      for name in to_free: del self.waveform_dict[name]
+
+  def ProcessBatch(self, waveforms, t0_columns, param_columns={}, block_size=64):
+    '''
+    Batched Reset + Process: runs the processors over a block of events at once, handing each
+    transform/calculator an (N, n_samples) block (see pygama.utils.batch_aware)
+      waveforms: 2-D array with one waveform per row, or a RaggedArray if they differ in length
+                 (events are then processed in groups of the same waveform length)
+      t0_columns: dict or dataframe of t1 columns, for the fields in t0_list
+      param_columns: dict of per-event parameters that come with the waveforms (eg fs_start, fs_end)
+      block_size: events handed to the processors at a time.  Blocks that fit in cache are faster than
+                  huge ones (most transforms are a few passes over the block), small ones pay more python overhead
+    Returns a dict of columns: the batched equivalent of the dicts Process returns
+    '''
+    if isinstance(waveforms, RaggedArray): groups = list(waveforms.iter_groups())
+    else: groups = [(np.arange(len(waveforms)), waveforms)]
+    groups = [(indices[i:i+block_size], block[i:i+block_size]) for indices, block in groups for i in range(0, len(indices), block_size)]
+
+    group_params = []
+    for indices, block in groups:
+      self.param_dict = {name: np.asarray(values)[indices] for name, values in param_columns.items()}
+      for name in self.t0_list: self.param_dict[name] = np.asarray(t0_columns[name])[indices]
+      self.waveform_dict = {"waveform":block}
+
+      self.RunPlan(self.Compile(self.param_dict.keys()), len(indices))
+      group_params.append(self.param_dict)
+
+    if len(groups) == 1: return self.param_dict
+    if len(groups) == 0: return {}
+
+    columns = {name: np.concatenate([np.asarray(params[name]) for params in group_params]) for name in group_params[0]}
+
+    #put the events back in their original order
+    indices = np.concatenate([indices for indices, block in groups])
+    if np.any(np.diff(indices) < 0):
+      order = np.argsort(indices, kind="stable")
+      columns = {name: values[order] for name, values in columns.items()}
+    return columns
 
   def AddTransform(self, function, args={}, input_waveform="waveform", output_waveform=None):
     self.list.append( Transformer(function, args, input_waveform, output_waveform) )
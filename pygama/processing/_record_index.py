@@ -0,0 +1,169 @@
+import os
+import numpy as np
+
+from ._header_parser import parse_header
+from ._record_scan import scan_record_headers
+
+__all__ = ["RECORD_DTYPE", "QUARANTINE_DTYPE", "build_record_index", "get_record_index", "split_record_index", "map_raw_file", "get_record_data", "quarantine_records"]
+
+#one row per ORCA record: byte offset of the record (including its orca header word),
+#length of the record in bytes and the data id from the record header
+RECORD_DTYPE = np.dtype([("offset", np.uint64), ("length", np.uint32), ("data_id", np.uint32)])
+
+#records (or stretches of the file) that were skipped, and why
+QUARANTINE_DTYPE = np.dtype([("offset", np.uint64), ("length", np.uint32), ("data_id", np.uint32), ("reason", "S32")])
+
+INDEX_CACHE_EXT = ".idx.npz"
+
+def map_raw_file(filename):
+    '''
+    Memory-maps an ORCA file read-only as a flat array of bytes
+    '''
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(filename, dtype=np.uint8, mode="r")
+
+def get_record_data(raw_data, record):
+    '''
+    Returns a zero-copy view of the data of a record (everything after the 4-byte orca record header)
+        raw_data: the array returned by map_raw_file
+        record: a row of a record index
+    '''
+    offset = int(record["offset"])
+    return raw_data[offset+4 : offset+int(record["length"])]
+
+def build_record_index(filename, header_length=None, start=None, verbose=False, valid_ids=None, return_quarantine=False):
+    '''
+    Walks the records of an ORCA file in a single pass and returns a RECORD_DTYPE array
+        filename: path to an orca data file
+        header_length: length of the orca header in longs (the first thing parse_header returns).  Parsed from the file if None
+        start: byte offset to start scanning at (must sit on a record boundary).  Defaults to right after the header
+        valid_ids: the data ids from the header.  If given, they're used to tell corrupt record headers from real ones
+        return_quarantine: also return a QUARANTINE_DTYPE array of the stretches of the file that were skipped
+    Only the first word of each record is touched. A record that runs past the end of the file
+    (ie, one that is still being written) is left out of the index.
+    If a record header is corrupt (zero length, or with valid_ids, an unknown data id that isn't followed
+    by a sensible record header), the scan resyncs on the next word that looks like the start of a
+    good record, and the bytes in between get quarantined.
+    '''
+    if start is None:
+        if header_length is None:
+            header_length, _, _ = parse_header(filename)
+        start = header_length*4
+
+    n_words = os.path.getsize(filename) // 4
+    pos = int(start) // 4
+    if pos >= n_words:
+        index, quarantine = np.zeros(0, dtype=RECORD_DTYPE), np.zeros(0, dtype=QUARANTINE_DTYPE)
+        return (index, quarantine) if return_quarantine else index
+
+    word_array = np.memmap(filename, dtype=np.uint32, mode="r", shape=(n_words,))
+    valid_ids = None if valid_ids is None else set(int(id) for id in valid_ids)
+
+    def is_header(pos):
+        #does the word at pos look like the start of a complete record?  (the end of the file counts too)
+        if pos == n_words: return True
+        record_length = int(word_array[pos]) & 0x3FFFF
+        return record_length > 0 and pos + record_length <= n_words and (valid_ids is None or (int(word_array[pos]) >> 18) in valid_ids)
+
+    #the header chasing is compiled (see _record_scan.pyx): it runs up to the end of the file or a corrupt
+    #record header, and only then do we come back here to resync
+    pieces = []
+    quarantine = []
+    while True:
+        offsets, lengths, data_ids, pos, reason = scan_record_headers(word_array, pos, valid_ids)
+        pieces.append((offsets, lengths, data_ids))
+        if reason is None: break
+
+        next_pos = _resync(word_array, pos+1, valid_ids, is_header)
+        print("Found a corrupt record ({}) at byte {}; skipping {} bytes to the next good record.".format(reason, pos*4, (next_pos-pos)*4))
+        quarantine.append((pos*4, (next_pos-pos)*4, int(word_array[pos]) >> 18, reason))
+        pos = next_pos
+
+    index = np.zeros(sum(len(offsets) for offsets, _, _ in pieces), dtype=RECORD_DTYPE)
+    index["offset"] = np.concatenate([offsets for offsets, _, _ in pieces])
+    index["length"] = np.concatenate([lengths for _, lengths, _ in pieces])
+    index["data_id"] = np.concatenate([data_ids for _, _, data_ids in pieces])
+    del word_array
+
+    if verbose: print("Indexed {} records in {}".format(len(index), filename))
+    if return_quarantine:
+        return index, np.array(quarantine, dtype=QUARANTINE_DTYPE)
+    return index
+
+def _resync(word_array, pos, valid_ids, is_header, block_words=1<<20):
+    '''
+    Returns the position of the first word at or after pos that looks like a record header, and is followed
+    by another one (or the end of the file).  Returns the end of the file if there isn't one.
+    '''
+    n_words = len(word_array)
+    valid_id_array = None if valid_ids is None else np.array(sorted(valid_ids), dtype=np.uint32)
+
+    while pos < n_words:
+        block = np.asarray(word_array[pos:pos+block_words])
+        block_lengths = block & 0x3FFFF
+        candidates = (block_lengths > 0) & (pos + np.arange(len(block)) + block_lengths <= n_words)
+        if valid_id_array is not None:
+            candidates &= np.isin(block >> 18, valid_id_array)
+
+        for i in np.flatnonzero(candidates).tolist():
+            if is_header(pos + i + int(block_lengths[i])):
+                return pos + i
+        pos += len(block)
+
+    return n_words
+
+def get_record_index(filename, header_length=None, use_cache=True, verbose=False, valid_ids=None, return_quarantine=False):
+    '''
+    Returns the record index for an ORCA file, using (and refreshing) the cache file
+    <filename>.idx.npz that sits next to the raw file.  The cache is only trusted if the
+    size and modification time of the raw file (and the valid_ids) still match.
+    See build_record_index for valid_ids and return_quarantine.
+    '''
+    cache_name = filename + INDEX_CACHE_EXT
+    stat = os.stat(filename)
+    cache_ids = np.array(sorted(valid_ids) if valid_ids is not None else [-1], dtype=np.int64)
+
+    if use_cache and os.path.isfile(cache_name):
+        try:
+            with np.load(cache_name) as cache:
+                if (int(cache["file_size"]) == stat.st_size and int(cache["mtime_ns"]) == stat.st_mtime_ns
+                    and "valid_ids" in cache and np.array_equal(cache["valid_ids"], cache_ids)):
+                    if verbose: print("Loaded record index from {}".format(cache_name))
+                    return (cache["index"], cache["quarantine"]) if return_quarantine else cache["index"]
+        except Exception as e:
+            print("Failed to load record index cache {} (Exception: {})".format(cache_name, e))
+
+    index, quarantine = build_record_index(filename, header_length, verbose=verbose, valid_ids=valid_ids, return_quarantine=True)
+
+    if use_cache:
+        try:
+            with open(cache_name, "wb") as f:
+                np.savez(f, index=index, quarantine=quarantine, valid_ids=cache_ids, file_size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        except OSError as e:
+            #raw data directories are often read-only.  not a big deal.
+            if verbose: print("Couldn't write record index cache {} (Exception: {})".format(cache_name, e))
+
+    return (index, quarantine) if return_quarantine else index
+
+def quarantine_records(records, reason):
+    '''
+    Returns QUARANTINE_DTYPE rows for some rows of a record index, all with the same reason
+    '''
+    quarantine = np.zeros(len(records), dtype=QUARANTINE_DTYPE)
+    for name in RECORD_DTYPE.names:
+        quarantine[name] = records[name]
+    quarantine["reason"] = reason
+    return quarantine
+
+def split_record_index(index, n_chunks):
+    '''
+    Splits a record index into at most n_chunks contiguous chunks holding about the same number of bytes
+    Returns a list of (start, stop) positions in the index
+    '''
+    if len(index) == 0:
+        return []
+    cum_bytes = np.cumsum(index["length"], dtype=np.uint64)
+    targets = cum_bytes[-1] * np.arange(1, n_chunks, dtype=np.float64) / n_chunks
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(cum_bytes, targets, side="right"), [len(index)])))
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
@@ -0,0 +1,82 @@
+cimport cython
+cimport numpy as np
+
+import numpy as np
+
+#ways a scan can stop, and what build_record_index quarantines a stretch as
+cdef enum:
+  SCAN_END = 0 #end of the file (or an incomplete record at the end)
+  SCAN_ZERO_LENGTH = 1
+  SCAN_BAD_HEADER = 2
+STOP_REASONS = [None, "zero length", "bad record header"]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint is_header(const np.uint32_t[:] words, Py_ssize_t pos, const np.uint8_t[:] valid_mask, bint check_ids) noexcept nogil:
+  #does the word at pos look like the start of a complete record?  (the end of the file counts too)
+  cdef Py_ssize_t n_words = words.shape[0]
+  if pos == n_words: return True
+  cdef np.uint32_t record_length = words[pos] & 0x3FFFF
+  return record_length > 0 and pos + record_length <= n_words and (not check_ids or valid_mask[words[pos] >> 18])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t scan(const np.uint32_t[:] words, Py_ssize_t pos, const np.uint8_t[:] valid_mask, bint check_ids,
+                     np.uint64_t[:] offsets, np.uint32_t[:] lengths, np.uint32_t[:] data_ids, bint fill, Py_ssize_t* stop):
+  #walks record headers from pos until the end of the file or a corrupt header.  Returns why it stopped, with
+  #the number of records in stop[0] (filled in, if fill) and the word it stopped at in stop[1]
+  cdef Py_ssize_t n_words = words.shape[0], n_records = 0
+  cdef np.uint32_t head, record_length, data_id
+  cdef int status = SCAN_END
+  with nogil:
+    while pos < n_words:
+      head = words[pos]
+      record_length = head & 0x3FFFF #in longs
+      data_id = head >> 18
+
+      if record_length == 0:
+        status = SCAN_ZERO_LENGTH
+        break
+      if check_ids and not valid_mask[data_id] and not (pos + record_length <= n_words and is_header(words, pos + record_length, valid_mask, check_ids)):
+        status = SCAN_BAD_HEADER
+        break
+      if pos + record_length > n_words:
+        #incomplete record at the end of the file
+        break
+
+      if fill:
+        offsets[n_records] = pos*4
+        lengths[n_records] = record_length*4
+        data_ids[n_records] = data_id
+      n_records += 1
+      pos += record_length
+  stop[0], stop[1] = n_records, pos
+  return status
+
+def scan_record_headers(const np.uint32_t[:] words, Py_ssize_t pos, valid_ids=None):
+  '''
+  Walks the ORCA record headers in words (the file as uint32s) starting at word pos, up to the end of the file
+  or the first corrupt header (zero length, or with valid_ids, an unknown data id that isn't followed by a
+  sensible record header).  A record that runs past the end of the file is left out.
+  Returns the offsets, lengths (both in bytes) and data ids of the records, the word it stopped at, and why
+  (None at the end of the file, else the reason the header there is corrupt).  The headers are walked twice:
+  once to count the records, once to fill them in.
+  '''
+  cdef bint check_ids = valid_ids is not None
+  cdef np.uint8_t[:] valid_mask = np.zeros(1 << 14, dtype=np.uint8)
+  if check_ids:
+    for data_id in valid_ids:
+      if 0 <= data_id < (1 << 14): valid_mask[data_id] = 1
+
+  cdef Py_ssize_t stop[2]
+  offsets = np.zeros(0, dtype=np.uint64)
+  lengths = np.zeros(0, dtype=np.uint32)
+  data_ids = np.zeros(0, dtype=np.uint32)
+  scan(words, pos, valid_mask, check_ids, offsets, lengths, data_ids, False, stop)
+
+  offsets = np.zeros(stop[0], dtype=np.uint64)
+  lengths = np.zeros(stop[0], dtype=np.uint32)
+  data_ids = np.zeros(stop[0], dtype=np.uint32)
+  status = scan(words, pos, valid_mask, check_ids, offsets, lengths, data_ids, True, stop)
+
+  return offsets, lengths, data_ids, stop[1], STOP_REASONS[status]
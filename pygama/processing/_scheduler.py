@@ -0,0 +1,150 @@
+import os, time, traceback
+from multiprocessing import Process, Pipe, cpu_count
+from multiprocessing.connection import wait
+import numpy as np
+import h5py
+
+from ._header_parser import get_header_info
+
+__all__ = ["RunScheduler", "estimate_tier_0_memory", "estimate_tier_1_memory"]
+
+def get_physical_memory_mb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e6
+    except (ValueError, OSError, AttributeError):
+        return np.inf
+
+def estimate_tier_0_memory(filename, flush_mb=200, num_threads=1):
+    '''
+    Rough peak memory (MB) of ProcessTier0 on a raw file, from its size and header.  The raw file is memory
+    mapped, so it only counts through the record index (16 bytes per record, assuming records of at least
+    256 bytes).  Each decoder buffers up to flush_mb before writing (up to twice that while its buffers
+    double, plus a copy while writing).  Parallel chunk workers each have their own decoders.
+    If the header can't be read, one decoder is assumed (processing the file will fail and say why).
+    '''
+    file_mb = os.path.getsize(filename) / 1e6
+    try:
+        n_decoders = len(set(get_header_info(filename)["decoder_for_id"].values()))
+    except Exception:
+        n_decoders = 1
+    return 150 + file_mb/16 + num_threads*(2*n_decoders + 1)*flush_mb
+
+def estimate_tier_1_memory(filename, chunk_size=10000, num_threads=1):
+    '''
+    Rough peak memory (MB) of ProcessTier1 on a t1 file, from the waveform length each decoder's events have:
+    a chunk of waveforms as read (int16) and as processed (float64 plus a working copy), for each worker.
+    Files written without the appendable layout get read whole, so they count by file size.
+    '''
+    file_mb = os.path.getsize(filename) / 1e6
+    chunk_mb = 0
+    with h5py.File(filename, "r") as f:
+        for group in f.keys():
+            if not group.endswith("_arrays"): continue
+            for name, dset in f[group].items():
+                if name.endswith("_offsets"): continue
+                if dset.ndim == 2: n_samples = dset.shape[1]
+                else: n_samples = dset.shape[0] / max(1, f[group][name+"_offsets"].shape[0])
+                chunk_mb = max(chunk_mb, chunk_size * n_samples * (dset.dtype.itemsize + 16) / 1e6)
+        if chunk_mb == 0: chunk_mb = 4*file_mb
+    return 150 + num_threads*chunk_mb
+
+def _run_job(function, args, kwargs, conn):
+    #runs in the job's own process: sends back None, or the traceback if it failed
+    try:
+        function(*args, **kwargs)
+        conn.send(None)
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        conn.close()
+
+class RunScheduler():
+    '''
+    Runs a batch of jobs (eg, one per run) each in its own process, as many at once as there are workers and
+    as fit in a memory budget.  Jobs are started biggest first, and smaller ones fill the room left over.
+    A job that fails (an exception, or its process dying, eg killed for running out of memory) is reported
+    and the rest carry on.  Progress (runs done, throughput and ETA) is printed as each job finishes.
+        n_workers: most jobs running at once (default: number of CPUs)
+        memory_budget_mb: total memory estimate of the jobs running at once (default: 80% of physical memory).
+                          A job bigger than the budget is run on its own.
+    '''
+    def __init__(self, n_workers=None, memory_budget_mb=None):
+        self.n_workers = cpu_count() if n_workers is None else max(1, int(n_workers))
+        self.memory_budget_mb = 0.8*get_physical_memory_mb() if memory_budget_mb is None else memory_budget_mb
+        self.jobs = []
+
+    def add_job(self, name, function, args=(), kwargs={}, memory_mb=0, size_mb=0):
+        '''
+        name: what to call the job in the output
+        function, args, kwargs: what to run
+        memory_mb: estimated peak memory of the job
+        size_mb: how much data it processes, for the throughput and ETA
+        '''
+        self.jobs.append({"name": name, "function": function, "args": args, "kwargs": kwargs,
+                          "memory_mb": memory_mb, "size_mb": size_mb})
+
+    def run(self):
+        '''
+        Runs all the jobs.  Returns a dict of name: None if the job succeeded, or the error if it failed
+        '''
+        pending = sorted(self.jobs, key=lambda job: job["memory_mb"], reverse=True)
+        running = {} #process sentinel: (job, process, connection, start time)
+        results = {}
+        total_mb = sum(job["size_mb"] for job in self.jobs)
+        done_mb = 0
+        start_time = time.time()
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                #start whatever fits
+                used_mb = sum(job["memory_mb"] for job, _, _, _ in running.values())
+                for job in list(pending):
+                    if len(running) >= self.n_workers: break
+                    if len(running) > 0 and used_mb + job["memory_mb"] > self.memory_budget_mb: continue
+                    if job["memory_mb"] > self.memory_budget_mb:
+                        print("Warning: {} needs about {:.0f} MB, more than the {:.0f} MB budget.  Running it on its own".format(
+                              job["name"], job["memory_mb"], self.memory_budget_mb))
+
+                    pending.remove(job)
+                    conn, child_conn = Pipe(duplex=False)
+                    process = Process(target=_run_job, args=(job["function"], job["args"], job["kwargs"], child_conn))
+                    process.start()
+                    child_conn.close()
+                    running[process.sentinel] = (job, process, conn, time.time())
+                    used_mb += job["memory_mb"]
+                    if job["memory_mb"] > self.memory_budget_mb: break
+
+                #wait for one to finish
+                for sentinel in wait(list(running.keys())):
+                    job, process, conn, job_start = running.pop(sentinel)
+                    process.join()
+                    error = None
+                    try:
+                        if conn.poll(): error = conn.recv()
+                        else: error = "its process died (exit code {})".format(process.exitcode)
+                    except EOFError:
+                        error = "its process died (exit code {})".format(process.exitcode)
+                    conn.close()
+
+                    results[job["name"]] = error
+                    done_mb += job["size_mb"]
+                    self.print_progress(job, error, time.time() - job_start, results, done_mb, total_mb, time.time() - start_time)
+        finally:
+            for job, process, conn, _ in running.values():
+                process.terminate()
+                process.join()
+
+        n_failed = sum(error is not None for error in results.values())
+        print("Finished {} jobs in {:.1f} s: {} failed{}".format(len(results), time.time() - start_time, n_failed,
+              "" if n_failed == 0 else " ({})".format(", ".join(str(name) for name, error in results.items() if error is not None))))
+        return results
+
+    def print_progress(self, job, error, job_time, results, done_mb, total_mb, elapsed):
+        if error is None: print("{} done in {:.1f} s".format(job["name"], job_time))
+        else: print("{} FAILED after {:.1f} s: {}".format(job["name"], job_time, error.strip().splitlines()[-1]))
+
+        rate = done_mb / elapsed if elapsed > 0 else 0
+        eta = (total_mb - done_mb) / rate if rate > 0 else np.nan
+        n_failed = sum(e is not None for e in results.values())
+        print("   {}/{} jobs finished ({} failed), {:.1f} MB/s, ETA {}".format(len(results), len(self.jobs), n_failed, rate,
+              time.strftime("%H:%M:%S", time.gmtime(eta)) if np.isfinite(eta) else "unknown"))
@@ -0,0 +1,57 @@
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+__all__ = ["TimingReport"]
+
+class TimingReport():
+    '''
+    Keeps track of wall time, records handled, bytes handled and records skipped for each stage of
+    processing (eg "header", "decode/ORGretina4MWaveformDecoder", "write/ORGretina4MWaveformDecoder").
+    Stages are added the first time they show up.  Reports from different processes can be merged.
+    '''
+    columns = ["wall_time", "records", "bytes", "skipped"]
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, wall_time=0., records=0, bytes=0, skipped=0):
+        if stage not in self.stages:
+            self.stages[stage] = {name: 0 for name in self.columns}
+        values = self.stages[stage]
+        values["wall_time"] += wall_time
+        values["records"] += int(records)
+        values["bytes"] += int(bytes)
+        values["skipped"] += int(skipped)
+
+    @contextmanager
+    def timer(self, stage, records=0, bytes=0, skipped=0):
+        '''
+        Adds the time spent in a with block (and the given counts) to a stage
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, records, bytes, skipped)
+
+    def merge(self, other):
+        for stage, values in other.stages.items():
+            self.add(stage, **values)
+
+    def to_df(self):
+        '''
+        Returns the report as a dataframe indexed by stage, with throughput columns added
+        '''
+        df = pd.DataFrame.from_dict(self.stages, orient="index", columns=self.columns)
+        df.index.name = "stage"
+        wall_time = df["wall_time"].where(df["wall_time"] > 0)
+        df["records_per_s"] = (df["records"] / wall_time).fillna(0)
+        df["MB_per_s"] = (df["bytes"] / 1e6 / wall_time).fillna(0)
+        return df
+
+    def to_file(self, file_name, key):
+        self.to_df().to_hdf(file_name, key=key, mode='a')
+
+    def print_report(self):
+        print(self.to_df().to_string(float_format=lambda x: "%.3f" % x))
@@ -1,6 +1,83 @@
 from future.utils import iteritems
-
-#Classes that wrap functional implementations of calculators or transformers
+import hashlib, inspect, os, sys
+import numpy as np
+
+from ..utils import is_batch_aware
+from ..decoders.buffers import RaggedArray
+
+def process_rows(function, input_wfs, args, event_args, n_events=None):
+    '''
+    Per-event fallback for batched processing: calls function on each row of input_wfs (a 2-D block
+    or a RaggedArray; None to call it without a waveform n_events times), with the args named in
+    event_args (length-N arrays) indexed by event.  Returns the list of outputs.
+    '''
+    outputs = []
+    for i in range(len(input_wfs) if input_wfs is not None else n_events):
+        row_args = {arg: (val[i] if arg in event_args else val) for (arg, val) in iteritems(args)}
+        if input_wfs is None: outputs.append(function(**row_args))
+        else: outputs.append(function(input_wfs[i], **row_args))
+    return outputs
+
+def stack_waveforms(outputs):
+    #stacks per-event output waveforms into a block (or a RaggedArray if their lengths differ)
+    if len(set(len(wf) for wf in outputs)) > 1:
+        return RaggedArray.from_rows(outputs)
+    return np.array(outputs)
+
+def split_args(args, param_names):
+    '''
+    Splits a processor's args into the ones passed as given and the ones filled in from param_dict:
+    string values naming a parameter (a t0 field or an earlier calculator's output).
+    Returns (static_args, bound_args), bound_args mapping arg to parameter name
+    '''
+    static_args, bound_args = {}, {}
+    for (arg, val) in iteritems(args):
+      if isinstance(val, str) and val in param_names: bound_args[arg] = val
+      else: static_args[arg] = val
+    return static_args, bound_args
+
+def function_identity(function):
+    '''
+    What identifies a function when caching its outputs: its module and name, plus its bytecode, constants and
+    default argument values for python functions, or for compiled ones (eg from a cython module) when the module
+    was built.  So editing a processor function or its defaults (or rebuilding its module) invalidates its cached
+    outputs.  The functions it calls aren't covered: after editing a helper (eg baseline_fit_matrix for
+    fit_baseline), rerun without incremental (or delete the t2 file).
+    '''
+    module = getattr(function, "__module__", None)
+    identity = (module, getattr(function, "__qualname__", getattr(function, "__name__", None)))
+    if inspect.isfunction(function):
+        return identity + (code_token(function.__code__), cache_token(function.__defaults__), cache_token(function.__kwdefaults__))
+    module_file = getattr(sys.modules.get(module), "__file__", None)
+    if module_file is not None and os.path.isfile(module_file):
+        return identity + (os.stat(module_file).st_mtime_ns,)
+    return identity
+
+def code_token(code):
+    #bytecode and constants, recursing into nested code objects (whose repr would have an address in it)
+    return (code.co_code, tuple(code_token(c) if inspect.iscode(c) else cache_token(c) for c in code.co_consts))
+
+def cache_token(value):
+    '''
+    A repr-able stand-in for an argument value, for hashing into a cache key.  Unlike repr, it covers every
+    element of an array, and identifies functions by function_identity (not by address)
+    '''
+    if isinstance(value, np.ndarray):
+        return ("ndarray", value.dtype.str, value.shape, hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(cache_token(v) for v in value)
+    if isinstance(value, dict):
+        return ("dict",) + tuple(sorted((repr(k), cache_token(v)) for k, v in value.items()))
+    if callable(value):
+        return ("function",) + function_identity(value)
+    return repr(value)
+
+def hash_token(token):
+    return hashlib.sha1(repr(token).encode()).hexdigest()
+
+#Classes that wrap functional implementations of calculators or transformers.
+#bind() works out once (for a given set of parameter names) which args come from param_dict, and set_args()
+#then fills them in for each event or block.  replace_args() does both.
 class Calculator():
   def __init__(self, function, args={}, input_waveform="waveform",  output_name=None):
     self.function = function
@@ -8,22 +85,41 @@ class Calculator():
     self.input_waveform_name = input_waveform
     self.output_name = output_name
 
+  def bind(self, param_names):
+    self.static_args, self.bound_args = split_args(self.perm_args, param_names)
+
+  def set_args(self, param_dict):
+    self.args = self.static_args.copy() #copy we'll actually pass to the function
+    for (arg, name) in iteritems(self.bound_args): self.args[arg] = param_dict[name]
+    self.event_args = self.bound_args.keys() #per-event arrays when batching
+
   def replace_args(self, param_dict):
     #check args list for string vals which match keys in param dict
-    self.args = self.perm_args.copy() #copy we'll actually pass to the function
-
-    for (arg, val) in iteritems(self.args):
-      if getattr(val, '__iter__', False):
-        self.args[arg] = val
-      elif val in param_dict.keys():
-        self.args[arg] = param_dict[val]
+    self.bind(param_dict.keys())
+    self.set_args(param_dict)
 
   def set_waveform(self, waveform_dict):
     self.input_wf = waveform_dict[self.input_waveform_name]
 
+  def get_output_names(self):
+    return [self.output_name] if isinstance(self.output_name, str) else list(self.output_name)
+
   def process(self):
     return self.function(self.input_wf, **self.args)
 
+  def process_batch(self, n_events=None):
+    '''
+    Runs the calculator on a block of waveforms.  Returns a length-N array, or for several
+    output names, a list of length-N arrays (one per output)
+    '''
+    if is_batch_aware(self.function) and not isinstance(self.input_wf, RaggedArray):
+      return self.function(self.input_wf, **self.args)
+
+    outputs = process_rows(self.function, self.input_wf, self.args, self.event_args)
+    if not isinstance(self.output_name, str) and len(self.output_name) > 1:
+      return [np.array([out[i] for out in outputs]) for i in range(len(self.output_name))]
+    return np.array(outputs)
+
 class Transformer():
   def __init__(self, function, args={}, input_waveform="waveform",  output_waveform=None):
     self.function = function
@@ -31,13 +127,18 @@ class Transformer():
     self.input_waveform_name = input_waveform
     self.output_name = output_waveform
 
+  def bind(self, param_names):
+    self.static_args, self.bound_args = split_args(self.perm_args, param_names)
+
+  def set_args(self, param_dict):
+    self.args = self.static_args.copy() #copy we'll actually pass to the function
+    for (arg, name) in iteritems(self.bound_args): self.args[arg] = param_dict[name]
+    self.event_args = self.bound_args.keys() #per-event arrays when batching
+
   def replace_args(self, param_dict):
     #check args list for string vals which match keys in param dict
-    self.args = self.perm_args.copy() #copy we'll actually pass to the function
-
-    for (arg, val) in iteritems(self.args):
-      if val in param_dict.keys():
-        self.args[arg] = param_dict[val]
+    self.bind(param_dict.keys())
+    self.set_args(param_dict)
 
   def set_waveform(self, waveform_dict):
     self.input_wf = waveform_dict[self.input_waveform_name]
@@ -45,31 +146,67 @@ class Transformer():
   def process(self):
     return self.function(self.input_wf, **self.args)
 
+  def process_batch(self, n_events=None):
+    '''
+    Runs the transform on a block of waveforms, returning the block of output waveforms
+    '''
+    if is_batch_aware(self.function) and not isinstance(self.input_wf, RaggedArray):
+      return self.function(self.input_wf, **self.args)
+    return stack_waveforms(process_rows(self.function, self.input_wf, self.args, self.event_args))
+
 class DatabaseLookup():
   def __init__(self, function, args={}, output_name=None):
     self.function = function
     self.perm_args = args
     self.output_name = output_name
 
+  def bind(self, param_names):
+    self.static_args, self.bound_args = split_args(self.perm_args, param_names)
+
+  def set_args(self, param_dict):
+    self.args = self.static_args.copy() #copy we'll actually pass to the function
+    for (arg, name) in iteritems(self.bound_args): self.args[arg] = param_dict[name]
+    self.event_args = self.bound_args.keys() #per-event arrays when batching
+
   def replace_args(self, param_dict):
     #check args list for string vals which match keys in param dict
-    self.args = self.perm_args.copy() #copy we'll actually pass to the function
+    self.bind(param_dict.keys())
+    self.set_args(param_dict)
 
-    for (arg, val) in iteritems(self.args):
-      if val in param_dict.keys():
-        self.args[arg] = param_dict[val]
+  def get_output_names(self):
+    return [self.output_name] if isinstance(self.output_name, str) else list(self.output_name)
 
   def process(self):
     return self.function(**self.args)
 
+  def process_batch(self, n_events):
+    if is_batch_aware(self.function):
+      #a value for the whole block is repeated for each event (as its own writable array, not a broadcast view)
+      return np.full(n_events, self.function(**self.args))
+    return np.array(process_rows(self.function, None, self.args, self.event_args, n_events))
+
 class Tier0Passer():
   def __init__(self, t0_name, output_name=None):
     self.t0_name = t0_name
     if output_name is None: output_name = t0_name
     self.output_name = output_name
 
-  def replace_args(self, param_dict):
+  def bind(self, param_names):
+    if self.t0_name not in param_names:
+      raise ValueError("Can't pass {} through from tier 0: it isn't one of the t0 fields ({})".format(self.t0_name, ", ".join(param_names)))
+    self.bound_args = {"t0_value": self.t0_name}
+
+  def set_args(self, param_dict):
     self.t0_value = param_dict[self.t0_name]
 
+  def replace_args(self, param_dict):
+    self.set_args(param_dict)
+
+  def get_output_names(self):
+    return [self.output_name]
+
   def process(self):
     return self.t0_value
+
+  def process_batch(self, n_events):
+    return self.t0_value
@@ -1,21 +1,99 @@
+cimport cython
+from libc.math cimport fabs
+
 import numpy as np
 import pandas as pd
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy import signal
 
 from .filters import *
+from .utils import batch_aware
 
 #Silence harmless warning you get using savgol on old LAPACK
 import warnings
 warnings.filterwarnings(action="ignore", module="scipy", message="^internal gelsd")
 
+#All the transforms marked batch_aware work on a single waveform or on a 2-D block with one waveform
+#per row (along the last axis), and per-event parameters can then be given as arrays with one value per row.
+#Parameters that set the length of the output (eg rampTime) have to be the same for every row.
+
+def per_event(value):
+  #shapes a per-event parameter (scalar or one value per row) to broadcast against a waveform or block
+  value = np.asarray(value)
+  return value[..., np.newaxis] if value.ndim > 0 else value
+
+#Compiled kernels, for the transforms that are a loop over samples.  They take contiguous float64 rows and run
+#without the GIL.  Each does the same floating point operations in the same order as the python/numpy version
+#of the transform, so the results are identical; the python version still handles anything else (other
+#dtypes, out of range values, ...).
+
+cdef double pairwise_sum(const double* a, Py_ssize_t n) noexcept nogil:
+  #np.sum of n contiguous float64s: numpy's pairwise summation (8 accumulators, blocks of up to 128)
+  cdef Py_ssize_t i, n2
+  cdef double res
+  cdef double r[8]
+  if n < 8:
+    res = -0.0
+    for i in range(n): res += a[i]
+    return res
+  elif n <= 128:
+    for i in range(8): r[i] = a[i]
+    i = 8
+    while i < n - (n % 8):
+      r[0] += a[i]
+      r[1] += a[i+1]
+      r[2] += a[i+2]
+      r[3] += a[i+3]
+      r[4] += a[i+4]
+      r[5] += a[i+5]
+      r[6] += a[i+6]
+      r[7] += a[i+7]
+      i += 8
+    res = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+    while i < n:
+      res += a[i]
+      i += 1
+    return res
+  n2 = n // 2
+  n2 -= n2 % 8
+  return pairwise_sum(a, n2) + pairwise_sum(a + n2, n - n2)
+
+cdef inline double np_sum(const double* a, Py_ssize_t n) noexcept nogil:
+  #what np.sum(a[:n]) gives: the reduction starts from 0
+  return 0. + pairwise_sum(a, n)
+
+def as_float_rows(waveform):
+  '''
+  The waveform (or block) as C-contiguous float64 rows for the compiled kernels, or None if converting
+  would change the results (only float64 and small integer types convert exactly)
+  '''
+  if waveform.dtype != np.float64 and not (waveform.dtype.kind in "iu" and waveform.dtype.itemsize <= 4): return None
+  return np.ascontiguousarray(np.atleast_2d(waveform), dtype=np.float64)
+
 #Finds average baseline from first [samples] number of samples
+@batch_aware
 def remove_baseline(waveform, bl_0=0, bl_1=0):
-    return (waveform - (bl_0 + bl_1*np.arange(len(waveform))))
-
+    baseline = per_event(bl_1)*np.arange(waveform.shape[-1], dtype=np.result_type(waveform, bl_0, bl_1, np.float64))
+    baseline += per_event(bl_0)
+    if baseline.shape != waveform.shape:
+        #a block with one baseline for every row
+        return waveform - baseline
+    return np.subtract(waveform, baseline, out=baseline)
+
+@batch_aware
 def center(waveform, center_index, n_samples_before, n_samples_after):
-  return waveform[center_index - n_samples_before : center_index+ n_samples_after]
-
+  if waveform.ndim == 1 or np.ndim(center_index) == 0:
+    start = center_index - n_samples_before
+    return waveform[..., start : center_index+ n_samples_after]
+
+  start = np.asarray(center_index) - n_samples_before
+  stop = np.asarray(center_index) + n_samples_after
+  if np.any(start < 0) or np.any(stop > waveform.shape[-1]):
+    #slices running off the waveform come out different lengths (or wrap), so do it row by row
+    return np.array([center(wf, c, n_samples_before, n_samples_after) for wf, c in zip(waveform, center_index)])
+  return np.take_along_axis(waveform, start[:, np.newaxis] + np.arange(n_samples_before + n_samples_after), axis=-1)
+
+@batch_aware
 def trim_waveform(waveform, n_samples_before=None, n_samples_after=None):
   """Cut out the first n_samples_before and the last n_samples_after samples.
   If no values are supplied, you get the whole thing back 
@@ -26,64 +104,136 @@ def trim_waveform(waveform, n_samples_before=None, n_samples_after=None):
   else:
     end_index = -1*n_samples_after
 
-  return waveform[start_index : end_index]
+  return waveform[..., start_index : end_index]
 
+@batch_aware
 def interpolate(waveform, offset):
-  xp = np.arange(len(waveform))
-  x = xp[:-1] + offset
-  return np.interp(x,xp,waveform)
-
+  xp = np.arange(waveform.shape[-1])
+  x = xp[:-1] + per_event(offset)
+  if waveform.ndim == 1:
+    return np.interp(x,xp,waveform)
+
+  #np.interp, one row at a time: same arithmetic as its C loop so the results match exactly
+  x = np.broadcast_to(x, (waveform.shape[0], len(xp)-1))
+  j = np.clip(np.floor(x).astype(np.int64), 0, len(xp)-2)
+  y_j = np.take_along_axis(waveform, j, axis=-1)
+  slope = np.diff(waveform, axis=-1) / np.diff(xp)
+  out = np.take_along_axis(slope, j, axis=-1)*(x - j) + y_j
+  out = np.where(x == j, y_j, out)
+  out = np.where(x >= len(xp)-1, waveform[:, -1:], out)
+  return np.where(x < 0, waveform[:, :1], out)
+
+@batch_aware
 def savgol_filter(waveform, window_length=47, order=2):
-  return signal.savgol_filter(waveform, window_length, order)
-
+  filtered = signal.savgol_filter(waveform, window_length, order)
+  if waveform.ndim > 1:
+    #scipy fits the edges of all the rows in one least-squares solve, which rounds a little differently
+    #from fitting a single waveform, so redo the edges row by row (from just the edge windows)
+    half = window_length // 2
+    for wf, filtered_wf in zip(waveform, filtered):
+      filtered_wf[:half] = signal.savgol_filter(wf[:window_length], window_length, order)[:half]
+      filtered_wf[-half:] = signal.savgol_filter(wf[-window_length:], window_length, order)[-half:]
+  return filtered
+
+@batch_aware
 def pz_correct(waveform, rc, digFreq=100E6):
     ''' RC params are in us'''
+    if np.ndim(rc) > 0:
+      #one filter per distinct rc
+      pz_wf = np.empty(waveform.shape)
+      for rc_value in np.unique(rc):
+        rows = np.asarray(rc) == rc_value
+        pz_wf[rows] = pz_correct(waveform[rows], rc_value, digFreq)
+      return pz_wf
+
     #get the linear filter parameters.
     num, den = rc_decay(rc, digFreq)
 
     #reversing num and den does the inverse transform (ie, PZ corrects)
     return signal.lfilter(den, num, waveform)
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void trap_filter_rows(const double[:, ::1] wfs, double[:, ::1] out, const double[::1] baselines, Py_ssize_t ramp,
+                           Py_ssize_t flat, double decay_constant, double norm):
+  #trap_filter's numpy code, one pass per row: delayed-difference, then the running sums
+  cdef Py_ssize_t row, j, n = wfs.shape[1], start = 2*ramp + flat
+  cdef double b, d, x, f = 0., t, total = 0., f_0, trap_0
+  cdef const double* wf
+  with nogil:
+    for row in range(wfs.shape[0]):
+      wf = &wfs[row, 0]
+      b = baselines[row]
+      f_0 = wf[0] - b
+      trap_0 = (decay_constant + 1.)*(wf[0] - b)
+      for j in range(n):
+        d = b if j < ramp else wf[j-ramp]
+        d = d + (b if j < flat + ramp else wf[j-flat-ramp])
+        d = d + (b if j < start else wf[j-start])
+        x = wf[j] - d
+
+        if decay_constant != 0:
+          f = x + f_0 if j == 0 else f + x
+          t = (f + trap_0) + decay_constant*x if j == 0 else f + decay_constant*x
+        else:
+          t = x + trap_0 if j == 0 else x
+        total = t if j == 0 else total + t
+        if j >= start: out[row, j-start] = total / norm
+
+@batch_aware
 def trap_filter(waveform, rampTime=400, flatTime=200, decayTime=0., baseline = 0.):
     """ Apply a trap filter to a waveform. """
+    if waveform.dtype.kind in "iu":
+        #eg raw int16 digitizer waveforms
+        waveform = np.asarray(waveform, dtype=np.float64)
+
     decayConstant = 0.
     norm = rampTime
     if decayTime != 0:
         decayConstant = 1./(np.exp(1./decayTime) - 1)
         norm *= decayConstant
 
-    trapOutput = np.zeros_like(waveform)
-    fVector = np.zeros_like(waveform)
-    scratch = np.zeros_like(waveform)
-
-    fVector[0] = waveform[0] - baseline
-    trapOutput[0] = (decayConstant+1.)*(waveform[0] - baseline)
-
-    wf_minus_ramp = np.zeros_like(waveform)
-    wf_minus_ramp[:rampTime] = baseline
-    wf_minus_ramp[rampTime:] = waveform[:len(waveform)-rampTime]
-
-    wf_minus_ft_and_ramp = np.zeros_like(waveform)
-    wf_minus_ft_and_ramp[:(flatTime+rampTime)] = baseline
-    wf_minus_ft_and_ramp[(flatTime+rampTime):] = waveform[:len(waveform)-flatTime-rampTime]
-
-    wf_minus_ft_and_2ramp = np.zeros_like(waveform)
-    wf_minus_ft_and_2ramp[:(flatTime+2*rampTime)] = baseline
-    wf_minus_ft_and_2ramp[(flatTime+2*rampTime):] = waveform[:len(waveform)-flatTime-2*rampTime]
-
-    scratch = waveform - (wf_minus_ramp + wf_minus_ft_and_ramp + wf_minus_ft_and_2ramp )
-
+    n_samples = waveform.shape[-1]
+    if (waveform.dtype == np.float64 and 0 < rampTime and 0 <= flatTime and 2*rampTime+flatTime <= n_samples
+        and np.asarray(baseline).dtype.kind in "iuf"):
+        wfs = np.ascontiguousarray(np.atleast_2d(waveform))
+        baselines = np.ascontiguousarray(np.broadcast_to(baseline, wfs.shape[:1]), dtype=np.float64)
+        trapOutput = np.empty((wfs.shape[0], n_samples - (2*rampTime+flatTime)))
+        trap_filter_rows(wfs, trapOutput, baselines, rampTime, flatTime, decayConstant, norm)
+        return trapOutput if waveform.ndim > 1 else trapOutput[0]
+
+    f_0 = waveform[...,0] - baseline
+    trap_0 = (decayConstant+1.)*(waveform[...,0] - baseline)
+
+    #scratch = waveform - (wf_minus_ramp + wf_minus_ft_and_ramp + wf_minus_ft_and_2ramp), where each term is the
+    #waveform delayed by that many samples (baseline before it starts).  Built up in one buffer, in the same order
+    baseline = per_event(baseline)
+    scratch = np.empty_like(waveform)
+    scratch[...,:rampTime] = baseline
+    scratch[...,rampTime:] = waveform[...,:n_samples-rampTime]
+    for delay in (flatTime+rampTime, flatTime+2*rampTime):
+      scratch[...,:delay] += baseline
+      scratch[...,delay:] += waveform[...,:n_samples-delay]
+    np.subtract(waveform, scratch, out=scratch)
+
+    #the f vector and the trap output start out zero except for their first samples
     if decayConstant != 0:
-        fVector = np.cumsum(fVector + scratch)
-        trapOutput = np.cumsum(trapOutput +fVector+ decayConstant*scratch)
+        fVector = scratch.copy()
+        fVector[...,0] += f_0
+        np.cumsum(fVector, axis=-1, out=fVector)
+        trapOutput = fVector
+        trapOutput[...,0] += trap_0
+        trapOutput += decayConstant*scratch
     else:
-        trapOutput = np.cumsum(trapOutput + scratch)
+        trapOutput = scratch
+        trapOutput[...,0] += trap_0
+    np.cumsum(trapOutput, axis=-1, out=trapOutput)
 
-    # Normalize and resize output
-    trapOutput[:len(waveform) - (2*rampTime+flatTime)] = trapOutput[2*rampTime+flatTime:]/norm
-    trapOutput.resize( (len(waveform) - (2*rampTime+flatTime)))
-    return trapOutput
+    # Normalize and cut off the end of the output
+    return (trapOutput[...,2*rampTime+flatTime:]/norm).astype(trapOutput.dtype, copy=False)
 
+@batch_aware
 def notch_filter(waveform, notch_freq, qual_factor = 10, f_dig = 1E8, ):
     nyquist = 0.5*f_dig
     w0 = notch_freq/nyquist
@@ -94,8 +244,33 @@ def notch_filter(waveform, notch_freq, qual_factor = 10, f_dig = 1E8, ):
     num, den = signal.iirnotch(w0, Q)
     return signal.lfilter(num, den, waveform)
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void asym_trap_filter_rows(const double[:, ::1] wfs, double[:, ::1] traps, Py_ssize_t ramp, Py_ssize_t flat, Py_ssize_t fall,
+                                bint pad_after):
+  cdef Py_ssize_t row, i, n = wfs.shape[1]
+  cdef Py_ssize_t shift = 0 if pad_after else 1000
+  cdef double r1, r2
+  with nogil:
+    for row in range(wfs.shape[0]):
+      for i in range(n - 1000):
+        #the sums of waveform[i:ramp+i] and waveform[ramp+flat+i:ramp+flat+fall+i], with the slices cut off at the end
+        r1 = np_sum(&wfs[row, i], min(ramp+i, n) - i) / ramp
+        r2 = np_sum(&wfs[row, 0] + min(ramp+flat+i, n), min(ramp+flat+fall+i, n) - min(ramp+flat+i, n)) / fall
+        traps[row, i+shift] = r2 - r1
+
+@batch_aware
 def asym_trap_filter(waveform,ramp=200,flat=100,fall=40,padAfter=False):
     """ Computes an asymmetric trapezoidal filter """
+    wfs = as_float_rows(waveform)
+    if wfs is not None and ramp > 0 and flat >= 0 and fall > 0:
+        traps = np.zeros(wfs.shape)
+        asym_trap_filter_rows(wfs, traps, ramp, flat, fall, padAfter)
+        return traps if waveform.ndim > 1 else traps[0]
+    if waveform.ndim > 1:
+        return np.array([asym_trap_filter(wf, ramp, flat, fall, padAfter) for wf in waveform])
+
     trap = np.zeros(len(waveform))
     for i in range(len(waveform)-1000):
         w1 = ramp
@@ -109,9 +284,96 @@ def asym_trap_filter(waveform,ramp=200,flat=100,fall=40,padAfter=False):
             trap[i] = r2 - r1
     return trap
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef Py_ssize_t nonlinearity_correct_row(double* wf, Py_ssize_t n, double time_constant, const double[::1] nlc_map,
+                                         const double[::1] nlc_map2, bint use_map2, Py_ssize_t map_offset, Py_ssize_t n_bl,
+                                         double* current_inl) noexcept nogil:
+  '''
+  nonlinearity_correct on one row, in place.  Returns the sample it got to: n when done, or where it found a value
+  the python loop has to deal with (not finite, or indexing the maps out of range or from the end), with current_inl
+  set to carry on from there.  Returns -1 (without touching the row) if it can't even start.
+  '''
+  cdef Py_ssize_t i, idx
+  cdef double x, inl
+  x = np_sum(wf, n_bl) / n_bl
+  if not fabs(x) < 1e18: return -1
+  idx = <Py_ssize_t>x + map_offset
+  if idx < 0 or idx >= nlc_map.shape[0]: return -1
+  inl = nlc_map[idx]
+
+  i = n_bl
+  while i < n:
+    x = wf[i]
+    if not fabs(x) < 1e18: break
+    idx = <Py_ssize_t>x + map_offset
+    if idx >= nlc_map.shape[0]:
+      i += 1
+      continue
+    if idx < 0 or (use_map2 and idx >= nlc_map2.shape[0]): break
+
+    inl += (nlc_map[idx] - inl) / time_constant
+    if use_map2: wf[i] -= nlc_map2[idx] + inl
+    else: wf[i] -= inl
+    i += 1
+
+  current_inl[0] = inl
+  return i
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void nonlinearity_correct_rows(double[:, ::1] wfs, const double[::1] time_constants, const double[::1] nlc_map,
+                                    const double[::1] nlc_map2, bint use_map2, Py_ssize_t map_offset, Py_ssize_t n_bl,
+                                    Py_ssize_t[::1] stops, double[::1] current_inls):
+  cdef Py_ssize_t row
+  with nogil:
+    for row in range(wfs.shape[0]):
+      stops[row] = nonlinearity_correct_row(&wfs[row, 0], wfs.shape[1], time_constants[row], nlc_map, nlc_map2, use_map2,
+                                            map_offset, n_bl, &current_inls[row])
+
+def nlc_map_as_float(nlc_map):
+  #an NLC map as float64 for the compiled kernel, or None if its values wouldn't come out the same
+  nlc_map = np.asarray(nlc_map)
+  if nlc_map.ndim != 1: return None
+  if nlc_map.dtype == np.float64: return np.ascontiguousarray(nlc_map)
+  if nlc_map.dtype.kind in "iu" and (len(nlc_map) == 0 or np.abs(nlc_map).max() < 2**52): return nlc_map.astype(np.float64)
+  return None
+
+@batch_aware
 def nonlinearity_correct(waveform, time_constant_samples, fNLCMap, fNLCMap2 = None, n_bl=100):
+  """ Radford's time-lagged nonlinearity correction, done in place (a block is corrected row by row) """
+  if waveform.ndim > 1 and n_bl >= waveform.shape[-1] and np.all(np.asarray(time_constant_samples) != 0):
+    print("input wf length is only {}".format(waveform.shape[-1]))
+    return
+
+  wfs = waveform if waveform.ndim > 1 else waveform[np.newaxis]
+  time_constants = np.broadcast_to(time_constant_samples, wfs.shape[:1])
+  nlc_map = nlc_map_as_float(fNLCMap)
+  nlc_map2 = nlc_map_as_float(fNLCMap2) if fNLCMap2 is not None else np.zeros(0)
+  if (waveform.dtype != np.float64 or not waveform.flags.c_contiguous or not 0 < n_bl < wfs.shape[-1] or time_constants.dtype.kind not in "iuf"
+      or np.any(time_constants == 0) or nlc_map is None or nlc_map2 is None):
+    if waveform.ndim == 1: return nonlinearity_correct_python(waveform, time_constant_samples, fNLCMap, fNLCMap2, n_bl)
+    for wf, time_constant in zip(waveform, time_constants):
+      nonlinearity_correct_python(wf, time_constant, fNLCMap, fNLCMap2, n_bl)
+    return waveform
+
+  map_offset = int((len(fNLCMap) - 1)/2)
+  stops = np.empty(len(wfs), dtype=np.intp)
+  current_inls = np.empty(len(wfs))
+  time_constants = np.ascontiguousarray(time_constants, dtype=np.float64)
+  nonlinearity_correct_rows(wfs, time_constants, nlc_map, nlc_map2, fNLCMap2 is not None, map_offset, n_bl, stops, current_inls)
+
+  #rows the kernel handed back: the python loop carries on where it stopped (or does the whole row)
+  for row in np.flatnonzero(stops < wfs.shape[-1]):
+    if stops[row] < 0: nonlinearity_correct_python(wfs[row], time_constants[row], fNLCMap, fNLCMap2, n_bl)
+    else: nonlinearity_correct_python(wfs[row], time_constants[row], fNLCMap, fNLCMap2, n_bl, stops[row], current_inls[row])
+  return waveform
+
+def nonlinearity_correct_python(waveform, time_constant_samples, fNLCMap, fNLCMap2 = None, n_bl=100, start=None, current_inl=None):
+  #nonlinearity_correct on one waveform in python, from sample start on with the given current_inl if start is given
 
-  map_offset = np.int((len(fNLCMap) - 1)/2)
+  map_offset = int((len(fNLCMap) - 1)/2)
 
   if (time_constant_samples == 0.):
     waveform -= fNLCMap.GetCorrection();
@@ -129,11 +391,13 @@ def nonlinearity_correct(waveform, time_constant_samples, fNLCMap, fNLCMap2 = No
     # // by nBLEst, but we do floating point division so that's not necessary
 
     try:
-      bl = np.int( np.sum(waveform[:n_bl])/n_bl )
-      current_inl = fNLCMap[bl + map_offset];
+      if start is None:
+        bl = int( np.sum(waveform[:n_bl])/n_bl )
+        current_inl = fNLCMap[bl + map_offset];
+        start = n_bl
 
-      for i in range(n_bl, len(waveform)):
-        wf_pt_int = np.int(waveform[i])
+      for i in range(start, len(waveform)):
+        wf_pt_int = int(waveform[i])
         if wf_pt_int + map_offset >= len(fNLCMap): continue
 
         summand = fNLCMap[ wf_pt_int + map_offset ];
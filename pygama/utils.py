@@ -1,5 +1,21 @@
 import sys
 
+#functions (transforms, calculators...) that can take a 2-D block of waveforms, one per row
+_batch_aware_functions = set()
+
+def batch_aware(function):
+    '''
+    Decorator marking a function as able to process an (N, n_samples) block of waveforms in one call,
+    with any per-event arguments given as length-N arrays.  It should return the same thing stacked along
+    a first axis of length N (or, for several outputs, a sequence of length-N arrays).
+    Batched Tier 1 processing calls unmarked functions once per event instead.
+    '''
+    _batch_aware_functions.add(function)
+    return function
+
+def is_batch_aware(function):
+    return function in _batch_aware_functions
+
 def update_progress(progress):
     #adapted from from https://stackoverflow.com/a/15860757
     barLength = 10 # Modify this to change the length of the progress bar
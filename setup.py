@@ -31,10 +31,18 @@ if __name__ == "__main__":
             language="c",
             include_dirs=include_dirs
         ),
+        Extension(
+            "pygama.processing._record_scan",
+            sources=[os.path.join("pygama", "processing", "_record_scan"+ext)],
+            language="c",
+            include_dirs=include_dirs
+        ),
         Extension(
                 "pygama.transforms",
                 sources=[os.path.join("pygama", "transforms"+ext)],
                 language="c",
+                #the compiled transforms match their numpy versions exactly only if a*b+c isn't fused into one op
+                extra_compile_args=["-ffp-contract=off"],
             )
         ]
 
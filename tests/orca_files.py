@@ -0,0 +1,68 @@
+import plistlib, struct
+import numpy as np
+
+#Writes small synthetic ORCA files for the Tier 0 tests
+
+GRETINA_ID, PREAMP_ID, ISEG_ID, UNKNOWN_ID = 3, 7, 9, 30
+
+def make_header(run):
+    cards = [{"Class Name": "ORGretina4MModel", "Card": card, "Enabled": [True]*8 + [False]*8, "Mrpsrt": [1]*16,
+              "Mrpsdv": [0]*16, "Prerecnt": [1000]*16, "Postrecnt": [800]*16, "FtCnt": [20]*16} for card in (2, 3)]
+    preamps = [{"MJDPreAmp": dict([("preampID", preamp_id)] + [("detectorName{}".format(i), "P{}_{}".format(preamp_id, i)) for i in range(16)])}
+               for preamp_id in (1, 2)]
+    return plistlib.dumps({
+        "dataDescription": {
+            "ORGretina4MModel": {"Gretina4M": {"dataId": GRETINA_ID << 18, "decoder": "ORGretina4MWaveformDecoder"}},
+            "MJDPreAmp": {"Adc": {"dataId": PREAMP_ID << 18, "decoder": "ORMJDPreAmpDecoderForAdc"}},
+            "ORiSegHVCard": {"HV": {"dataId": ISEG_ID << 18, "decoder": "ORiSegHVCardDecoderForHV"}},
+        },
+        "ObjectInfo": {
+            "DataChain": [{"Run Control": {"RunNumber": run}}],
+            "Crates": [{"CrateNumber": 1, "Cards": cards}],
+            "AuxHw": preamps,
+        },
+    })
+
+def make_record(data_id, payload):
+    return struct.pack("<I", (data_id << 18) | (len(payload)//4 + 1)) + payload
+
+def gretina_payload(rng, card, channel, timestamp, wf_length=200):
+    words = np.zeros(18 + wf_length, dtype=np.uint16)
+    words[1] = (1 << 5) | card
+    words[4] = (0xABC << 4) | channel
+    words[6], words[7], words[8] = timestamp & 0xFFFF, (timestamp >> 16) & 0xFFFF, (timestamp >> 32) & 0xFFFF
+    words[9] = rng.integers(0, 1 << 16)
+    words[18:] = rng.integers(-300, 3000, wf_length).astype(np.int16).view(np.uint16)
+    return words.tobytes()
+
+def preamp_payload(rng, preamp_id, timestamp):
+    return np.array([preamp_id, timestamp, 0xF0F0], dtype=np.uint32).tobytes() + rng.random(16).astype(np.float32).tobytes()
+
+def iseg_payload(rng, timestamp):
+    return np.array([(1 << 20) | (4 << 16), 0x11111111, 0, timestamp], dtype=np.uint32).tobytes() + rng.random(16).astype(np.float32).tobytes()
+
+def make_orca_file(path, n_records=500, run=42, gretina_every=10, unknown_every=50, seed=0):
+    '''
+    Writes an ORCA file of n_records records: a Gretina record every gretina_every records, and the rest
+    alternating preamp and iSeg records, plus a record with a data id that isn't in the header after every
+    unknown_every records.  Returns the byte offsets of the records.
+    '''
+    rng = np.random.default_rng(seed)
+    records = []
+    for i in range(n_records):
+        if i % gretina_every == 0:
+            records.append(make_record(GRETINA_ID, gretina_payload(rng, 2 + i % 2, i % 8, 1000 + i)))
+        elif i % 2 == 0:
+            records.append(make_record(PREAMP_ID, preamp_payload(rng, 1 + i % 4 // 2, 100000 + i)))
+        else:
+            records.append(make_record(ISEG_ID, iseg_payload(rng, 100000 + i)))
+        if unknown_every and i % unknown_every == unknown_every - 1:
+            records.append(make_record(UNKNOWN_ID, b"\0"*12))
+
+    header = make_header(run)
+    header_length = 8 + len(header)
+    header_length += (-header_length) % 4
+    with open(path, "wb") as f:
+        f.write(struct.pack("<II", header_length // 4, len(header)) + header + b"\0"*(header_length - 8 - len(header)))
+        f.write(b"".join(records))
+    return header_length + np.concatenate(([0], np.cumsum([len(record) for record in records])[:-1]))
@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+
+import pygama.processing #the decoders have to be imported through processing
+
+from pygama.decoders import SIS3302Decoder
+from pygama.decoders.buffers import ColumnBuffer, RaggedArray
+
+def make_buffer(capacity=4):
+    return ColumnBuffer({"energy": np.uint32, "timestamp": np.int64, "waveform": (np.int16, None)}, capacity=capacity)
+
+def test_column_buffer_round_trip():
+    rng = np.random.default_rng(0)
+    energy = rng.integers(0, 1 << 32, 50, dtype=np.uint64).astype(np.uint32)
+    timestamp = rng.integers(0, 1 << 48, 50)
+    waveforms = rng.integers(-1000, 1000, (50, 30)).astype(np.int16)
+
+    buffer = make_buffer()
+    assert len(buffer) == 0 and buffer["waveform"].shape == (0, 0)
+    #rows one at a time and in blocks, well past the starting capacity
+    for i in range(7):
+        buffer.append({"energy": energy[i], "timestamp": timestamp[i], "waveform": waveforms[i]})
+    buffer.extend({"energy": energy[7:40], "timestamp": timestamp[7:40], "waveform": waveforms[7:40]})
+    buffer.extend({"energy": energy[40:], "timestamp": timestamp[40:], "waveform": waveforms[40:]})
+
+    assert len(buffer) == 50 and buffer.capacity >= 50
+    assert buffer["energy"].dtype == np.uint32 and buffer["waveform"].dtype == np.int16
+    assert np.array_equal(buffer["energy"], energy)
+    assert np.array_equal(buffer["timestamp"], timestamp)
+    assert np.array_equal(buffer["waveform"], waveforms)
+
+    df = buffer.to_df()
+    assert np.array_equal(df["timestamp"].values, timestamp)
+    assert np.array_equal(np.stack(df["waveform"].values), waveforms)
+
+def test_column_buffer_truncate_and_reuse():
+    buffer = make_buffer()
+    waveforms = np.arange(60, dtype=np.int16).reshape(6, 10)
+    buffer.extend({"energy": np.arange(6), "timestamp": np.arange(6), "waveform": waveforms})
+    arrays = dict(buffer.arrays)
+
+    buffer.truncate(4)
+    assert np.array_equal(buffer["energy"], np.arange(4))
+    buffer.clear()
+    assert len(buffer) == 0 and len(buffer["waveform"]) == 0
+
+    #the memory gets reused
+    buffer.extend({"energy": np.arange(3), "timestamp": np.arange(3), "waveform": waveforms[3:]})
+    assert all(buffer.arrays[name] is arrays[name] for name in arrays)
+    assert np.array_equal(buffer["waveform"], waveforms[3:])
+
+def test_column_buffer_width():
+    #the first row sets the width of a field with width None, and rows of another width are refused
+    buffer = make_buffer()
+    buffer.append({"energy": 1, "timestamp": 2, "waveform": np.zeros(10)})
+    with pytest.raises(ValueError):
+        buffer.append({"energy": 1, "timestamp": 2, "waveform": np.zeros(12)})
+
+    buffer = ColumnBuffer({"waveform": (np.int16, 8)})
+    with pytest.raises(ValueError):
+        buffer.extend({"waveform": np.zeros((2, 6))})
+
+def make_rows(n_rows=30, seed=1):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(-1000, 1000, rng.choice([0, 5, 8, 13])).astype(np.int16) for i in range(n_rows)]
+
+def check_rows(ragged, rows):
+    assert len(ragged) == len(rows)
+    for row, expected in zip(ragged, rows):
+        assert row.dtype == np.int16 and np.array_equal(row, expected)
+
+def test_ragged_array_round_trip():
+    rows = make_rows()
+    ragged = RaggedArray(dtype=np.int16)
+    for row in rows[:10]:
+        ragged.append(row)
+    ragged.extend(rows[10:20])
+    ragged.extend(RaggedArray.from_rows(rows[20:]))
+    check_rows(ragged, rows)
+    assert np.array_equal(ragged.lengths, [len(row) for row in rows])
+    assert np.array_equal(ragged.flat, np.concatenate(rows))
+    assert np.array_equal(ragged[-1], rows[-1])
+
+    check_rows(ragged[5:17], rows[5:17])
+    check_rows(ragged[3:20:4], rows[3:20:4])
+    check_rows(ragged.take([7, 2, 2, 29]), [rows[i] for i in [7, 2, 2, 29]])
+    check_rows(RaggedArray.concatenate([ragged[:4], ragged[4:4], ragged[4:]]), rows)
+
+    #groups of same-length rows, as blocks
+    n_grouped = 0
+    for indices, block in ragged.iter_groups():
+        assert block.shape == (len(indices), len(rows[indices[0]]))
+        for i, row in zip(indices, block):
+            assert np.array_equal(row, rows[i])
+        n_grouped += len(indices)
+    assert n_grouped == len(rows)
+
+    ragged.truncate(12)
+    ragged.extend(rows[25:])
+    check_rows(ragged, rows[:12] + rows[25:])
+
+def test_ragged_array_2d():
+    block = np.arange(24, dtype=np.int16).reshape(4, 6)
+    ragged = RaggedArray.from_rows(block)
+    check_rows(ragged, list(block))
+    indices, grouped = next(ragged.iter_groups())
+    assert np.array_equal(indices, np.arange(4)) and np.array_equal(grouped, block)
+
+def test_ragged_array_file_round_trip(tmp_path):
+    rows = make_rows(40)
+    file_name = str(tmp_path / "t1_run1.h5")
+    decoder = SIS3302Decoder()
+    #in pieces, the way decoders get flushed
+    for start, stop in [(0, 15), (15, 16), (16, 40)]:
+        decoder.to_file(file_name, {"event_number": np.arange(start, stop), "waveform": RaggedArray.from_rows(rows[start:stop])}, append=True)
+
+    assert decoder.get_n_rows(file_name) == 40
+    columns = decoder.read_columns(file_name)
+    assert np.array_equal(columns["event_number"], np.arange(40))
+    check_rows(columns["waveform"], rows)
+    #reading part of the file only reads those rows
+    check_rows(decoder.read_columns(file_name, 13, 31)["waveform"], rows[13:31])
+    df = decoder.read_file(file_name, 20, 25)
+    assert list(df.index) == list(range(20, 25))
+    check_rows(RaggedArray.from_rows(list(df["waveform"])), rows[20:25])
@@ -0,0 +1,9 @@
+import numpy as np
+
+from pygama.calculators import fit_baseline, is_saturated, trap_max
+
+def test_list_input():
+    waveform = [2. + 0.5*i for i in range(20)]
+    assert np.allclose(fit_baseline(waveform, end_index=10), [0.5, 2.])
+    assert not is_saturated(waveform)
+    assert trap_max(waveform, method="fixed_time", pickoff_sample=4) == 4.
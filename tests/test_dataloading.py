@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import h5py
+
+import pygama.processing #the decoders have to be imported through processing
+from pygama.decoders import Gretina4MDecoder, SIS3302Decoder
+from pygama.decoders.buffers import RaggedArray
+
+def make_gretina_columns(start, stop, n_samples=40):
+    rng = np.random.default_rng(start)
+    return {
+        "event_number": np.arange(start, stop),
+        "energy": rng.integers(0, 1000, stop-start),
+        "channel": np.full(stop-start, 35),
+        "waveform": rng.integers(-500, 500, (stop-start, n_samples)).astype(np.int16),
+    }
+
+def check_columns(columns, expected):
+    assert columns.keys() == expected.keys()
+    for name in expected:
+        assert np.array_equal(columns[name], expected[name]), name
+
+def test_append_and_truncate(tmp_path):
+    file_name = str(tmp_path / "t1_run1.h5")
+    object_info = pd.DataFrame({"Enabled": [[1]*16]}, index=pd.MultiIndex.from_tuples([(1, 2)], names=["Crate", "Card"]))
+    decoder = Gretina4MDecoder(object_info=object_info)
+    pieces = [make_gretina_columns(start, stop) for start, stop in [(0, 30), (30, 31), (31, 70)]]
+    for columns in pieces:
+        decoder.to_file(file_name, columns, append=True)
+
+    expected = {name: np.concatenate([columns[name] for columns in pieces]) for name in pieces[0]}
+    assert decoder.get_n_rows(file_name) == 70
+    check_columns(decoder.read_columns(file_name), expected)
+    check_columns(decoder.read_columns(file_name, 25, 45), {name: values[25:45] for name, values in expected.items()})
+    assert len(pd.read_hdf(file_name, decoder.class_name)) == 1
+
+    #truncating then appending picks up where the truncated file ends
+    decoder.truncate_file(file_name, 31)
+    assert decoder.get_n_rows(file_name) == 31
+    check_columns(decoder.read_columns(file_name), {name: values[:31] for name, values in expected.items()})
+    decoder.to_file(file_name, pieces[2], append=True)
+    check_columns(decoder.read_columns(file_name), expected)
+
+    decoder.truncate_file(file_name, 0)
+    assert decoder.get_n_rows(file_name) == 0
+    decoder.to_file(file_name, pieces[0], append=True)
+    check_columns(decoder.read_columns(file_name), pieces[0])
+
+def test_truncate_ragged(tmp_path):
+    file_name = str(tmp_path / "t1_run1.h5")
+    decoder = SIS3302Decoder()
+    waveforms = [np.full(5 + i % 3, i, dtype=np.int16) for i in range(20)]
+    decoder.to_file(file_name, {"event_number": np.arange(20), "waveform": RaggedArray.from_rows(waveforms)}, append=True)
+    decoder.truncate_file(file_name, 8)
+    decoder.to_file(file_name, {"event_number": np.arange(8, 12), "waveform": RaggedArray.from_rows(waveforms[8:12])}, append=True)
+
+    columns = decoder.read_columns(file_name)
+    assert np.array_equal(columns["event_number"], np.arange(12))
+    assert all(np.array_equal(wf, expected) for wf, expected in zip(columns["waveform"], waveforms[:12]))
+    assert len(columns["waveform"]) == 12
+
+def test_waveform_storage(tmp_path):
+    columns = make_gretina_columns(0, 50)
+    #smooth waveforms near the ends of the int16 range, so the differences wrap around
+    columns["waveform"] = (np.cumsum(columns["waveform"] % 7, axis=1) + 32700).astype(np.int16)
+
+    for compression, delta_encode in [("lzf", False), ("gzip", True), (None, True)]:
+        file_name = str(tmp_path / "t1_{}_{}.h5".format(compression, delta_encode))
+        decoder = Gretina4MDecoder()
+        decoder.compression, decoder.delta_encode = compression, delta_encode
+        decoder.to_file(file_name, {name: values[:20] for name, values in columns.items()}, append=True)
+        decoder.to_file(file_name, {name: values[20:] for name, values in columns.items()}, append=True)
+
+        check_columns(decoder.read_columns(file_name), columns)
+        check_columns(decoder.read_columns(file_name, 10, 30), {name: values[10:30] for name, values in columns.items()})
+        with h5py.File(file_name, "r") as f:
+            dset = f["{}_arrays/waveform".format(decoder.decoder_name)]
+            #one waveform per row, in chunks of whole waveforms
+            assert dset.shape == (50, 40) and dset.chunks[1] == 40
+            assert dset.compression == compression
+            stored = dset[:]
+            if delta_encode:
+                assert np.array_equal(stored[:,1:], np.diff(columns["waveform"], axis=1))
+            else:
+                assert np.array_equal(stored, columns["waveform"])
@@ -0,0 +1,49 @@
+import pygama.processing #the decoders have to be imported through processing
+import pygama.decoders.dataloading as dataloading
+from pygama.decoders import get_decoders, get_decoder_class, get_digitizers, Gretina4MDecoder, SIS3302Decoder, ISegHVDecoder
+from pygama.decoders.dataloading import DataLoader
+from pygama.processing._header_parser import get_header_info
+
+from orca_files import make_orca_file
+
+class FakeEntryPoint():
+    def __init__(self, name, decoder_class, loaded):
+        self.name, self.decoder_class, self.loaded = name, decoder_class, loaded
+
+    def load(self):
+        self.loaded.append(self.name)
+        return self.decoder_class
+
+def test_get_decoders(tmp_path, monkeypatch):
+    path = str(tmp_path / "Run42")
+    make_orca_file(path, n_records=10)
+
+    #only the decoders the header names get built
+    def no_sis(self, *args, **kwargs):
+        raise AssertionError("SIS3302Decoder shouldn't be built")
+    monkeypatch.setattr(SIS3302Decoder, "__init__", no_sis)
+    decoders = get_decoders(get_header_info(path, use_cache=False))
+    assert [decoder.decoder_name for decoder in decoders] == ["ORGretina4MWaveformDecoder", "ORMJDPreAmpDecoderForAdc", "ORiSegHVCardDecoderForHV"]
+    assert len(decoders[0].object_info) == 2
+
+    assert get_decoder_class("ORiSegHVCardDecoderForHV") is ISegHVDecoder
+    assert [type(d) for d in get_digitizers(["ORGretina4MWaveformDecoder", "ORiSegHVCardDecoderForHV", "NotADecoder"])] == [Gretina4MDecoder]
+
+def test_registering_decoders(monkeypatch):
+    monkeypatch.setattr(dataloading, "_decoder_registry", dict(dataloading._decoder_registry))
+    loaded = []
+    monkeypatch.setattr(dataloading, "_load_entry_point_decoders",
+                        lambda: [FakeEntryPoint(name, SIS3302Decoder, loaded) for name in ["ORFakeDecoder", "OROtherDecoder"]])
+
+    #entry points only get loaded for the decoder names asked for
+    assert get_decoder_class("ORGretina4MWaveformDecoder") is Gretina4MDecoder
+    assert get_decoder_class("ORFakeDecoder") is SIS3302Decoder
+    assert get_decoder_class("ORUnknownDecoder") is None
+    assert loaded == ["ORFakeDecoder"]
+
+    #subclasses with a decoder name register themselves
+    class FakeDecoder(DataLoader):
+        decoder_name = "ORFakeDecoder"
+        def decode_event(self, event_data_bytes, event_number, header_dict):
+            pass
+    assert get_decoder_class("ORFakeDecoder") is FakeDecoder
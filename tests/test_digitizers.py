@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+import pygama.processing #the decoders have to be imported through processing
+from pygama.decoders import Gretina4MDecoder, SIS3302Decoder
+from pygama.decoders.digitizers import Digitizer
+
+from test_pollers import make_records
+from orca_files import gretina_payload
+
+def make_gretina_block(n_events=40, n_samples=2032, seed=0):
+    #two cards with different multisampling settings, and presummed waveforms with jumps near where they're expected
+    object_info = pd.DataFrame({
+        "Enabled": [[1]*16, [1]*16],
+        "Mrpsrt": [[1]*16, [3]*16],
+        "Mrpsdv": [[0]*16, [1]*16],
+        "Prerecnt": [[1000]*16, [600]*16],
+        "Postrecnt": [[800]*16, [800]*16],
+        "FtCnt": [[20]*16, [20]*16],
+    }, index=pd.MultiIndex.from_tuples([(1, 2), (1, 3)], names=["Crate", "Card"]))
+    decoder = Gretina4MDecoder(object_info=object_info)
+
+    rng = np.random.default_rng(seed)
+    channels = [decoder.crate_card_chan(1, 2 + i%2, i%16) for i in range(n_events)]
+    waveforms = []
+    for i, channel in enumerate(channels):
+        _, ratio, prere_cnt, postre_cnt, ft_cnt = decoder.get_presum_settings(channel)
+        bl_end = n_samples - prere_cnt - postre_cnt - ft_cnt + rng.integers(-10, 4)
+        ft_start = n_samples - ft_cnt - 1 + rng.integers(-4, 2)
+        wf = (0 if i % 5 == 0 else rng.integers(-500, 3000)) + rng.normal(0, 3, n_samples)
+        wf[bl_end:] += rng.integers(0, 4000)
+        wf[:bl_end] *= ratio
+        wf[ft_start:] *= ratio
+        waveforms.append(np.clip(wf, -32768, 32767).astype(np.int16))
+    return decoder, pd.DataFrame({"channel": channels, "waveform": waveforms})
+
+def test_gretina_presum_block():
+    #the block presum correction has to match parse_event_data, event by event
+    for n_samples in [2032, 2100, 1900]:
+        decoder, event_df = make_gretina_block(n_samples=n_samples)
+        waveforms, params = decoder.parse_event_block(event_df)
+        expected, expected_params = Digitizer.parse_event_block(decoder, event_df)
+        assert len(waveforms) == len(expected)
+        for wf, expected_wf in zip(waveforms, expected):
+            assert np.array_equal(wf, expected_wf)
+        for name in ["fs_start", "fs_end"]:
+            assert np.array_equal(params[name], expected_params[name])
+
+def sis3302_payload(waveform, energy_wf, wrap_start=None, wf_longs=None):
+    #an SIS3302 record (without the orca header word); with wrap_start, the waveform buffer is written
+    #circularly starting wrap_start longs in, and padded out to wf_longs longs
+    wf_words = np.asarray(waveform, dtype=np.int16).view(np.uint32)
+    wrap_length = len(wf_words)
+    if wrap_start is not None:
+        wf_words = np.roll(wf_words.view(np.uint16), 2*wrap_start).view(np.uint32)
+        wf_words = np.concatenate((wf_words, np.zeros((wf_longs or wrap_length) - wrap_length, dtype=np.uint32)))
+    head = [(1 << 21) | (5 << 16) | (3 << 8) | (wrap_start is not None), len(wf_words), len(energy_wf)//2, (0x1234 << 16) | 0x56, 0x789]
+    if wrap_start is not None:
+        head += [wrap_length, wrap_start]
+    footer = [4321, 1234, 0, 0xDEADBEEF]
+    return np.concatenate((head, wf_words, np.asarray(energy_wf, dtype=np.int16).view(np.uint32), footer)).astype(np.uint32)
+
+def test_sis3302_buffer_wrap_mode():
+    rng = np.random.default_rng(2)
+    waveforms = [rng.integers(-2000, 2000, 2*n_longs).astype(np.int16) for n_longs in [50, 50, 50, 40, 50]]
+    energy_wf = rng.integers(0, 100, 20).astype(np.int16)
+    payloads = [
+        sis3302_payload(waveforms[0], energy_wf),
+        sis3302_payload(waveforms[1], energy_wf, wrap_start=17),
+        sis3302_payload(waveforms[2], energy_wf, wrap_start=0),
+        #only the first (word 5) longs of the waveform buffer were filled
+        sis3302_payload(waveforms[3], energy_wf, wrap_start=33, wf_longs=50),
+        sis3302_payload(waveforms[4], energy_wf, wrap_start=49),
+    ]
+    raw_data, records = make_records(payloads)
+    event_numbers = np.arange(1, len(records)+1)
+
+    decoder = SIS3302Decoder()
+    decoder.decode_records(raw_data, records, event_numbers, {})
+    decoded = decoder.decoded_values.to_dict()
+    assert np.array_equal(decoded["event_number"], event_numbers)
+    for wf, expected_wf in zip(decoded["waveform"], waveforms):
+        assert np.array_equal(wf, expected_wf)
+    for wf in decoded["energy_wf"]:
+        assert np.array_equal(wf, energy_wf)
+    assert np.array_equal(decoded["timestamp"], np.full(len(records), (0x1234 << 32) + 0x789))
+    assert np.array_equal(decoded["energy"], np.full(len(records), 4321))
+
+    #decode_event gives the same thing
+    for record, event_number, expected_wf in zip(records, event_numbers, waveforms):
+        data_dict = decoder.decode_event(raw_data[int(record["offset"])+4 : int(record["offset"])+int(record["length"])], event_number, {})
+        assert np.array_equal(data_dict["waveform"], expected_wf)
+
+def decode_gretina_records(n_records=60, chan_list=None):
+    #records from two cards (channels 8-15 are disabled)
+    object_info = pd.DataFrame({"Enabled": [[1]*8 + [0]*8]*2}, index=pd.MultiIndex.from_tuples([(1, 2), (1, 3)], names=["Crate", "Card"]))
+    rng = np.random.default_rng(3)
+    payloads = [np.frombuffer(gretina_payload(rng, 2 + i % 2, i % 16, 1000 + 7*i + (i << 33)),
+                              dtype=np.uint32) for i in range(n_records)]
+    raw_data, records = make_records(payloads, data_id=3)
+    event_numbers = np.arange(1, n_records+1)
+
+    batched = Gretina4MDecoder(object_info=object_info, chan_list=chan_list)
+    batched.decode_records(raw_data, records, event_numbers, {})
+    per_event = Gretina4MDecoder(object_info=object_info, chan_list=chan_list)
+    for record, event_number in zip(records, event_numbers):
+        per_event.decode_event(raw_data[int(record["offset"])+4 : int(record["offset"])+int(record["length"])], event_number, {})
+    return batched, per_event
+
+def test_gretina_batch_matches_per_event():
+    batched, per_event = decode_gretina_records()
+    assert len(batched.decoded_values) == len(per_event.decoded_values) == 32
+    for name, values in per_event.decoded_values.to_dict().items():
+        assert np.array_equal(batched.decoded_values[name], values), name
+    #only the enabled channels, and with their 48 bit timestamps
+    channels = batched.decoded_values["channel"]
+    assert np.all(channels & 0xf < 8)
+    i = batched.decoded_values["event_number"] - 1
+    assert np.array_equal(batched.decoded_values["timestamp"], 1000 + 7*i + (i << 33))
+
+def test_gretina_chan_list():
+    chan_list = [Gretina4MDecoder().crate_card_chan(1, card, channel) for card, channel in [(2, 0), (2, 4), (3, 1), (3, 9)]]
+    batched, per_event = decode_gretina_records(chan_list=chan_list)
+    for name, values in per_event.decoded_values.to_dict().items():
+        assert np.array_equal(batched.decoded_values[name], values), name
+    #channel 9 is disabled
+    assert set(batched.decoded_values["channel"]) == set(chan_list[:3])
@@ -0,0 +1,57 @@
+import os
+
+import pygama.processing._header_parser as header_parser
+from pygama.processing._header_parser import get_header_info
+
+from orca_files import make_orca_file, GRETINA_ID, PREAMP_ID, ISEG_ID
+
+def count_parses(monkeypatch):
+    parse_header = header_parser.parse_header
+    n_parses = [0]
+    def counted_parse(*args):
+        n_parses[0] += 1
+        return parse_header(*args)
+    monkeypatch.setattr(header_parser, "parse_header", counted_parse)
+    monkeypatch.setattr(header_parser, "_header_info_memo", header_parser.OrderedDict())
+    return n_parses
+
+def test_header_info(tmp_path):
+    path = str(tmp_path / "Run42")
+    offsets = make_orca_file(path, n_records=10)
+    header_info = get_header_info(path, use_cache=False)
+    assert header_info["run_number"] == 42
+    assert header_info["header_length"]*4 == offsets[0]
+    assert header_info["decoder_for_id"] == {GRETINA_ID: "ORGretina4MWaveformDecoder", PREAMP_ID: "ORMJDPreAmpDecoderForAdc",
+                                             ISEG_ID: "ORiSegHVCardDecoderForHV"}
+    assert list(header_info["object_info"]) == ["ORGretina4MModel"]
+    assert len(header_info["object_info"]["ORGretina4MModel"]) == 2
+
+def test_header_cache(tmp_path, monkeypatch):
+    n_parses = count_parses(monkeypatch)
+    path = str(tmp_path / "Run42")
+    make_orca_file(path, n_records=10)
+
+    header_info = get_header_info(path)
+    assert os.path.isfile(path + header_parser.HEADER_CACHE_EXT)
+    #from memory, then (as in a new process) from the pickle
+    assert get_header_info(path) is header_info
+    header_parser._header_info_memo.clear()
+    assert get_header_info(path)["decoder_for_id"] == header_info["decoder_for_id"]
+    assert n_parses[0] == 1
+
+    #a rewritten file gets parsed again
+    make_orca_file(path, n_records=10, run=1234)
+    assert get_header_info(path)["run_number"] == 1234
+    assert n_parses[0] == 2
+    assert get_header_info(path, use_cache=False)["run_number"] == 1234
+    assert n_parses[0] == 3
+
+def test_header_memo_size(tmp_path, monkeypatch):
+    count_parses(monkeypatch)
+    paths = [str(tmp_path / "Run{}".format(run)) for run in range(header_parser.HEADER_MEMO_SIZE + 3)]
+    for run, path in enumerate(paths):
+        make_orca_file(path, n_records=2, run=run)
+        get_header_info(path)
+    #only the most recently used headers are kept in memory
+    assert len(header_parser._header_info_memo) == header_parser.HEADER_MEMO_SIZE
+    assert [key[0] for key in header_parser._header_info_memo] == [os.path.basename(path) for path in paths[3:]]
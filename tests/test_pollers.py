@@ -0,0 +1,62 @@
+import numpy as np
+
+import pygama.processing #the decoders have to be imported through processing
+from pygama.processing._record_index import RECORD_DTYPE
+from pygama.decoders import MJDPreampDecoder, ISegHVDecoder
+
+def make_records(payloads, data_id=3):
+    #lays records (orca header word + payload words) back-to-back, and returns the raw bytes and record index
+    words, records = [], np.zeros(len(payloads), dtype=RECORD_DTYPE)
+    offset = 0
+    for i, payload in enumerate(payloads):
+        records[i] = (offset, 4*(len(payload)+1), data_id)
+        words.append(np.concatenate(([(data_id << 18) | (len(payload)+1)], payload)).astype(np.uint32))
+        offset += 4*(len(payload)+1)
+    return np.concatenate(words).view(np.uint8), records
+
+def decode_both(decoder_class, payloads, header_dict):
+    raw_data, records = make_records(payloads)
+    event_numbers = np.arange(1, len(records)+1)
+
+    batched = decoder_class()
+    batched.decode_records(raw_data, records, event_numbers, header_dict)
+
+    per_event = decoder_class()
+    for record, event_number in zip(records, event_numbers):
+        per_event.decode_event(raw_data[int(record["offset"])+4 : int(record["offset"])+int(record["length"])], event_number, header_dict)
+    return batched.decoded_values.to_dict(), per_event.decoded_values.to_dict()
+
+def check_same(batched, per_event):
+    assert batched.keys() == per_event.keys()
+    for name in batched:
+        assert np.array_equal(batched[name], per_event[name]), name
+
+def test_iseg_batch_matches_per_event():
+    rng = np.random.default_rng(0)
+    payloads = []
+    for i in range(30):
+        payload = rng.integers(0, 1 << 32, 20 + (i % 3 == 1), dtype=np.uint64).astype(np.uint32)
+        payload[0] = (1 << 20) | (i % 4 << 16)
+        payload[4:20] = rng.normal(1000, 10, 16).astype(np.float32).view(np.uint32)
+        payloads.append(payload)
+    batched, per_event = decode_both(ISegHVDecoder, payloads, {})
+    #records of different lengths still come out in event order
+    assert np.array_equal(batched["event_number"], np.arange(1, 31))
+    check_same(batched, per_event)
+
+def test_preamp_batch_matches_per_event():
+    header_dict = {"ObjectInfo": {"AuxHw": [
+        {"MJDPreAmp": dict({"preampID": preamp_id}, **{"detectorName{}".format(i): "P{}{}".format(preamp_id, i) for i in range(16)})}
+        for preamp_id in [5, 9]]}}
+    rng = np.random.default_rng(1)
+    payloads = []
+    for i in range(20):
+        payload = np.zeros(19 + (i % 4 == 0), dtype=np.uint32)
+        payload[0] = [5, 9][i % 2]
+        payload[1] = 1500000000 + i
+        payload[2] = rng.integers(0, 1 << 16)
+        payload[3:19] = rng.normal(0, 5, 16).astype(np.float32).view(np.uint32)
+        payloads.append(payload)
+    batched, per_event = decode_both(MJDPreampDecoder, payloads, header_dict)
+    assert np.array_equal(batched["event_number"], np.repeat(np.arange(1, 21), 16))
+    check_same(batched, per_event)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from pygama.processing import TierOneProcessorList
+from pygama.processing.processors import DatabaseLookup
+from pygama.utils import batch_aware
+from pygama.transforms import trap_filter, savgol_filter
+from pygama.calculators import fit_baseline, trap_max
+
+from test_tier1_cache import get_processing_list
+
+def test_database_lookup_batch():
+    @batch_aware
+    def gain(channel, default=1.5):
+        return np.where(np.asarray(channel) == 3, 2., default)
+
+    #one value for the whole block
+    lookup = DatabaseLookup(gain, {"channel": 3}, output_name="gain")
+    lookup.bind([])
+    lookup.set_args({})
+    gains = lookup.process_batch(4)
+    assert np.array_equal(gains, np.full(4, 2.))
+    #outputs can be modified in place further down the processor list
+    gains *= 2
+    assert np.array_equal(lookup.process_batch(4), np.full(4, 2.))
+
+    #or one per event
+    lookup = DatabaseLookup(gain, {"channel": "channel"}, output_name="gain")
+    lookup.bind(["channel"])
+    lookup.set_args({"channel": np.array([3, 1, 3])})
+    assert np.array_equal(lookup.process_batch(3), [2., 1.5, 2.])
+
+def test_compile_plan():
+    procs = get_processing_list()
+    #a transform nothing reads
+    procs.AddTransform(savgol_filter, {}, input_waveform="blrm_wf", output_waveform="smoothed_wf")
+    param_names = ["channel", "energy", "timestamp"]
+    plan = procs.Compile(param_names)
+
+    assert [processor for processor, to_free in plan] == procs.list[:-1]
+    #each waveform is freed after the last processor reading it
+    assert [to_free for processor, to_free in plan] == [[], [], ["waveform"], ["blrm_wf"], [], ["trap_wf"]]
+    #and the plan is kept until something changes
+    assert procs.Compile(param_names) is plan
+    procs.keep_waveforms = True
+    assert all(to_free == [] for processor, to_free in procs.Compile(param_names))
+
+    #outputs that are already cached don't get recomputed, and nor do the transforms only they needed
+    procs.keep_waveforms = False
+    procs.cached_outputs = {"trap_max", "trap_ft"}
+    assert [processor for processor, to_free in procs.Compile(param_names)] == procs.list[:2]
+
+def test_compile_checks_names():
+    procs = TierOneProcessorList()
+    procs.AddCalculator(fit_baseline, {"end_index": 100}, output_name=["bl_slope", "bl_int"])
+    procs.AddCalculator(trap_max, {}, input_waveform="trap_wf", output_name="trap_max")
+    procs.AddTransform(trap_filter, {"rampTime": 40, "flatTime": 20}, input_waveform="blrm_wf", output_waveform="trap_wf")
+    with pytest.raises(ValueError):
+        procs.Compile(["channel"])
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+
+import pygama.processing._record_index as record_index
+from pygama.processing._record_index import build_record_index, get_record_index, split_record_index
+
+from orca_files import make_orca_file, GRETINA_ID, PREAMP_ID, ISEG_ID, UNKNOWN_ID
+
+def read_record_headers(path, offsets):
+    words = np.fromfile(path, dtype=np.uint32)[offsets // 4]
+    return 4*(words & 0x3FFFF), words >> 18
+
+def test_build_record_index(tmp_path):
+    path = str(tmp_path / "Run42")
+    offsets = make_orca_file(path, n_records=2000)
+    lengths, data_ids = read_record_headers(path, offsets)
+
+    index = build_record_index(path)
+    assert np.array_equal(index["offset"], offsets)
+    assert np.array_equal(index["length"], lengths)
+    assert np.array_equal(index["data_id"], data_ids)
+    assert set(data_ids) == {GRETINA_ID, PREAMP_ID, ISEG_ID, UNKNOWN_ID}
+
+    #from partway through, and (with the data ids from the header) the same thing
+    assert np.array_equal(build_record_index(path, start=offsets[777]), index[777:])
+    assert np.array_equal(build_record_index(path, valid_ids=[GRETINA_ID, PREAMP_ID, ISEG_ID]), index)
+
+    #a record that's still being written isn't indexed yet
+    with open(path, "ab") as f:
+        f.write(np.array([(PREAMP_ID << 18) | 20, 1, 2], dtype=np.uint32).tobytes())
+    assert np.array_equal(build_record_index(path), index)
+
+def test_split_record_index(tmp_path):
+    path = str(tmp_path / "Run42")
+    make_orca_file(path, n_records=1000)
+    index = build_record_index(path)
+    chunks = split_record_index(index, 4)
+    assert len(chunks) == 4 and chunks[0][0] == 0 and chunks[-1][1] == len(index)
+    assert all(stop == next_start for (_, stop), (next_start, _) in zip(chunks[:-1], chunks[1:]))
+    chunk_bytes = [index["length"][start:stop].sum() for start, stop in chunks]
+    assert max(chunk_bytes) - min(chunk_bytes) <= 2*index["length"].max()
+
+def test_record_index_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "Run42")
+    make_orca_file(path, n_records=500)
+    index = get_record_index(path)
+    assert os.path.isfile(path + record_index.INDEX_CACHE_EXT)
+
+    #the second time it comes from the cache
+    build = record_index.build_record_index
+    n_builds = [0]
+    def counted_build(*args, **kwargs):
+        n_builds[0] += 1
+        return build(*args, **kwargs)
+    monkeypatch.setattr(record_index, "build_record_index", counted_build)
+    assert np.array_equal(get_record_index(path), index)
+    assert n_builds[0] == 0
+
+    #but not for other valid_ids, or once the file has changed
+    assert np.array_equal(get_record_index(path, valid_ids=[GRETINA_ID, PREAMP_ID, ISEG_ID]), index)
+    assert n_builds[0] == 1
+    make_orca_file(path, n_records=600)
+    assert len(get_record_index(path)) > len(index)
+    assert n_builds[0] == 2
+    #and never with use_cache=False
+    assert np.array_equal(get_record_index(path, use_cache=False), get_record_index(path))
+    assert n_builds[0] == 3
+
+def corrupt_records(path, offsets, bad_words):
+    #overwrites the record header word of some records
+    with open(path, "r+b") as f:
+        for i, word in bad_words.items():
+            f.seek(int(offsets[i]))
+            f.write(np.array([word], dtype=np.uint32).tobytes())
+
+def test_resync_on_corrupt_records(tmp_path):
+    path = str(tmp_path / "Run42")
+    offsets = make_orca_file(path, n_records=1000)
+    lengths, _ = read_record_headers(path, offsets)
+    valid_ids = [GRETINA_ID, PREAMP_ID, ISEG_ID]
+    index = build_record_index(path, valid_ids=valid_ids)
+
+    #a zero length record header, and one with a data id that isn't in the header (and a length that leads nowhere).
+    #Both are away from the records with unknown data ids, which next to a corrupt record look corrupt too
+    bad = {120: 0, 501: (UNKNOWN_ID + 1 << 18) | 3}
+    corrupt_records(path, offsets, bad)
+    corrupt_index, quarantine = build_record_index(path, valid_ids=valid_ids, return_quarantine=True)
+
+    #everything else is still found
+    assert np.array_equal(corrupt_index, np.delete(index, list(bad)))
+    assert np.array_equal(quarantine["offset"], offsets[list(bad)])
+    assert np.array_equal(quarantine["length"], lengths[list(bad)])
+    assert list(quarantine["reason"]) == [b"zero length", b"bad record header"]
+
+    #the cache keeps the quarantine too (the first call writes it, the second reads it)
+    assert all(np.array_equal(cached, built) for cached, built in
+               zip(get_record_index(path, valid_ids=valid_ids, return_quarantine=True), (corrupt_index, quarantine)))
+    assert all(np.array_equal(cached, built) for cached, built in
+               zip(get_record_index(path, valid_ids=valid_ids, return_quarantine=True), (corrupt_index, quarantine)))
@@ -0,0 +1,57 @@
+import os, time
+import numpy as np
+
+from pygama.processing._scheduler import RunScheduler, estimate_tier_0_memory
+
+from orca_files import make_orca_file
+
+def log_job(log_dir, name, duration=0.3, fail=None):
+    with open(os.path.join(log_dir, name), "w") as f:
+        f.write("{}\n".format(time.time()))
+        time.sleep(duration)
+        if fail == "exception": raise RuntimeError("job {} failed".format(name))
+        if fail == "exit": os._exit(3)
+        f.write("{}\n".format(time.time()))
+
+def read_times(log_dir, name):
+    with open(os.path.join(log_dir, name)) as f:
+        return [float(line) for line in f]
+
+def test_memory_budget(tmp_path):
+    memory = {"a": 60, "b": 60, "c": 30, "d": 30, "e": 20, "big": 150}
+    scheduler = RunScheduler(n_workers=3, memory_budget_mb=100)
+    for name, memory_mb in memory.items():
+        scheduler.add_job(name, log_job, (str(tmp_path), name), memory_mb=memory_mb, size_mb=1)
+    results = scheduler.run()
+    assert results == {name: None for name in memory}
+
+    times = {name: read_times(str(tmp_path), name) for name in memory}
+    #the job bigger than the budget runs on its own, and first
+    assert all(times[name][0] >= times["big"][1] for name in memory if name != "big")
+    #and the others never go over the budget together, but do run side by side
+    n_running = []
+    for name in memory:
+        if name == "big": continue
+        running = [other for other in memory if times[other][0] <= times[name][0] < times[other][1]]
+        assert sum(memory[other] for other in running) <= 100
+        n_running.append(len(running))
+    assert 1 < max(n_running) <= 3
+
+def test_failed_jobs(tmp_path):
+    scheduler = RunScheduler(n_workers=2)
+    scheduler.add_job(1, log_job, (str(tmp_path), "1"), {"duration": 0.1, "fail": "exception"})
+    scheduler.add_job(2, log_job, (str(tmp_path), "2"), {"duration": 0.1, "fail": "exit"})
+    scheduler.add_job(3, log_job, (str(tmp_path), "3"), {"duration": 0.1})
+    results = scheduler.run()
+    #the others still run
+    assert "RuntimeError: job 1 failed" in results[1]
+    assert "exit code 3" in results[2]
+    assert results[3] is None and len(read_times(str(tmp_path), "3")) == 2
+
+def test_tier_0_memory_estimate(tmp_path):
+    path = str(tmp_path / "Run42")
+    make_orca_file(path, n_records=100)
+    file_mb = os.path.getsize(path) / 1e6
+    #three decoders in the header, each buffering up to flush_mb (twice that while growing), plus a copy being written
+    assert np.isclose(estimate_tier_0_memory(path, flush_mb=100), 150 + file_mb/16 + 7*100)
+    assert np.isclose(estimate_tier_0_memory(path, flush_mb=100, num_threads=2), 150 + file_mb/16 + 14*100)
@@ -0,0 +1,174 @@
+import os, io, contextlib, threading, time
+import numpy as np
+import pandas as pd
+import pytest
+
+import pygama.processing #the decoders have to be imported through processing
+from pygama.processing._pygama import ProcessTier0, read_tier_0_checkpoint, decode_or_quarantine
+from pygama.decoders import Gretina4MDecoder, MJDPreampDecoder, ISegHVDecoder
+
+from orca_files import make_orca_file, UNKNOWN_ID
+from test_record_index import corrupt_records
+from test_pollers import make_records
+
+def run_tier_0(raw_file, output_dir, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        ProcessTier0(str(raw_file), output_dir=str(output_dir), use_index_cache=False, use_header_cache=False, **kwargs)
+    return output_dir / "t1_run42.h5"
+
+def check_same_t1(file_a, file_b):
+    for decoder in [Gretina4MDecoder(), MJDPreampDecoder(), ISegHVDecoder()]:
+        df_a, df_b = decoder.read_file(str(file_a)), decoder.read_file(str(file_b))
+        assert list(df_a.columns) == list(df_b.columns) and len(df_a) == len(df_b)
+        for name in df_a.columns:
+            if df_a[name].dtype == object and isinstance(df_a[name].iloc[0], np.ndarray):
+                assert all(np.array_equal(a, b) for a, b in zip(df_a[name], df_b[name])), name
+            else:
+                assert np.array_equal(df_a[name].values, df_b[name].values), name
+    pd.testing.assert_frame_equal(pd.read_hdf(str(file_a), "tier0_quarantine"), pd.read_hdf(str(file_b), "tier0_quarantine"))
+
+def test_resume_matches_full_run(tmp_path, monkeypatch):
+    raw_file = tmp_path / "Run42"
+    #enough records for several 10000 record blocks, with a checkpoint after each
+    make_orca_file(str(raw_file), n_records=30000, gretina_every=500)
+    (tmp_path / "full").mkdir()
+    (tmp_path / "resumed").mkdir()
+
+    full_file = run_tier_0(raw_file, tmp_path / "full")
+    #checkpoints are only written when asked for
+    assert read_tier_0_checkpoint(str(full_file)) is None
+
+    #get killed partway through
+    decode_records = ISegHVDecoder.decode_records
+    n_calls = [0]
+    def preempted(self, *args):
+        n_calls[0] += 1
+        if n_calls[0] > 2: raise KeyboardInterrupt()
+        decode_records(self, *args)
+    monkeypatch.setattr(ISegHVDecoder, "decode_records", preempted)
+    with pytest.raises(KeyboardInterrupt):
+        run_tier_0(raw_file, tmp_path / "resumed", resume=True, checkpoint_mb=0.5, flush_events=3000)
+    checkpoint = read_tier_0_checkpoint(str(tmp_path / "resumed" / "t1_run42.h5"))
+    assert checkpoint["n_records"] == 20000
+
+    monkeypatch.setattr(ISegHVDecoder, "decode_records", decode_records)
+    resumed_file = run_tier_0(raw_file, tmp_path / "resumed", resume=True, checkpoint_mb=0.5, flush_events=3000)
+    #including the records quarantined before the checkpoint
+    check_same_t1(full_file, resumed_file)
+
+def test_decode_or_quarantine(monkeypatch, capsys):
+    payloads = []
+    for i in range(6):
+        payload = np.zeros(20, dtype=np.uint32)
+        payload[0], payload[3] = (1 << 20) | (i % 4 << 16), 1000 + i
+        payloads.append(payload)
+    raw_data, records = make_records(payloads, data_id=9)
+    event_numbers = np.arange(len(records))
+
+    #a group that only fails as a whole gets decoded one record at a time, without losing any
+    decode_records = ISegHVDecoder.decode_records
+    def no_groups(self, raw_data, records, *args):
+        if len(records) > 1: raise ValueError()
+        decode_records(self, raw_data, records, *args)
+    monkeypatch.setattr(ISegHVDecoder, "decode_records", no_groups)
+    decoder = ISegHVDecoder()
+    assert len(decode_or_quarantine(decoder, raw_data, records, event_numbers, {})) == 0
+    assert np.array_equal(decoder.decoded_values.to_dict()["event_number"], event_numbers)
+    assert "quarantined" not in capsys.readouterr().out
+
+    #records that fail on their own are quarantined
+    def no_odd_timestamps(self, raw_data, records, *args):
+        words = raw_data[records["offset"].astype(np.int64)[:,np.newaxis] + np.arange(16, 20)].view(np.uint32)[:,0]
+        if np.any(words % 2): raise ValueError()
+        decode_records(self, raw_data, records, *args)
+    monkeypatch.setattr(ISegHVDecoder, "decode_records", no_odd_timestamps)
+    decoder = ISegHVDecoder()
+    quarantine = decode_or_quarantine(decoder, raw_data, records, event_numbers, {})
+    assert np.array_equal(quarantine["offset"], records["offset"][1::2])
+    assert np.array_equal(decoder.decoded_values.to_dict()["event_number"], event_numbers[::2])
+    assert "couldn't decode 3 records" in capsys.readouterr().out
+
+def test_small_flushes_match_one_flush(tmp_path):
+    raw_file = tmp_path / "Run42"
+    make_orca_file(str(raw_file), n_records=3000)
+    (tmp_path / "one").mkdir()
+    (tmp_path / "small").mkdir()
+    check_same_t1(run_tier_0(raw_file, tmp_path / "one"), run_tier_0(raw_file, tmp_path / "small", flush_events=128, flush_mb=0.01))
+
+def test_quarantine_table(tmp_path):
+    raw_file = tmp_path / "Run42"
+    offsets = make_orca_file(str(raw_file), n_records=1000)
+    (tmp_path / "clean").mkdir()
+    clean_file = run_tier_0(raw_file, tmp_path / "clean")
+    clean = pd.read_hdf(str(clean_file), "tier0_quarantine")
+    #records with a data id that isn't in the header
+    assert (clean["reason"] == "unrecognized").all() and (clean["data_id"] == UNKNOWN_ID).all() and len(clean) == 20
+
+    corrupt_records(str(raw_file), offsets, {120: 0})
+    (tmp_path / "corrupt").mkdir()
+    t1_file = run_tier_0(raw_file, tmp_path / "corrupt")
+    quarantine = pd.read_hdf(str(t1_file), "tier0_quarantine").sort_values("offset")
+    assert list(quarantine["reason"]) == ["unrecognized"]*2 + ["zero length"] + ["unrecognized"]*18
+    assert quarantine["offset"].iloc[2] == offsets[120]
+    #the rest of the file still gets decoded: only the preamp record (one row per channel) is lost
+    n_rows = [decoder.get_n_rows(str(clean_file)) - decoder.get_n_rows(str(t1_file)) for decoder in [Gretina4MDecoder(), MJDPreampDecoder(), ISegHVDecoder()]]
+    assert n_rows == [0, 16, 0]
+
+def test_parallel_matches_serial(tmp_path):
+    raw_file = tmp_path / "Run42"
+    make_orca_file(str(raw_file), n_records=5000)
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+    serial_file = run_tier_0(raw_file, tmp_path / "serial")
+    #the chunks are decoded in their own processes, and put back together in order
+    parallel_file = run_tier_0(raw_file, tmp_path / "parallel", num_threads=3, flush_events=500)
+    check_same_t1(serial_file, parallel_file)
+    assert not any(name.startswith("t1_run42.h5.part") for name in os.listdir(str(tmp_path / "parallel")))
+
+def test_chan_list(tmp_path):
+    raw_file = tmp_path / "Run42"
+    make_orca_file(str(raw_file), n_records=3000)
+    (tmp_path / "all").mkdir()
+    (tmp_path / "some").mkdir()
+    decoder = Gretina4MDecoder()
+    chan_list = [decoder.crate_card_chan(1, 2, 0), decoder.crate_card_chan(1, 3, 5)]
+    all_file = run_tier_0(raw_file, tmp_path / "all")
+    some_file = run_tier_0(raw_file, tmp_path / "some", chan_list=chan_list)
+
+    #only the digitizer records get filtered
+    df_all, df_some = decoder.read_file(str(all_file)), decoder.read_file(str(some_file))
+    df_expected = df_all[df_all["channel"].isin(chan_list)]
+    assert 0 < len(df_some) < len(df_all)
+    assert np.array_equal(df_some["event_number"].values, df_expected["event_number"].values)
+    assert all(np.array_equal(a, b) for a, b in zip(df_some["waveform"], df_expected["waveform"]))
+    for other in [MJDPreampDecoder(), ISegHVDecoder()]:
+        assert other.get_n_rows(str(some_file)) == other.get_n_rows(str(all_file))
+
+    #the dropped records are counted as skipped in the timing report
+    timing = pd.read_hdf(str(some_file), "tier0_timing")
+    assert timing.loc["decode/" + decoder.decoder_name, "skipped"] == len(df_all) - len(df_some)
+
+def test_follow_matches_full_run(tmp_path):
+    full_raw = tmp_path / "full" / "Run42"
+    (tmp_path / "full").mkdir()
+    offsets = make_orca_file(str(full_raw), n_records=3000)
+    with open(str(full_raw), "rb") as f:
+        raw_bytes = f.read()
+
+    #the file gets written in pieces that end partway through a record
+    cuts = [int(offsets[i]) + 6 for i in [500, 1700]] + [len(raw_bytes)]
+    raw_file = tmp_path / "followed" / "Run42"
+    (tmp_path / "followed").mkdir()
+    with open(str(raw_file), "wb") as f:
+        f.write(raw_bytes[:cuts[0]])
+    def write_rest():
+        for start, stop in zip(cuts[:-1], cuts[1:]):
+            time.sleep(0.3)
+            with open(str(raw_file), "ab") as f:
+                f.write(raw_bytes[start:stop])
+    writer = threading.Thread(target=write_rest)
+    writer.start()
+    followed_file = run_tier_0(raw_file, tmp_path / "followed", follow=True, poll_interval=0.05, follow_timeout=1.)
+    writer.join()
+
+    check_same_t1(run_tier_0(full_raw, tmp_path / "full"), followed_file)
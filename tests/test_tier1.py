@@ -0,0 +1,33 @@
+import io, contextlib
+import pandas as pd
+
+import pygama.processing #the decoders have to be imported through processing
+from pygama.processing._pygama import ProcessTier1
+from pygama.decoders import Gretina4MDecoder
+
+from test_tier1_cache import get_processing_list, make_t1_file
+
+def run_tier_1(t1_file, output_dir, **kwargs):
+    output_dir.mkdir()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ProcessTier1(t1_file, get_processing_list(), output_dir=str(output_dir), digitizer_list=[Gretina4MDecoder(correct_presum=False)],
+                            **kwargs)
+
+def test_chunks_match_one_chunk(tmp_path):
+    t1_file = str(tmp_path / "t1_run7.h5")
+    make_t1_file(t1_file, n_events=103)
+    #event by event, all at once
+    expected = run_tier_1(t1_file, tmp_path / "per_event", vectorize=False)
+    assert len(expected) == 103 and list(expected.index) == list(range(103))
+
+    for chunk_size in [10, 3, 103, 1000]:
+        df = run_tier_1(t1_file, tmp_path / "chunks_{}".format(chunk_size), chunk_size=chunk_size)
+        pd.testing.assert_frame_equal(df, expected)
+
+def test_workers_match_one_process(tmp_path):
+    t1_file = str(tmp_path / "t1_run7.h5")
+    make_t1_file(t1_file, n_events=103)
+    expected = run_tier_1(t1_file, tmp_path / "one", chunk_size=20)
+    #the workers read their own chunks from the t1 file, and the results get written in order
+    df = run_tier_1(t1_file, tmp_path / "workers", chunk_size=20, num_threads=2)
+    pd.testing.assert_frame_equal(df, expected)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+import pygama.processing #the decoders have to be imported through processing
+from pygama.processing import TierOneProcessorList
+from pygama.processing._pygama import ProcessTier1
+from pygama.decoders import Gretina4MDecoder
+from pygama.transforms import remove_baseline, trap_filter
+from pygama.calculators import fit_baseline, trap_max
+
+def get_processing_list(ramp_time=40, end_index=100):
+    procs = TierOneProcessorList()
+    procs.AddFromTier0("channel")
+    procs.AddCalculator(fit_baseline, {"end_index":end_index}, output_name=["bl_slope", "bl_int"])
+    procs.AddTransform(remove_baseline, {"bl_0":"bl_int", "bl_1":"bl_slope"}, output_waveform="blrm_wf")
+    procs.AddTransform(trap_filter, {"rampTime":ramp_time, "flatTime":20}, input_waveform="blrm_wf", output_waveform="trap_wf")
+    procs.AddCalculator(trap_max, {}, input_waveform="trap_wf", output_name="trap_max")
+    procs.AddCalculator(trap_max, {"method":"fixed_time","pickoff_sample":150}, input_waveform="trap_wf", output_name="trap_ft")
+    return procs
+
+def make_t1_file(path, n_events=50, n_samples=300, seed=0):
+    object_info = pd.DataFrame({"Enabled": [[1]*16]}, index=pd.MultiIndex.from_tuples([(1, 2)], names=["Crate", "Card"]))
+    decoder = Gretina4MDecoder(object_info=object_info)
+    rng = np.random.default_rng(seed)
+    waveforms = rng.normal(100, 3, (n_events, n_samples))
+    waveforms[:, n_samples//2:] += rng.integers(0, 1000, n_events)[:, np.newaxis]
+    decoder.to_file(path, {
+        "event_number": np.arange(n_events),
+        "energy": rng.integers(0, 1000, n_events),
+        "timestamp": np.arange(n_events)*1000,
+        "channel": np.full(n_events, decoder.crate_card_chan(1, 2, 3)),
+        "board_id": np.zeros(n_events, dtype=np.int64),
+        "waveform": waveforms.astype(np.int16)
+    }, append=True)
+
+def run_tier_1(t1_file, output_dir, procs, incremental):
+    df = ProcessTier1(t1_file, procs, output_dir=str(output_dir), digitizer_list=[Gretina4MDecoder(correct_presum=False)],
+                      incremental=incremental)
+    pd.testing.assert_frame_equal(df, pd.read_hdf(str(output_dir / "t2_run7.h5"), "data"))
+    #the processors of the last plan compiled are the ones that ran
+    return [processor for processor, to_free in procs.plan], df
+
+def test_output_keys_change_with_args():
+    keys = get_processing_list().GetOutputKeys("source")
+    assert keys == get_processing_list().GetOutputKeys("source")
+
+    #only the outputs downstream of the trap filter change
+    changed = get_processing_list(ramp_time=50).GetOutputKeys("source")
+    assert {name for name in keys if keys[name] != changed[name]} == {"trap_max", "trap_ft"}
+
+    #the baseline fit feeds everything but the t0 field
+    changed = get_processing_list(end_index=120).GetOutputKeys("source")
+    assert {name for name in keys if keys[name] != changed[name]} == {"bl_slope", "bl_int", "trap_max", "trap_ft"}
+
+    #and a different t1 file changes them all
+    changed = get_processing_list().GetOutputKeys("other source")
+    assert all(keys[name] != changed[name] for name in keys)
+
+def test_output_keys_change_with_defaults():
+    def scale(waveform, factor=2.):
+        return np.amax(waveform, axis=-1)*factor
+
+    procs = TierOneProcessorList()
+    procs.AddCalculator(scale, {}, output_name="scaled")
+    key = procs.GetOutputKeys("source")["scaled"]
+    scale.__defaults__ = (3.,)
+    assert procs.GetOutputKeys("source")["scaled"] != key
+
+def test_incremental_recomputes_changed_outputs(tmp_path):
+    t1_file = str(tmp_path / "t1_run7.h5")
+    make_t1_file(t1_file)
+    output_dir = tmp_path / "t2"
+    output_dir.mkdir()
+
+    ran, _ = run_tier_1(t1_file, output_dir, get_processing_list(), incremental=True)
+    assert len(ran) == 6
+
+    #nothing changed: nothing runs
+    ran, _ = run_tier_1(t1_file, output_dir, get_processing_list(), incremental=True)
+    assert ran == []
+
+    #a new trap filter: it runs again with the transform feeding it and the calculators reading it.  The channel
+    #and baseline fit come from the cache
+    procs = get_processing_list(ramp_time=50)
+    ran, df = run_tier_1(t1_file, output_dir, procs, incremental=True)
+    assert ran == procs.list[2:]
+
+    fresh_dir = tmp_path / "t2_fresh"
+    fresh_dir.mkdir()
+    _, df_fresh = run_tier_1(t1_file, fresh_dir, get_processing_list(ramp_time=50), incremental=False)
+    pd.testing.assert_frame_equal(df, df_fresh)
+
+    #or just where it went, without reading the run back in
+    path = ProcessTier1(t1_file, get_processing_list(), output_dir=str(fresh_dir), digitizer_list=[Gretina4MDecoder(correct_presum=False)],
+                        return_path=True)
+    assert path == str(fresh_dir / "t2_run7.h5")
@@ -0,0 +1,41 @@
+import io, contextlib
+import pandas as pd
+
+import pygama.processing #the decoders have to be imported through processing
+from pygama.processing._pygama import ProcessTier0
+from pygama.processing._timing import TimingReport
+
+from orca_files import make_orca_file
+
+def test_timing_report():
+    report = TimingReport()
+    report.add("decode/a", 2., records=10, bytes=4e6)
+    with report.timer("decode/b", records=5, skipped=1):
+        pass
+    other = TimingReport()
+    other.add("decode/a", 2., records=30, bytes=4e6, skipped=2)
+    other.add("write/a", 0.5)
+    report.merge(other)
+
+    df = report.to_df()
+    assert list(df.index) == ["decode/a", "decode/b", "write/a"]
+    assert df.loc["decode/a", "records"] == 40 and df.loc["decode/a", "skipped"] == 2
+    assert df.loc["decode/a", "records_per_s"] == 10. and df.loc["decode/a", "MB_per_s"] == 2.
+    assert df.loc["decode/b", "wall_time"] >= 0 and df.loc["decode/b", "skipped"] == 1
+    assert df.loc["write/a", "records_per_s"] == 0
+
+def test_tier_0_timing(tmp_path):
+    raw_file = tmp_path / "Run42"
+    offsets = make_orca_file(str(raw_file), n_records=1000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = ProcessTier0(str(raw_file), output_dir=str(tmp_path), use_index_cache=False, use_header_cache=False)
+    timing = pd.read_hdf(str(tmp_path / "t1_run42.h5"), "tier0_timing")
+    pd.testing.assert_frame_equal(timing, report.to_df())
+
+    #every record is either decoded by some decoder or unrecognized
+    decoded = timing.loc[[stage for stage in timing.index if stage.startswith("decode/")]]
+    assert decoded["records"].sum() + timing.loc["unrecognized", "skipped"] == len(offsets) == timing.loc["total", "records"]
+    assert timing.loc["unrecognized", "skipped"] == 20
+    assert decoded.loc["decode/ORGretina4MWaveformDecoder", "records"] == 100
+    assert {"header", "index", "total"} <= set(timing.index)
+    assert all("write/" + stage[len("decode/"):] in timing.index for stage in decoded.index)
@@ -0,0 +1,61 @@
+import numpy as np
+
+from pygama.transforms import (remove_baseline, trap_filter, center, trim_waveform, interpolate, savgol_filter, pz_correct,
+                               notch_filter, asym_trap_filter, nonlinearity_correct)
+
+def test_remove_baseline_float_offset():
+    #float bl_0 with the default (int) bl_1, on an int and a float waveform
+    for waveform in [np.arange(10), np.arange(10.)]:
+        out = remove_baseline(waveform, bl_0=1.5)
+        assert out.dtype == np.float64
+        assert np.array_equal(out, np.arange(10.) - 1.5)
+
+def test_remove_baseline_block():
+    block = np.arange(20.).reshape(2, 10)
+    assert np.array_equal(remove_baseline(block, bl_0=1.5, bl_1=0.25), block - (1.5 + 0.25*np.arange(10)))
+
+    bl_0, bl_1 = np.array([1., 2.]), np.array([0.5, -0.5])
+    out = remove_baseline(block, bl_0=bl_0, bl_1=bl_1)
+    for i in range(2):
+        assert np.array_equal(out[i], remove_baseline(block[i], bl_0=bl_0[i], bl_1=bl_1[i]))
+
+def test_trap_filter_int16():
+    #raw digitizer waveforms are int16
+    waveform = np.arange(2000, dtype=np.int16)
+    out = trap_filter(waveform, 100, 50)
+    assert out.dtype == np.float64
+    assert np.array_equal(out, trap_filter(waveform.astype(np.float64), 100, 50))
+    assert np.array_equal(trap_filter(np.stack([waveform, waveform]), 100, 50)[1], out)
+
+def test_block_matches_rows():
+    #each batch aware transform on a block, with per-event parameters, gives what it gives row by row
+    rng = np.random.default_rng(0)
+    block = np.cumsum(rng.normal(0, 3, (6, 1500)), axis=1) + rng.integers(-200, 200, (6, 1))
+    centers = rng.integers(300, 1200, 6)
+    offsets = rng.random(6)
+    rcs = np.array([50., 70., 50., 70., 50., 50.])
+    nlc_map = rng.normal(0, 0.5, 4001)
+
+    transforms = [
+        (remove_baseline, {"bl_0": rng.normal(0, 5, 6), "bl_1": rng.normal(0, 0.01, 6)}),
+        (center, {"center_index": centers, "n_samples_before": 200, "n_samples_after": 300}),
+        (trim_waveform, {"n_samples_before": 10, "n_samples_after": 20}),
+        (interpolate, {"offset": offsets}),
+        (savgol_filter, {"window_length": 31, "order": 3}),
+        (pz_correct, {"rc": rcs}),
+        (trap_filter, {"rampTime": 100, "flatTime": 40, "decayTime": 70., "baseline": rng.normal(0, 5, 6)}),
+        (notch_filter, {"notch_freq": 5e6}),
+        (asym_trap_filter, {"ramp": 80, "flat": 30, "fall": 20}),
+    ]
+    for transform, args in transforms:
+        out = transform(block, **args)
+        assert len(out) == len(block), transform.__name__
+        for i, (wf, out_wf) in enumerate(zip(block, out)):
+            row_args = {name: value[i] if np.ndim(value) > 0 else value for name, value in args.items()}
+            assert np.array_equal(out_wf, transform(wf, **row_args)), transform.__name__
+
+    #corrected in place
+    time_constants = rng.uniform(5, 20, 6)
+    corrected = nonlinearity_correct(block.copy(), time_constants, nlc_map)
+    for i, wf in enumerate(block):
+        assert np.array_equal(corrected[i], nonlinearity_correct(wf.copy(), time_constants[i], nlc_map))